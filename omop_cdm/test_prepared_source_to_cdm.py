@@ -2,6 +2,8 @@ import unittest
 import json
 import csv
 import os
+import shutil
+import tempfile
 import sys
 sys.path.insert(0, os.path.curdir)
 import transform_prepared_source_to_cdm as tpsc
@@ -41,6 +43,16 @@ class TestMapping(unittest.TestCase):
             if os.path.exists(full_file_name):
                 os.remove(full_file_name)
 
+    def test_id_range_overflow(self):
+        # A stage raises on the first row past the IDs reserved for it rather than after it has finished
+        output_directory = tempfile.mkdtemp()
+        try:
+            with self.assertRaisesRegex(RuntimeError, "past the last reserved ID 1$"):
+                tpsc.main("./test/input/", output_directory, self.config["json_map_directory"], id_block_size=1,
+                          persist_id_maps=False)
+        finally:
+            shutil.rmtree(output_directory)
+
     def test_cdm_file_generation(self):
 
         tpsc.main("./test/input/", "./test/output/", self.config["json_map_directory"])
@@ -135,6 +147,91 @@ class TestMapping(unittest.TestCase):
         self.assertNotEqual("0", first_drug_exposure["drug_concept_id"])
 
 
+def append_csv_rows(csv_file_name, rows):
+    with open_csv_file(csv_file_name) as f:
+        ends_with_newline = f.read().endswith("\n")
+    with open_csv_file(csv_file_name, "a") as fw:
+        if not ends_with_newline:
+            fw.write("\n")
+        csv.writer(fw, lineterminator="\n").writerows(rows)
+
+
+class TestDeltaMapping(unittest.TestCase):
+
+    def setUp(self):
+        with open("./test/test_config.json") as f:
+            self.config = json.load(f)
+
+        self.full_output_directory = "./test/delta_full_output/"
+        self.input_directory = "./test/delta_input/"
+        self.delta_output_directory = "./test/delta_output/"
+        self.tearDown()
+
+        os.makedirs(self.full_output_directory)
+        os.makedirs(self.delta_output_directory)
+        shutil.copytree("./test/input/", self.input_directory)
+
+    def tearDown(self):
+        for directory in [self.full_output_directory, self.input_directory, self.delta_output_directory]:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    def test_delta_mapping(self):
+        tpsc.main("./test/input/", self.full_output_directory, self.config["json_map_directory"])
+
+        # Without a delta manifest the largest ids are read from the CDM files
+        max_ids, id_maps = tpsc.read_previous_id_state(self.full_output_directory)
+        self.assertEqual(4, max_ids["person"])
+        self.assertEqual(1, max_ids["visit_occurrence"])
+        self.assertEqual(os.path.abspath(os.path.join(self.full_output_directory, "person_cdm.csv.json")),
+                         id_maps["person"])
+
+        # A new visit of person 100 and a new person 300
+        append_csv_rows(os.path.join(self.input_directory, "source_encounter.csv"),
+                        [["11", "100", "2016-02-01 08:00", "2016-02-01 10:00", "Outpatient", "Outpatient Visit",
+                          "", "", "", "", ""]])
+        append_csv_rows(os.path.join(self.input_directory, "source_person.csv"),
+                        [["300", "F", "FEMALE", "1990-01-01", "", "", "", "", "", ""]])
+
+        tpsc.main(self.input_directory, self.delta_output_directory, self.config["json_map_directory"],
+                  previous_output_csv_directory=self.full_output_directory,
+                  previous_input_csv_directory="./test/input/")
+
+        full_person_ids = dict([(row_dict["person_source_value"], row_dict["person_id"]) for row_dict in
+                                read_csv_file_as_dict(os.path.join(self.full_output_directory, "person_cdm.csv"))])
+        delta_person_ids = dict([(row_dict["person_source_value"], row_dict["person_id"]) for row_dict in
+                                 read_csv_file_as_dict(os.path.join(self.delta_output_directory, "person_cdm.csv"))])
+
+        # Only the changed persons are mapped; a person keeps its id and a new person gets an id after the largest
+        self.assertEqual({"100", "300"}, set(delta_person_ids.keys()))
+        self.assertEqual(full_person_ids["100"], delta_person_ids["100"])
+        self.assertTrue(int(delta_person_ids["300"]) > max_ids["person"])
+
+        delta_visits = read_csv_file_as_dict(os.path.join(self.delta_output_directory, "visit_occurrence_cdm.csv"))
+        self.assertEqual(["11"], [row_dict["visit_source_value"] for row_dict in delta_visits])
+        self.assertTrue(int(delta_visits[0]["visit_occurrence_id"]) > max_ids["visit_occurrence"])
+        self.assertEqual(full_person_ids["100"], delta_visits[0]["person_id"])
+
+        # The replace sets delete the rows of the changed persons and replace tables without a person_id
+        replace_person_ids = [row_dict["person_id"] for row_dict in read_csv_file_as_dict(
+            os.path.join(self.delta_output_directory, tpsc.replace_person_id_file_name))]
+        self.assertEqual(sorted([int(delta_person_ids["100"]), int(delta_person_ids["300"])]),
+                         [int(person_id) for person_id in replace_person_ids])
+
+        with open(os.path.join(self.delta_output_directory, tpsc.delta_manifest_file_name)) as f:
+            manifest_dict = json.load(f)
+        self.assertEqual("person_id", manifest_dict["tables"]["person"]["replace_field"])
+        self.assertEqual(["person_cdm.csv"], manifest_dict["tables"]["person"]["files"])
+        self.assertIsNone(manifest_dict["tables"]["location"]["replace_field"])
+
+        # A later delta run starts from the merged id maps and largest ids of this run
+        delta_max_ids, delta_id_maps = tpsc.read_previous_id_state(self.delta_output_directory)
+        self.assertEqual(int(delta_person_ids["300"]), delta_max_ids["person"])
+        self.assertEqual(int(delta_visits[0]["visit_occurrence_id"]), delta_max_ids["visit_occurrence"])
+        with open(delta_id_maps["person"]) as f:
+            self.assertEqual({"100", "101", "102", "201", "300"}, set(json.load(f).keys()))
+
+
 class TestCodeMappers(unittest.TestCase):
     def setUp(self):
 
@@ -24,6 +24,8 @@ except ImportError:
     from prepared_source_classes import *
     from mapping_classes import *
 
+import csv
+import shutil
 import logging
 import argparse
 
@@ -69,21 +71,367 @@ def procedure_post_processing(output_dict):
     return output_dict
 
 
-def main(input_csv_directory, output_csv_directory, json_map_directory):
+def run_mapper(map_runner_obj, n_workers=1, batch_size=None, compile_rules=False, pipeline=False, profiler=None,
+               prefetch_size=None, memoize_rules=False, commit_file_name=None, commit_rows=100000):
+    """Run a mapper in the current process, with reader and writer threads if pipeline is set, or split the input
+    across n_workers processes. With prefetch_size the vocabulary lookups are prefetched for blocks of rows. With
+    memoize_rules the results of pure mapper trees are cached on their input values. With commit_file_name a run in
+    the current process commits the rows mapped every commit_rows rows and resumes from the last commit."""
+    if memoize_rules:
+        map_runner_obj.input_output_directory_obj.memoize()
+
+    if compile_rules:
+        map_runner_obj.input_output_directory_obj.compile()
+
+    if profiler is not None:
+        map_runner_obj.profiler = profiler
+
+    if prefetch_size is not None:
+        map_runner_obj.prefetch_size = prefetch_size
+
+    if commit_file_name is not None:
+        if n_workers > 1 or pipeline:
+            logging.warning("Rows are only committed when mapping in a single thread")
+        else:
+            map_runner_obj.commit_file_name = commit_file_name
+            map_runner_obj.commit_rows = commit_rows
+
+    if n_workers > 1:
+        map_runner_obj.run_parallel(n_workers=n_workers, batch_size=batch_size)
+    elif pipeline:
+        map_runner_obj.run_pipelined(batch_size=batch_size)
+    else:
+        map_runner_obj.run(batch_size=batch_size)
+
+    log_lookup_cache_statistics()
+
+
+def run_stage_mapper(map_runner_obj, config, stage_name, parallel=False):
+    """Run the mapper of a stage with the options in config. Only parallel stages split their input across
+    n_workers processes."""
+    if config["profile_directory"] is not None:
+        profiler = MappingProfiler(config["profile_directory"])
+        # Reports are numbered in the order the stages run with a single worker
+        profiler.n_reports = mapping_stage_graph.execution_order().index(stage_name)
+    else:
+        profiler = None
+
+    if parallel:
+        n_workers = config["n_workers"]
+    else:
+        n_workers = 1
+
+    if config["checkpoints"] is not None:
+        commit_file_name = config["checkpoints"].commit_file_name(stage_name)
+    else:
+        commit_file_name = None
+
+    run_mapper(map_runner_obj, n_workers=n_workers, batch_size=config["batch_size"],
+               compile_rules=config["compile_rules"], pipeline=config["pipeline"], profiler=profiler,
+               prefetch_size=config["prefetch_size"], memoize_rules=config["memoize_rules"],
+               commit_file_name=commit_file_name, commit_rows=config["commit_rows"])
+
+    config["id_ranges"].check_rows_run(stage_name, map_runner_obj.rows_run)
+
+
+def allocate_id_ranges(input_csv_directory, block_size=None, table_offsets=None):
+    """Reserve the IDs of the CDM tables written by the stages. Without a block_size each stage reserves an ID for
+    each row of its input file. Without table_offsets the first range of a table has an offset of 0 so its IDs
+    are the ':row_id' of the input rows."""
+    id_ranges = IdRangeAllocator(block_size, table_offsets)
+    id_ranges.reserve_csv_rows("observation_period", ["observation_period"],
+                               os.path.join(input_csv_directory, "source_observation_period.csv"))
+    id_ranges.reserve_csv_rows("visit_detail", ["visit_detail"],
+                               os.path.join(input_csv_directory, "source_encounter_detail.csv"))
+    id_ranges.reserve_csv_rows("payer_plan_period", ["payer_plan_period"],
+                               os.path.join(input_csv_directory, "source_encounter_coverage.csv"))
+    id_ranges.reserve_csv_rows("measurement", ["measurement", "observation"],
+                               os.path.join(input_csv_directory, "source_result.csv"))
+    id_ranges.reserve_csv_rows("condition", ["condition_occurrence", "measurement", "observation",
+                                             "procedure_occurrence"],
+                               os.path.join(input_csv_directory, "source_condition.csv"))
+    id_ranges.reserve_csv_rows("procedure", ["measurement", "observation", "procedure_occurrence", "drug_exposure",
+                                             "device_exposure"],
+                               os.path.join(input_csv_directory, "source_procedure.csv"))
+    id_ranges.reserve_csv_rows("drug_exposure", ["drug_exposure"],
+                               os.path.join(input_csv_directory, "source_medication.csv"))
+    return id_ranges
+
+
+def stage_build_options(config):
+    """The rule configuration each stage checkpoint is valid for: the files defining the rules, the lookup build
+    policy, whether id maps are persisted, the id maps of a previous run and the ID ranges of the stage"""
+    rule_files_sha256 = [hash_file(os.path.abspath(__file__)),
+                         hash_file(sys.modules[generate_mapper_obj.__module__].__file__)]
+    premapped_id_maps_sha256 = dict([(table_name, hash_file(json_file_name))
+                                     for table_name, json_file_name in config["premapped_id_maps"].items()])
+    return {stage_obj.name: {"rule_files_sha256": rule_files_sha256,
+                             "non_unique_key_policy": lookup_build_defaults["non_unique_key_policy"],
+                             "persist_id_maps": config["persist_id_maps"],
+                             "premapped_id_maps_sha256": premapped_id_maps_sha256,
+                             "id_ranges": config["id_ranges"].stage_id_ranges(stage_obj.name)}
+            for stage_obj in mapping_stage_graph.stages}
+
+
+def premapped_id_map(config, table_name, output_csv_file_name):
+    """The JSON id map of source values whose ids a stage keeps: the map of the previous run in delta mode or
+    else the map persisted next to the output file by an earlier run"""
+    if table_name in config["premapped_id_maps"]:
+        return config["premapped_id_maps"][table_name]
+    elif os.path.exists(output_csv_file_name + ".json"):
+        return output_csv_file_name + ".json"
+    else:
+        return None
+
+
+#### DELTA MODE ####
+
+delta_manifest_file_name = "delta_manifest.json"
+replace_person_id_file_name = "replace_person_id.csv"
+
+
+def person_source_file_names(input_csv_directory):
+    """The prepared source files with rows of a person, which are the files with an s_person_id field"""
+    return sorted([file_name for file_name in os.listdir(input_csv_directory) if file_name.endswith(".csv") and
+                   "s_person_id" in [field_name.lower() for field_name in
+                                     read_csv_header(os.path.join(input_csv_directory, file_name))]])
+
+
+def read_changed_persons(changed_persons_file_name):
+    """Read a file with an s_person_id on each line and an optional s_person_id header"""
+    with open(changed_persons_file_name, "r", newline="", encoding="utf8") as f:
+        s_person_ids = [row[0].strip() for row in csv.reader(f) if len(row) and len(row[0].strip())]
+
+    if len(s_person_ids) and s_person_ids[0].lower() == "s_person_id":
+        s_person_ids = s_person_ids[1:]
+
+    return set(s_person_ids)
+
+
+def changed_persons_between_snapshots(previous_input_csv_directory, input_csv_directory):
+    """Return the s_person_id of the persons with a row which was added, changed or removed in a person source
+    file between two prepared source snapshots"""
+    changed_persons = set()
+
+    file_names = person_source_file_names(input_csv_directory)
+    previous_file_names = person_source_file_names(previous_input_csv_directory)
+
+    for file_name in sorted(set(file_names) | set(previous_file_names)):
+        csv_file_name = os.path.join(input_csv_directory, file_name)
+        previous_csv_file_name = os.path.join(previous_input_csv_directory, file_name)
+
+        if file_name in file_names and file_name in previous_file_names:
+            file_changed_persons = changed_csv_keys(previous_csv_file_name, csv_file_name, "s_person_id")
+        elif file_name in file_names:
+            file_changed_persons = set(csv_key_digests(csv_file_name, "s_person_id"))
+        else:
+            file_changed_persons = set(csv_key_digests(previous_csv_file_name, "s_person_id"))
+
+        logging.info("%s persons changed in '%s'" % (len(file_changed_persons), file_name))
+        changed_persons |= file_changed_persons
+
+    return changed_persons
+
+
+def prepare_delta_input(input_csv_directory, delta_input_csv_directory, changed_persons):
+    """Write the rows of the changed persons in each person source file to delta_input_csv_directory. Other
+    source files, such as locations and care sites, are copied whole."""
+    if not os.path.exists(delta_input_csv_directory):
+        os.makedirs(delta_input_csv_directory)
+
+    file_names = person_source_file_names(input_csv_directory)
+    for file_name in sorted(os.listdir(input_csv_directory)):
+        csv_file_name = os.path.join(input_csv_directory, file_name)
+        delta_csv_file_name = os.path.join(delta_input_csv_directory, file_name)
+        if file_name in file_names:
+            n_rows = filter_csv_file(csv_file_name, delta_csv_file_name, "s_person_id", changed_persons)
+            logging.info("Wrote %s rows of changed persons to '%s'" % (n_rows, delta_csv_file_name))
+        elif file_name.endswith(".csv"):
+            shutil.copyfile(csv_file_name, delta_csv_file_name)
+
+
+def cdm_file_table_name(csv_file_name):
+    """Return the name of the CDM table whose fields are the header of a CDM file"""
+    header = read_csv_header(csv_file_name)
+    for output_class in OutputClass.__subclasses__():
+        if output_class.__module__ == PersonObject.__module__ and output_class().fields() == header:
+            return output_class().table_name()
+    return None
+
+
+def cdm_file_max_ids(csv_file_name):
+    """Return {table: largest id} of a CDM file of a table with an id field"""
+    table_name = cdm_file_table_name(csv_file_name)
+    if table_name is not None and read_csv_header(csv_file_name)[0] == table_name + "_id":
+        return {table_name: get_largest_id_from_csv_file(csv_file_name, table_name + "_id")}
+    else:
+        return {}
+
+
+def read_previous_id_state(previous_output_csv_directory):
+    """Return the largest id of each CDM table and the person and visit id maps written by a previous full or
+    delta run"""
+    manifest_file_name = os.path.join(previous_output_csv_directory, delta_manifest_file_name)
+    if os.path.exists(manifest_file_name):
+        with open(manifest_file_name, "r") as f:
+            manifest_dict = json.load(f)
+        max_ids = manifest_dict["max_ids"]
+        id_map_file_names = manifest_dict["id_maps"]
+    else:
+        max_ids = {}
+        for file_name in sorted(os.listdir(previous_output_csv_directory)):
+            if file_name.endswith("_cdm.csv"):
+                for table_name, max_id in cdm_file_max_ids(os.path.join(previous_output_csv_directory,
+                                                                        file_name)).items():
+                    max_ids[table_name] = max(max_ids.get(table_name, 0), max_id)
+        id_map_file_names = {"person": "person_cdm.csv.json", "visit_occurrence": "visit_occurrence_cdm.csv.json"}
+
+    id_maps = {}
+    for table_name, file_name in id_map_file_names.items():
+        json_file_name = os.path.join(previous_output_csv_directory, file_name)
+        if not os.path.exists(json_file_name):
+            raise ValueError("The previous run did not persist the '%s' id map '%s'" % (table_name, json_file_name))
+        id_maps[table_name] = os.path.abspath(json_file_name)
+
+    return max_ids, id_maps
+
+
+def write_delta_replace_sets(output_csv_directory, stage_outputs, changed_persons, previous_max_ids,
+                             previous_id_maps):
+    """Write the replace sets which a loader applies to the CDM of the previous run. A table whose rows have a
+    person_id is brought up to date by deleting the rows of each person_id in the replace_person_id file and
+    loading the rows of its files; a table without person_id, such as location, is replaced by its files. The
+    manifest also holds the largest id of each table and the person and visit id maps merged with those of the
+    previous run, which a later delta run starts from."""
+    id_map_file_names = {}
+    merged_id_maps = {}
+    for table_name, id_field_name in [("person", "person_id"), ("visit_occurrence", "visit_occurrence_id")]:
+        with open(previous_id_maps[table_name], "r") as f:
+            merged_id_map = json.load(f)
+        with open(stage_outputs[table_name + "_cdm.csv.json"], "r") as f:
+            merged_id_map.update(json.load(f))
+
+        id_map_file_names[table_name] = table_name + "_id_map.json"
+        write_json_map(merged_id_map, os.path.join(output_csv_directory, id_map_file_names[table_name]),
+                       sorted_key_lookup=False)
+        merged_id_maps[table_name] = merged_id_map
+
+    replace_person_ids = sorted(set([int(merged_id_maps["person"][s_person_id]["person_id"])
+                                     for s_person_id in changed_persons if s_person_id in merged_id_maps["person"]]))
+    with open(os.path.join(output_csv_directory, replace_person_id_file_name), "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(["person_id"])
+        csv_writer.writerows([[person_id] for person_id in replace_person_ids])
+
+    max_ids = dict(previous_max_ids)
+    tables = {}
+    for output_name in sorted(stage_outputs):
+        if output_name.endswith("_cdm.csv"):
+            csv_file_name = stage_outputs[output_name]
+            table_name = cdm_file_table_name(csv_file_name)
+            if table_name not in tables:
+                if "person_id" in read_csv_header(csv_file_name):
+                    tables[table_name] = {"replace_field": "person_id",
+                                          "replace_file": replace_person_id_file_name, "files": []}
+                else:
+                    tables[table_name] = {"replace_field": None, "replace_file": None, "files": []}
+            tables[table_name]["files"] += [os.path.relpath(csv_file_name, output_csv_directory)]
+
+            for max_table_name, max_id in cdm_file_max_ids(csv_file_name).items():
+                max_ids[max_table_name] = max(max_ids.get(max_table_name, 0), max_id)
+
+    manifest_dict = {"changed_persons": len(changed_persons), "replace_person_ids": len(replace_person_ids),
+                     "tables": tables, "max_ids": max_ids, "id_maps": id_map_file_names}
+    with open(os.path.join(output_csv_directory, delta_manifest_file_name), "w") as fw:
+        json.dump(manifest_dict, fw, indent=4, sort_keys=True)
+
+    logging.info("Wrote replace sets of %s tables for %s persons" % (len(tables), len(replace_person_ids)))
+    return manifest_dict
+
+
+def main(input_csv_directory, output_csv_directory, json_map_directory, n_workers=1, batch_size=None,
+         compile_rules=False, project_input_fields=False, pipeline=False, profile_directory=None,
+         prefetch_size=None, memoize_rules=False, max_workers=1, id_block_size=None, persist_id_maps=True,
+         checkpoint_directory=None, resume=False, commit_rows=100000, previous_output_csv_directory=None,
+         changed_persons_file_name=None, previous_input_csv_directory=None):
+    """Map the prepared source to the CDM. Stages which do not depend on each other run concurrently in up to
+    max_workers processes. Stages writing the same table get disjoint ID ranges of id_block_size IDs or, by
+    default, of the number of rows of their input file. The location, person, care site and visit id maps are
+    captured while the CDM files are written and, with persist_id_maps or more than one worker, also written as
+    JSON maps next to them, which stages in other processes open.
+    With a checkpoint_directory each stage which completes is checkpointed and skipped on a rerun while its
+    checkpoint is current; with resume a stage which did not complete continues from the last of the rows
+    committed every commit_rows rows.
+
+    With a previous_output_csv_directory only the rows of changed persons are mapped: the persons in
+    changed_persons_file_name and those whose rows differ from the snapshot in previous_input_csv_directory.
+    Persons and visits keep the ids of the previous run, other ids start after its largest ids, and replace
+    sets for the loader are written with write_delta_replace_sets."""
     # TODO: Add Provider
 
+    if previous_output_csv_directory is not None:
+        changed_persons = set()
+        if changed_persons_file_name is not None:
+            changed_persons |= read_changed_persons(changed_persons_file_name)
+        if previous_input_csv_directory is not None:
+            changed_persons |= changed_persons_between_snapshots(previous_input_csv_directory, input_csv_directory)
+        if changed_persons_file_name is None and previous_input_csv_directory is None:
+            raise ValueError("A delta run needs a changed persons file or a previous input directory")
+        logging.info("Mapping the rows of %s changed persons" % len(changed_persons))
+
+        previous_max_ids, premapped_id_maps = read_previous_id_state(previous_output_csv_directory)
+        delta_input_csv_directory = os.path.join(output_csv_directory, "delta_source")
+        prepare_delta_input(input_csv_directory, delta_input_csv_directory, changed_persons)
+        input_csv_directory = delta_input_csv_directory
+        # The id maps merged into the manifest are read from the persisted maps
+        persist_id_maps = True
+    else:
+        changed_persons = None
+        previous_max_ids = None
+        premapped_id_maps = {}
+
+    if max_workers is not None and max_workers > 1:  # Stages in worker processes read the persisted id maps
+        persist_id_maps = True
+
+    config = {"input_csv_directory": input_csv_directory, "output_csv_directory": output_csv_directory,
+              "json_map_directory": json_map_directory, "n_workers": n_workers, "batch_size": batch_size,
+              "compile_rules": compile_rules, "project_input_fields": project_input_fields, "pipeline": pipeline,
+              "profile_directory": profile_directory, "prefetch_size": prefetch_size,
+              "memoize_rules": memoize_rules, "persist_id_maps": persist_id_maps,
+              "id_ranges": allocate_id_ranges(input_csv_directory, id_block_size, previous_max_ids),
+              "premapped_id_maps": premapped_id_maps, "commit_rows": commit_rows, "checkpoints": None}
+
+    if checkpoint_directory is not None:
+        config["checkpoints"] = StageCheckpoints(checkpoint_directory, input_csv_directory,
+                                                 stage_build_options(config), resume)
+
+    stage_outputs = mapping_stage_graph.run(config, max_workers=max_workers, checkpoints=config["checkpoints"])
+
+    if changed_persons is not None:
+        write_delta_replace_sets(output_csv_directory, stage_outputs, changed_persons, previous_max_ids,
+                                 premapped_id_maps)
+
+    return stage_outputs
+
+
+#### STAGES ####
+
+def location_stage(config, stage_inputs):
+
     output_class_obj = OutputClassDirectory()
     in_out_map_obj = InputOutputMapperDirectory()
-    output_directory_obj = OutputClassDirectory()
 
-    ### Location ###
+    # Shares the lookups made by a router with the rules mapping the same row
+    mapping_context = MappingContext()
 
-    input_location_csv = os.path.join(input_csv_directory, "source_location.csv")
-    output_location_csv = os.path.join(output_csv_directory, "location_cdm.csv")
+    input_location_csv = os.path.join(config["input_csv_directory"], "source_location.csv")
+    output_location_csv = os.path.join(config["output_csv_directory"], "location_cdm.csv")
 
     def location_router_obj(input_dict):
         return LocationObject()
 
+    location_router_obj.input_fields = []
+
     # ["location_id", "address_1", "address_2", "city", "state", "zip", "county", "location_source_value"]
     # k_location,s_address_1,s_address_2,s_city,s_state,s_zip,s_county
     location_rules = [
@@ -98,41 +446,68 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
 
     location_runner_obj = generate_mapper_obj(input_location_csv, SourceLocationObject(), output_location_csv,
                                            LocationObject(), location_rules,
-                                           output_class_obj, in_out_map_obj, location_router_obj)
+                                           output_class_obj, in_out_map_obj, location_router_obj,
+                                           mapping_context=mapping_context,
+                                           project_input_fields=config["project_input_fields"],
+                                           id_map_fields=("location_source_value", "location_id"))
 
-    location_runner_obj.run()
+    run_stage_mapper(location_runner_obj, config, "location")
 
-    location_json_file_name = create_json_map_from_csv_file(output_location_csv, "location_source_value",
-                                                             "location_id")
+    location_id_map = output_class_obj[LocationObject].id_map()
+    if config["persist_id_maps"]:
+        location_json_file_name = write_json_map_from_id_map(location_id_map, output_location_csv + ".json")
+    else:
+        location_json_file_name = None
 
-    k_location_mapper = CoderMapperJSONClass(location_json_file_name, "k_location")
+    return {"location_cdm.csv": output_location_csv, "location_id_map": location_id_map,
+            "location_cdm.csv.json": location_json_file_name}
 
-    #### Person ####
 
-    input_person_csv = os.path.join(input_csv_directory, "source_person.csv")
-    output_person_csv = os.path.join(output_csv_directory, "person_cdm.csv")
+def person_stage(config, stage_inputs):
 
-    if os.path.exists(output_person_csv + ".json"):
-        premapped_patients_json = output_person_csv + ".json"
-    else:
-        premapped_patients_json = None
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    k_location_mapper = CoderMapperIdMapClass(stage_inputs["location_id_map"], "k_location")
 
-    person_rules = create_person_rules(json_map_directory, k_location_mapper, person_id_json_file_name=premapped_patients_json)
+    input_person_csv = os.path.join(config["input_csv_directory"], "source_person.csv")
+    output_person_csv = os.path.join(config["output_csv_directory"], "person_cdm.csv")
+
+    premapped_patients_json = premapped_id_map(config, "person", output_person_csv)
+
+    person_rules = create_person_rules(config["json_map_directory"], k_location_mapper,
+                                       person_id_json_file_name=premapped_patients_json)
 
     person_runner_obj = generate_mapper_obj(input_person_csv, SourcePersonObject(), output_person_csv, PersonObject(),
                                             person_rules,
-                                            output_class_obj, in_out_map_obj, person_router_obj)
+                                            output_class_obj, in_out_map_obj, person_router_obj,
+                                            mapping_context=mapping_context,
+                                            project_input_fields=config["project_input_fields"],
+                                            id_map_fields=("person_source_value", "person_id"))
+
+    run_stage_mapper(person_runner_obj, config, "person")
+
+    # Look up for s_person_id
+    person_id_map = output_class_obj[PersonObject].id_map()
+    if config["persist_id_maps"]:
+        person_json_file_name = write_json_map_from_id_map(person_id_map, output_person_csv + ".json")
+    else:
+        person_json_file_name = None
 
-    person_runner_obj.run()
+    return {"person_cdm.csv": output_person_csv, "person_id_map": person_id_map,
+            "person_cdm.csv.json": person_json_file_name}
 
-    #### Death ####
 
-    # Generate look up for s_person_id
-    output_person_csv = os.path.join(output_csv_directory, "person_cdm.csv")
-    person_json_file_name = create_json_map_from_csv_file(output_person_csv, "person_source_value", "person_id")
-    s_person_id_mapper = CoderMapperJSONClass(person_json_file_name)
+def death_stage(config, stage_inputs):
 
-    death_rules = create_death_person_rules(json_map_directory, s_person_id_mapper)
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+
+    death_rules = create_death_person_rules(config["json_map_directory"], s_person_id_mapper)
 
     def death_router_obj(input_dict):
         """Determines if a row_dict codes a death"""
@@ -150,18 +525,34 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
-    output_death_csv = os.path.join(output_csv_directory, "death_cdm.csv")
+    death_router_obj.input_fields = ["s_person_id", "i_exclude", "s_death_datetime"]
+
+    input_person_csv = os.path.join(config["input_csv_directory"], "source_person.csv")
+    output_death_csv = os.path.join(config["output_csv_directory"], "death_cdm.csv")
     death_runner_obj = generate_mapper_obj(input_person_csv, SourcePersonObject(), output_death_csv, DeathObject(),
-                                           death_rules, output_class_obj, in_out_map_obj, death_router_obj)
-    death_runner_obj.run()
+                                           death_rules, output_class_obj, in_out_map_obj, death_router_obj,
+                                           mapping_context=mapping_context,
+                                           project_input_fields=config["project_input_fields"])
+    run_stage_mapper(death_runner_obj, config, "death")
 
-    #### Observation_Period ####
+    return {"death_cdm.csv": output_death_csv}
 
-    obs_per_rules = create_observation_period_rules(json_map_directory, s_person_id_mapper)
 
-    output_obs_per_csv = os.path.join(output_csv_directory, "observation_period_cdm.csv")
+def observation_period_stage(config, stage_inputs):
 
-    input_obs_per_csv = os.path.join(input_csv_directory, "source_observation_period.csv")
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+
+    obs_per_rules = create_observation_period_rules(config["json_map_directory"], s_person_id_mapper,
+                                                    *config["id_ranges"].offset_and_max_id("observation_period",
+                                                                                           "observation_period"))
+
+    output_obs_per_csv = os.path.join(config["output_csv_directory"], "observation_period_cdm.csv")
+
+    input_obs_per_csv = os.path.join(config["input_csv_directory"], "source_observation_period.csv")
 
     def obs_router_obj(input_dict):
         if len(s_person_id_mapper.map({"s_person_id": input_dict["s_person_id"]})):
@@ -169,47 +560,74 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    obs_router_obj.input_fields = ["s_person_id"]
+
     obs_per_runner_obj = generate_mapper_obj(input_obs_per_csv, SourceObservationPeriodObject(), output_obs_per_csv,
                                              ObservationPeriodObject(),
-                                             obs_per_rules, output_class_obj, in_out_map_obj, obs_router_obj)
-    obs_per_runner_obj.run()
+                                             obs_per_rules, output_class_obj, in_out_map_obj, obs_router_obj,
+                                             mapping_context=mapping_context,
+                                             project_input_fields=config["project_input_fields"])
+    run_stage_mapper(obs_per_runner_obj, config, "observation_period")
+
+    return {"observation_period_cdm.csv": output_obs_per_csv}
 
-    #### Care Sites ####
+
+def care_site_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
 
     care_site_rules = [
         (":row_id", "care_site_id"),
         ("s_care_site_name", "care_site_name"),
         ("k_care_site", "care_site_source_value")]
 
-    input_care_site_csv = os.path.join(input_csv_directory, "source_care_site.csv")
-    output_care_site_csv = os.path.join(output_csv_directory, "care_site_cdm.csv")
+    input_care_site_csv = os.path.join(config["input_csv_directory"], "source_care_site.csv")
+    output_care_site_csv = os.path.join(config["output_csv_directory"], "care_site_cdm.csv")
 
     def care_site_router_obj(input_dict):
         return CareSiteObject()
 
+    care_site_router_obj.input_fields = []
+
     care_site_runner_obj = generate_mapper_obj(input_care_site_csv, SourceCareSiteObject(), output_care_site_csv,
                                            CareSiteObject(), care_site_rules,
-                                           output_class_obj, in_out_map_obj, care_site_router_obj)
+                                           output_class_obj, in_out_map_obj, care_site_router_obj,
+                                           mapping_context=mapping_context,
+                                           project_input_fields=config["project_input_fields"],
+                                           id_map_fields=("care_site_source_value", "care_site_id"))
+
+    run_stage_mapper(care_site_runner_obj, config, "care_site")
+
+    care_site_id_map = output_class_obj[CareSiteObject].id_map()
+    if config["persist_id_maps"]:
+        care_site_json_file_name = write_json_map_from_id_map(care_site_id_map, output_care_site_csv + ".json")
+    else:
+        care_site_json_file_name = None
+
+    return {"care_site_cdm.csv": output_care_site_csv, "care_site_id_map": care_site_id_map,
+            "care_site_cdm.csv.json": care_site_json_file_name}
+
 
-    care_site_runner_obj.run()
+def visit_stage(config, stage_inputs):
 
-    care_site_json_file_name = create_json_map_from_csv_file(output_care_site_csv, "care_site_source_value",
-                                                             "care_site_id")
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
 
-    k_care_site_mapper = CoderMapperJSONClass(care_site_json_file_name, "k_care_site")
+    json_map_directory = config["json_map_directory"]
 
-    #### Visit_Occurrence ###
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    k_care_site_mapper = CoderMapperIdMapClass(stage_inputs["care_site_id_map"], "k_care_site")
 
     snomed_code_json = os.path.join(json_map_directory, "concept_code_SNOMED.json")
     snomed_code_mapper = CodeMapperClassSqliteJSONClass(snomed_code_json)
 
-    input_encounter_csv = os.path.join(input_csv_directory, "source_encounter.csv")
-    output_visit_occurrence_csv = os.path.join(output_csv_directory, "visit_occurrence_cdm.csv")
+    input_encounter_csv = os.path.join(config["input_csv_directory"], "source_encounter.csv")
+    output_visit_occurrence_csv = os.path.join(config["output_csv_directory"], "visit_occurrence_cdm.csv")
 
-    if os.path.exists(output_visit_occurrence_csv + ".json"):
-        visit_id_json = output_visit_occurrence_csv + ".json"
-    else:
-        visit_id_json = None
+    visit_id_json = premapped_id_map(config, "visit_occurrence", output_visit_occurrence_csv)
 
     visit_rules = create_visit_rules(json_map_directory, s_person_id_mapper, k_care_site_mapper, snomed_code_mapper,
                                      visit_id_json)
@@ -223,22 +641,42 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    visit_router_obj.input_fields = ["s_person_id", "i_exclude"]
+
     visit_runner_obj = generate_mapper_obj(input_encounter_csv, SourceEncounterObject(), output_visit_occurrence_csv,
                                            VisitOccurrenceObject(), visit_rules,
-                                           output_class_obj, in_out_map_obj, visit_router_obj)
+                                           output_class_obj, in_out_map_obj, visit_router_obj,
+                                           mapping_context=mapping_context,
+                                           project_input_fields=config["project_input_fields"],
+                                           id_map_fields=("visit_source_value", "visit_occurrence_id"))
 
-    visit_runner_obj.run()
+    run_stage_mapper(visit_runner_obj, config, "visit")
 
     # Visit ID Map
-    encounter_json_file_name = create_json_map_from_csv_file(output_visit_occurrence_csv, "visit_source_value",
-                                                             "visit_occurrence_id")
+    visit_occurrence_id_map = output_class_obj[VisitOccurrenceObject].id_map()
+    if config["persist_id_maps"]:
+        visit_occurrence_json_file_name = write_json_map_from_id_map(visit_occurrence_id_map, output_visit_occurrence_csv + ".json")
+    else:
+        visit_occurrence_json_file_name = None
+
+    return {"visit_occurrence_cdm.csv": output_visit_occurrence_csv, "visit_occurrence_id_map": visit_occurrence_id_map,
+            "visit_occurrence_cdm.csv.json": visit_occurrence_json_file_name}
+
 
-    s_encounter_id_mapper = CoderMapperJSONClass(encounter_json_file_name, "s_encounter_id")
+def visit_detail_stage(config, stage_inputs):
 
-    ### Visit Detail
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    json_map_directory = config["json_map_directory"]
 
-    input_encounter_detail_csv = os.path.join(input_csv_directory, "source_encounter_detail.csv")
-    output_visit_detail_csv = os.path.join(output_csv_directory, "visit_detail_cdm.csv")
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    k_care_site_mapper = CoderMapperIdMapClass(stage_inputs["care_site_id_map"], "k_care_site")
+    s_encounter_id_mapper = CoderMapperIdMapClass(stage_inputs["visit_occurrence_id_map"], "s_encounter_id")
+
+    input_encounter_detail_csv = os.path.join(config["input_csv_directory"], "source_encounter_detail.csv")
+    output_visit_detail_csv = os.path.join(config["output_csv_directory"], "visit_detail_cdm.csv")
 
     visit_concept_json = os.path.join(json_map_directory, "concept_name_Visit.json")
     visit_concept_mapper = ChainMapper(
@@ -260,8 +698,10 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     #  "preceding_visit_detail_id", "visit_source_value", "visit_source_concept_id", "admitting_source_value",
     #  "discharge_to_source_value", "visit_detail_parent_id", "visit_occurrence_id"]
 
+    visit_detail_row_offset, visit_detail_max_id = config["id_ranges"].offset_and_max_id("visit_detail", "visit_detail")
     visit_detail_rules = [
-        (":row_id", "visit_detail_id"),
+        (":row_id", row_map_offset("visit_detail_id", visit_detail_row_offset, visit_detail_max_id),
+         {"visit_detail_id": "visit_detail_id"}),
         ("s_encounter_detail_id", "visit_source_value"),
         ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
         ("s_encounter_id", s_encounter_id_mapper, {"visit_occurrence_id": "visit_occurrence_id"}),
@@ -298,19 +738,34 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    visit_detail_router_obj.input_fields = ["s_person_id", "s_encounter_id", "i_exclude", "s_start_datetime"]
+
     visit_detail_runner_obj = generate_mapper_obj(input_encounter_detail_csv, SourceEncounterDetailObject(),
                                                   output_visit_detail_csv,
                                                   VisitDetailObject(), visit_detail_rules,
-                                                  output_class_obj, in_out_map_obj, visit_detail_router_obj)
-    visit_detail_runner_obj.run()
-    # raise RuntimeError
-    #### Benefit Coverage Period ####
+                                                  output_class_obj, in_out_map_obj, visit_detail_router_obj,
+                                                  mapping_context=mapping_context,
+                                                  project_input_fields=config["project_input_fields"])
+    run_stage_mapper(visit_detail_runner_obj, config, "visit_detail")
 
-    payer_plan_period_rules = create_payer_plan_period_rules(s_person_id_mapper)
+    return {"visit_detail_cdm.csv": output_visit_detail_csv}
 
-    output_ppp_csv = os.path.join(output_csv_directory, "payer_plan_period_cdm.csv")
 
-    input_ppp_csv = os.path.join(input_csv_directory, "source_encounter_coverage.csv")
+def payer_plan_period_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+
+    payer_plan_period_rules = create_payer_plan_period_rules(s_person_id_mapper,
+                                                             *config["id_ranges"].offset_and_max_id(
+                                                                 "payer_plan_period", "payer_plan_period"))
+
+    output_ppp_csv = os.path.join(config["output_csv_directory"], "payer_plan_period_cdm.csv")
+
+    input_ppp_csv = os.path.join(config["input_csv_directory"], "source_encounter_coverage.csv")
 
     def payer_plan_period_router_obj(input_dict):
         if len(s_person_id_mapper.map({"s_person_id": input_dict["s_person_id"]})):
@@ -321,12 +776,31 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    payer_plan_period_router_obj.input_fields = ["s_person_id", "s_start_payer_date"]
+
     payer_plan_period_runner_obj = generate_mapper_obj(input_ppp_csv, SourceEncounterCoverageObject(), output_ppp_csv,
                                                        PayerPlanPeriodObject(),
                                                        payer_plan_period_rules, output_class_obj, in_out_map_obj,
-                                                       payer_plan_period_router_obj
-                                                       )
-    payer_plan_period_runner_obj.run()
+                                                       payer_plan_period_router_obj,
+                                                       mapping_context=mapping_context,
+                                                       project_input_fields=config["project_input_fields"])
+    run_stage_mapper(payer_plan_period_runner_obj, config, "payer_plan_period")
+
+    return {"payer_plan_period_cdm.csv": output_ppp_csv}
+
+
+def measurement_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    json_map_directory = config["json_map_directory"]
+
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    s_encounter_id_mapper = CoderMapperIdMapClass(stage_inputs["visit_occurrence_id_map"], "s_encounter_id")
+    snomed_code_json = os.path.join(json_map_directory, "concept_code_SNOMED.json")
+    snomed_code_mapper = CodeMapperClassSqliteJSONClass(snomed_code_json)
 
     #### MEASUREMENT and OBSERVATION dervived from 'source_result.csv' ####
 
@@ -351,26 +825,50 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    measurement_router_obj.input_fields = ["s_person_id", "i_exclude", "s_code"]
+
     snomed_json = os.path.join(json_map_directory, "concept_name_SNOMED.json")
     snomed_mapper = CodeMapperClassSqliteJSONClass(snomed_json)
 
     measurement_rules, observation_measurement_rules = \
         create_measurement_and_observation_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, snomed_mapper,
-                                                 snomed_code_mapper)
+                                                 snomed_code_mapper,
+                                                 *config["id_ranges"].offset_and_max_id("measurement", "measurement"),
+                                                 *config["id_ranges"].offset_and_max_id("measurement", "observation"))
 
-    input_result_csv = os.path.join(input_csv_directory, "source_result.csv")
-    output_measurement_csv = os.path.join(output_csv_directory, "measurement_encounter_cdm.csv")
+    input_result_csv = os.path.join(config["input_csv_directory"], "source_result.csv")
+    output_measurement_csv = os.path.join(config["output_csv_directory"], "measurement_encounter_cdm.csv")
 
     measurement_runner_obj = generate_mapper_obj(input_result_csv, SourceResultObject(), output_measurement_csv,
                                                  MeasurementObject(),
                                                  measurement_rules, output_class_obj, in_out_map_obj,
-                                                 measurement_router_obj)
+                                                 measurement_router_obj,
+                                                 mapping_context=mapping_context,
+                                                 project_input_fields=config["project_input_fields"])
 
-    output_observation_csv = os.path.join(output_csv_directory, "observation_measurement_encounter_cdm.csv")
+    output_observation_csv = os.path.join(config["output_csv_directory"], "observation_measurement_encounter_cdm.csv")
     register_to_mapper_obj(input_result_csv, SourceResultObject(), output_observation_csv,
                            ObservationObject(), observation_measurement_rules, output_class_obj, in_out_map_obj)
 
-    measurement_runner_obj.run()
+    run_stage_mapper(measurement_runner_obj, config, "measurement", parallel=True)
+
+    return {"measurement_encounter_cdm.csv": output_measurement_csv,
+            "observation_measurement_encounter_cdm.csv": output_observation_csv}
+
+
+def condition_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    output_directory_obj = OutputClassDirectory()
+    mapping_context = MappingContext()
+
+    json_map_directory = config["json_map_directory"]
+
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    s_encounter_id_mapper = CoderMapperIdMapClass(stage_inputs["visit_occurrence_id_map"], "s_encounter_id")
+    snomed_code_json = os.path.join(json_map_directory, "concept_code_SNOMED.json")
+    snomed_code_mapper = CodeMapperClassSqliteJSONClass(snomed_code_json)
 
     #### CONDITION / DX ####
 
@@ -383,10 +881,10 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
             condition_type_name_map
         )
 
-    input_condition_csv = os.path.join(input_csv_directory, "source_condition.csv")
-    hi_condition_csv_obj = InputClassCSVRealization(input_condition_csv, SourceConditionObject())
+    input_condition_csv = os.path.join(config["input_csv_directory"], "source_condition.csv")
+    hi_condition_csv_obj = InputClassCSVTupleRealization(input_condition_csv, SourceConditionObject())
 
-    output_condition_csv = os.path.join(output_csv_directory, "condition_occurrence_dx_cdm.csv")
+    output_condition_csv = os.path.join(config["output_csv_directory"], "condition_occurrence_dx_cdm.csv")
     cdm_condition_csv_obj = OutputClassCSVRealization(output_condition_csv, ConditionOccurrenceObject())
 
     icd9cm_json = os.path.join(json_map_directory, "ICD9CM_with_parent.json")
@@ -429,19 +927,23 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         return input_dict
 
 
-    ConditionMapper = ChainMapper(CaseMapper(case_mapper_condition,
+    ConditionMapper = mapping_context.memoize(ChainMapper(CaseMapper(case_mapper_condition,
                             CodeMapperClassSqliteJSONClass(icd9cm_json, "s_condition_code"),
                             CodeMapperClassSqliteJSONClass(icd10cm_json, "s_condition_code"),
-                            CodeMapperClassSqliteJSONClass(snomed_code_json, "s_condition_code")),
-                            PassThroughFunctionMapper(clean_concept_ids))
+                            CodeMapperClassSqliteJSONClass(snomed_code_json, "s_condition_code"), pure=True),
+                            PassThroughFunctionMapper(clean_concept_ids)),
+                            ("s_condition_code", "m_condition_code_oid"))
 
     s_condition_type_dict = {"Admitting": "52870002", "Final": "89100005", "Preliminary": "148006"}
     condition_status_snomed_mapper = CodeMapperDictClass(s_condition_type_dict, "s_condition_type")
     condition_status_mapper = ChainMapper(condition_status_snomed_mapper, snomed_code_mapper)
 
 
+    condition_row_offset, condition_max_id = config["id_ranges"].offset_and_max_id("condition", "condition_occurrence")
+
     # Required: condition_occurrence_id, person_id, condition_concept_id, condition_start_date
-    condition_rules_dx = [(":row_id", "condition_occurrence_id"),
+    condition_rules_dx = [(":row_id", row_map_offset("condition_occurrence_id", condition_row_offset, condition_max_id),
+                           {"condition_occurrence_id": "condition_occurrence_id"}),
                           ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                           ("s_encounter_id", s_encounter_id_mapper, {"visit_occurrence_id": "visit_occurrence_id"}),
                           (("s_condition_code", "m_condition_code_oid"),
@@ -463,8 +965,8 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     in_out_map_obj.register(SourceConditionObject(), ConditionOccurrenceObject(), condition_rules_dx_class)
     output_directory_obj.register(ConditionOccurrenceObject(), cdm_condition_csv_obj)
 
-    measurement_row_offset = measurement_runner_obj.rows_run
-    measurement_rules_dx = [(":row_id", row_map_offset("measurement_id", measurement_row_offset),
+    measurement_row_offset, measurement_max_id = config["id_ranges"].offset_and_max_id("condition", "measurement")
+    measurement_rules_dx = [(":row_id", row_map_offset("measurement_id", measurement_row_offset, measurement_max_id),
                              {"measurement_id": "measurement_id"}),
                             (":row_id", ConstantMapper({"measurement_type_concept_id": 0}),
                              {"measurement_type_concept_id": "measurement_type_concept_id"}),
@@ -484,16 +986,16 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     in_out_map_obj.register(SourceConditionObject(), MeasurementObject(), measurement_rules_dx_class)
 
     # The mapped ICD9 to measurements get mapped to a separate code
-    output_measurement_dx_encounter_csv = os.path.join(output_csv_directory, "measurement_dx_cdm.csv")
+    output_measurement_dx_encounter_csv = os.path.join(config["output_csv_directory"], "measurement_dx_cdm.csv")
     output_measurement_dx_encounter_csv_obj = OutputClassCSVRealization(output_measurement_dx_encounter_csv,
                                                                         MeasurementObject())
 
     output_directory_obj.register(MeasurementObject(), output_measurement_dx_encounter_csv_obj)
 
-    observation_row_offset = measurement_runner_obj.rows_run
+    observation_row_offset, observation_max_id = config["id_ranges"].offset_and_max_id("condition", "observation")
 
     # ICD9 and ICD10 codes which map to observations according to the CDM Vocabulary
-    observation_rules_dx = [(":row_id", row_map_offset("observation_id", observation_row_offset),
+    observation_rules_dx = [(":row_id", row_map_offset("observation_id", observation_row_offset, observation_max_id),
                              {"observation_id": "observation_id"}),
                             (":row_id", ConstantMapper({"observation_type_concept_id": 0}),
                              {"observation_type_concept_id": "observation_type_concept_id"}),
@@ -514,7 +1016,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
 
     observation_rules_dx_class = build_input_output_mapper(observation_rules_dx)
 
-    output_observation_dx_encounter_csv = os.path.join(output_csv_directory, "observation_dx_cdm.csv")
+    output_observation_dx_encounter_csv = os.path.join(config["output_csv_directory"], "observation_dx_cdm.csv")
     output_observation_dx_encounter_csv_obj = OutputClassCSVRealization(output_observation_dx_encounter_csv,
                                                                         ObservationObject())
 
@@ -528,7 +1030,10 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     # "Procedure recorded as diagnostic code"
     # TODO: Map procedure_type_concept_id
 
-    procedure_rules_dx_encounter = [(":row_id", "procedure_occurrence_id"),
+    procedure_row_offset, procedure_max_id = config["id_ranges"].offset_and_max_id("condition", "procedure_occurrence")
+    procedure_rules_dx_encounter = [(":row_id", row_map_offset("procedure_occurrence_id", procedure_row_offset,
+                                                               procedure_max_id),
+                                     {"procedure_occurrence_id": "procedure_occurrence_id"}),
                                     (":row_id",
                                      ChainMapper(ConstantMapper({"name": "Procedure recorded as diagnostic code"}),
                                                  procedure_type_mapper),
@@ -547,7 +1052,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
 
     procedure_rules_dx_encounter_class = build_input_output_mapper(procedure_rules_dx_encounter)
 
-    output_procedure_dx_encounter_csv = os.path.join(output_csv_directory, "procedure_dx_cdm.csv")
+    output_procedure_dx_encounter_csv = os.path.join(config["output_csv_directory"], "procedure_dx_cdm.csv")
     output_procedure_dx_encounter_csv_obj = OutputClassCSVRealization(output_procedure_dx_encounter_csv,
                                                                       ProcedureOccurrenceObject())
 
@@ -603,39 +1108,63 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    condition_router_obj.input_fields = ["m_condition_code_oid", "s_person_id", "i_exclude", "s_condition_code"]
+
     condition_runner_obj = RunMapperAgainstSingleInputRealization(hi_condition_csv_obj, in_out_map_obj,
                                                                   output_directory_obj,
                                                                   condition_router_obj,
-                                                                  post_map_func=condition_post_processing)
+                                                                  post_map_func=condition_post_processing,
+                                                                  mapping_context=mapping_context,
+                                                                  project_input_fields=config["project_input_fields"])
+
+    run_stage_mapper(condition_runner_obj, config, "condition", parallel=True)
+
+    return {"condition_occurrence_dx_cdm.csv": output_condition_csv,
+            "measurement_dx_cdm.csv": output_measurement_dx_encounter_csv,
+            "observation_dx_cdm.csv": output_observation_dx_encounter_csv,
+            "procedure_dx_cdm.csv": output_procedure_dx_encounter_csv}
+
+
+def procedure_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    output_directory_obj = OutputClassDirectory()
+    mapping_context = MappingContext()
 
-    condition_runner_obj.run()
+    json_map_directory = config["json_map_directory"]
 
-    # Update needed offsets
-    condition_row_offset = condition_runner_obj.rows_run
-    procedure_row_offset = condition_runner_obj.rows_run
-    measurement_row_offset += condition_row_offset
-    observation_row_offset += condition_row_offset
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    s_encounter_id_mapper = CoderMapperIdMapClass(stage_inputs["visit_occurrence_id_map"], "s_encounter_id")
+
+    procedure_row_offset, procedure_max_id = config["id_ranges"].offset_and_max_id("procedure", "procedure_occurrence")
+    measurement_row_offset, measurement_max_id = config["id_ranges"].offset_and_max_id("procedure", "measurement")
+    observation_row_offset, observation_max_id = config["id_ranges"].offset_and_max_id("procedure", "observation")
+    drug_row_offset, drug_max_id = config["id_ranges"].offset_and_max_id("procedure", "drug_exposure")
+    device_row_offset, device_max_id = config["id_ranges"].offset_and_max_id("procedure", "device_exposure")
 
     procedure_rules_encounter = create_procedure_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper,
-                                                       procedure_row_offset)
+                                                       procedure_row_offset, procedure_max_id,
+                                                       mapping_context=mapping_context)
     procedure_rule = procedure_rules_encounter[0]
     procedure_code_map = procedure_rule[1]
 
     procedure_rules_encounter_class = build_input_output_mapper(procedure_rules_encounter)
 
-    input_proc_csv = os.path.join(input_csv_directory, "source_procedure.csv")
-    hi_proc_csv_obj = InputClassCSVRealization(input_proc_csv, SourceProcedureObject())
+    input_proc_csv = os.path.join(config["input_csv_directory"], "source_procedure.csv")
+    hi_proc_csv_obj = InputClassCSVTupleRealization(input_proc_csv, SourceProcedureObject())
 
     in_out_map_obj.register(SourceProcedureObject(), ProcedureOccurrenceObject(), procedure_rules_encounter_class)
 
-    output_proc_encounter_csv = os.path.join(output_csv_directory, "procedure_cdm.csv")
+    output_proc_encounter_csv = os.path.join(config["output_csv_directory"], "procedure_cdm.csv")
     output_proc_encounter_csv_obj = OutputClassCSVRealization(output_proc_encounter_csv,
                                                               ProcedureOccurrenceObject())
 
     output_directory_obj.register(ProcedureOccurrenceObject(), output_proc_encounter_csv_obj)
 
     #### Measurements from Procedures #####
-    measurement_rules_proc_encounter = [(":row_id", row_map_offset("measurement_id", measurement_row_offset),
+    measurement_rules_proc_encounter = [(":row_id", row_map_offset("measurement_id", measurement_row_offset,
+                                                                   measurement_max_id),
                                          {"measurement_id": "measurement_id"}),
                                         ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                                         (":row_id", ConstantMapper({"measurement_type_concept_id": 0}),
@@ -654,7 +1183,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
 
     measurement_rules_proc_encounter_class = build_input_output_mapper(measurement_rules_proc_encounter)
 
-    output_measurement_proc_encounter_csv = os.path.join(output_csv_directory, "measurement_proc_cdm.csv")
+    output_measurement_proc_encounter_csv = os.path.join(config["output_csv_directory"], "measurement_proc_cdm.csv")
     output_measurement_proc_encounter_csv_obj = OutputClassCSVRealization(output_measurement_proc_encounter_csv,
                                                                           MeasurementObject())
 
@@ -663,7 +1192,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     in_out_map_obj.register(SourceProcedureObject(), MeasurementObject(), measurement_rules_proc_encounter_class)
 
     #### Observations from Procedures #####
-    observation_rules_proc = [(":row_id", row_map_offset("observation_id", observation_row_offset),
+    observation_rules_proc = [(":row_id", row_map_offset("observation_id", observation_row_offset, observation_max_id),
                                {"observation_id": "observation_id"}),
                               (":row_id", ConstantMapper({"observation_type_concept_id": 0}),
                                {"observation_type_concept_id": "observation_type_concept_id"}),
@@ -680,7 +1209,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
                                 "MAPPED_CONCEPT_ID".lower(): "observation_concept_id"})]
 
     observation_rules_proc_class = build_input_output_mapper(observation_rules_proc)
-    output_observation_proc_csv = os.path.join(output_csv_directory, "observation_proc_cdm.csv")
+    output_observation_proc_csv = os.path.join(config["output_csv_directory"], "observation_proc_cdm.csv")
     output_observation_proc_csv_obj = OutputClassCSVRealization(output_observation_proc_csv,
                                                                 ObservationObject())
 
@@ -688,7 +1217,8 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
     in_out_map_obj.register(SourceProcedureObject(), ObservationObject(), observation_rules_proc_class)
 
     ##### DrugExposure from Procedures ####
-    drug_rules_proc = [(":row_id", "drug_exposure_id"),
+    drug_rules_proc = [(":row_id", row_map_offset("drug_exposure_id", drug_row_offset, drug_max_id),
+                        {"drug_exposure_id": "drug_exposure_id"}),
                        (":row_id", ConstantMapper({"drug_type_concept_id": 0}),
                         {"drug_type_concept_id": "drug_type_concept_id"}),
                        ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
@@ -706,7 +1236,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
                          "MAPPED_CONCEPT_ID".lower(): "drug_concept_id"})]
 
     drug_rules_proc_class = build_input_output_mapper(drug_rules_proc)
-    output_drug_proc_csv = os.path.join(output_csv_directory, "drug_exposure_proc_cdm.csv")
+    output_drug_proc_csv = os.path.join(config["output_csv_directory"], "drug_exposure_proc_cdm.csv")
     output_drug_proc_csv_obj = OutputClassCSVRealization(output_drug_proc_csv,
                                                          DrugExposureObject())
 
@@ -715,7 +1245,8 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
 
     #### Device Exposure from Procedures ####
 
-    device_rules_proc = [(":row_id", "device_exposure_id"),
+    device_rules_proc = [(":row_id", row_map_offset("device_exposure_id", device_row_offset, device_max_id),
+                          {"device_exposure_id": "device_exposure_id"}),
                          (":row_id", ConstantMapper({"device_type_concept_id": 0}),
                           {"device_type_concept_id": "device_type_concept_id"}),
                          ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
@@ -732,7 +1263,7 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
                            "MAPPED_CONCEPT_ID".lower(): "device_concept_id"})]
 
     device_rules_proc_class = build_input_output_mapper(device_rules_proc)
-    output_device_proc_csv = os.path.join(output_csv_directory, "device_exposure_proc_cdm.csv")
+    output_device_proc_csv = os.path.join(config["output_csv_directory"], "device_exposure_proc_cdm.csv")
     output_device_proc_csv_obj = OutputClassCSVRealization(output_device_proc_csv,
                                                            DeviceExposureObject())
 
@@ -776,13 +1307,39 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
+    procedure_router_obj.input_fields = ["s_person_id", "m_procedure_code_oid", "s_procedure_code"]
+
     procedure_runner_obj = RunMapperAgainstSingleInputRealization(hi_proc_csv_obj, in_out_map_obj,
                                                                   output_directory_obj,
-                                                                  procedure_router_obj, post_map_func=procedure_post_processing)
+                                                                  procedure_router_obj, post_map_func=procedure_post_processing,
+                                                                  mapping_context=mapping_context,
+                                                                  project_input_fields=config["project_input_fields"])
+
+    run_stage_mapper(procedure_runner_obj, config, "procedure", parallel=True)
+
+    return {"procedure_cdm.csv": output_proc_encounter_csv,
+            "measurement_proc_cdm.csv": output_measurement_proc_encounter_csv,
+            "observation_proc_cdm.csv": output_observation_proc_csv,
+            "drug_exposure_proc_cdm.csv": output_drug_proc_csv,
+            "device_exposure_proc_cdm.csv": output_device_proc_csv}
+
+
+def drug_exposure_stage(config, stage_inputs):
+
+    output_class_obj = OutputClassDirectory()
+    in_out_map_obj = InputOutputMapperDirectory()
+    mapping_context = MappingContext()
+
+    json_map_directory = config["json_map_directory"]
 
-    procedure_runner_obj.run()
+    s_person_id_mapper = mapping_context.memoize(CoderMapperIdMapClass(stage_inputs["person_id_map"]), ("s_person_id",))
+    s_encounter_id_mapper = CoderMapperIdMapClass(stage_inputs["visit_occurrence_id_map"], "s_encounter_id")
+    snomed_code_json = os.path.join(json_map_directory, "concept_code_SNOMED.json")
+    snomed_code_mapper = CodeMapperClassSqliteJSONClass(snomed_code_json)
+    snomed_json = os.path.join(json_map_directory, "concept_name_SNOMED.json")
+    snomed_mapper = CodeMapperClassSqliteJSONClass(snomed_json)
 
-    drug_row_offset = procedure_runner_obj.rows_run
+    drug_row_offset, drug_max_id = config["id_ranges"].offset_and_max_id("drug_exposure", "drug_exposure")
 
     #### DRUG EXPOSURE ####
     def drug_exposure_router_obj(input_dict):
@@ -799,17 +1356,23 @@ def main(input_csv_directory, output_csv_directory, json_map_directory):
         else:
             return NoOutputClass()
 
-    input_med_csv = os.path.join(input_csv_directory, "source_medication.csv")
-    output_drug_exposure_csv = os.path.join(output_csv_directory, "drug_exposure_cdm.csv")
+    drug_exposure_router_obj.input_fields = ["s_person_id", "i_exclude", "s_start_medication_datetime"]
+
+    input_med_csv = os.path.join(config["input_csv_directory"], "source_medication.csv")
+    output_drug_exposure_csv = os.path.join(config["output_csv_directory"], "drug_exposure_cdm.csv")
 
     medication_rules = create_medication_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper,
-                                               snomed_mapper, snomed_code_mapper, drug_row_offset)
+                                               snomed_mapper, snomed_code_mapper, drug_row_offset, drug_max_id)
 
     drug_exposure_runner_obj = generate_mapper_obj(input_med_csv, SourceMedicationObject(), output_drug_exposure_csv,
                                                    DrugExposureObject(),
                                                    medication_rules, output_class_obj, in_out_map_obj,
-                                                   drug_exposure_router_obj, post_map_func=procedure_post_processing)
-    drug_exposure_runner_obj.run()
+                                                   drug_exposure_router_obj, post_map_func=procedure_post_processing,
+                                                   mapping_context=mapping_context,
+                                                   project_input_fields=config["project_input_fields"])
+    run_stage_mapper(drug_exposure_runner_obj, config, "drug_exposure", parallel=True)
+
+    return {"drug_exposure_cdm.csv": output_drug_exposure_csv}
 
 
 #### RULES ####
@@ -819,7 +1382,7 @@ def create_person_rules(json_map_directory, k_location_mapper, person_id_json_fi
 
     gender_json = os.path.join(json_map_directory, "concept_name_Gender.json")
     gender_json_mapper = CoderMapperJSONClass(gender_json)
-    upper_case_mapper = TransformMapper(lambda x: x.upper())
+    upper_case_mapper = TransformMapper(lambda x: x.upper(), pure=True)
     gender_mapper = CascadeMapper(ChainMapper(upper_case_mapper,
                                               SingleMatchAddValueMapper(("m_gender", "M"), ("m_gender", "MALE")),
                                               SingleMatchAddValueMapper(("m_gender", "F"), ("m_gender", "FEMALE")),
@@ -960,7 +1523,8 @@ def create_death_person_rules(json_map_directory, s_person_id_mapper):
     return death_rules
 
 
-def create_observation_period_rules(json_map_directory, s_person_id_mapper):
+def create_observation_period_rules(json_map_directory, s_person_id_mapper, observation_period_id_start=0,
+                                    observation_period_max_id=None):
     """Generate observation rules"""
     observation_period_mapper = CoderMapperJSONClass(
         os.path.join(json_map_directory, "concept_name_Obs_Period_Type.json"))
@@ -968,7 +1532,9 @@ def create_observation_period_rules(json_map_directory, s_person_id_mapper):
         ConstantMapper({"observation_period_type_name": "Period covering healthcare encounters"}),
         observation_period_mapper)
 
-    observation_period_rules = [(":row_id", "observation_period_id"),
+    observation_period_rules = [(":row_id", row_map_offset("observation_period_id", observation_period_id_start,
+                                                               observation_period_max_id),
+                                 {"observation_period_id": "observation_period_id"}),
                                 ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                                 ("s_start_observation_datetime", SplitDateTimeWithTZ(),
                                  {"date": "observation_period_start_date"}),
@@ -983,10 +1549,11 @@ def create_observation_period_rules(json_map_directory, s_person_id_mapper):
     return observation_period_rules
 
 
-def create_payer_plan_period_rules(s_person_id_mapper):
+def create_payer_plan_period_rules(s_person_id_mapper, payer_plan_period_id_start=0, payer_plan_period_max_id=None):
 
     payer_plan_period_rules = [
-        (":row_id", "payer_plan_period_id"),
+        (":row_id", row_map_offset("payer_plan_period_id", payer_plan_period_id_start, payer_plan_period_max_id),
+         {"payer_plan_period_id": "payer_plan_period_id"}),
         ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
         ("s_start_payer_date", SplitDateTimeWithTZ(), {"date": "payer_plan_period_start_date"}),
         (("s_start_payer_date", "s_end_payer_date"), CascadeMapper(
@@ -1036,7 +1603,8 @@ def case_mapper_procedures(input_dict, field="m_procedure_code_oid"):
 
 
 
-def create_procedure_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, procedure_id_start):
+def create_procedure_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, procedure_id_start,
+                           procedure_max_id=None, mapping_context=None):
     # Maps the DXs linked by the claims
     # procedure
     # 2.16.840.1.113883.6.104 -- ICD9 Procedure Codes
@@ -1066,13 +1634,17 @@ def create_procedure_rules(json_map_directory, s_person_id_mapper, s_encounter_i
                                                    CodeMapperClassSqliteJSONClass(cpt_json, "s_procedure_code"),
                                                    CodeMapperClassSqliteJSONClass(hcpcs_json, "s_procedure_code"),
                                                    CodeMapperClassSqliteJSONClass(snomed_json, "s_procedure_code"),
-                                                  ), ConstantMapper({"CONCEPT_ID".lower(): 0, "MAPPED_CONCEPT_ID": 0}))
+                                                   pure=True), ConstantMapper({"CONCEPT_ID".lower(): 0, "MAPPED_CONCEPT_ID": 0}))
+
+    if mapping_context is not None:
+        ProcedureCodeMapper = mapping_context.memoize(ProcedureCodeMapper, ("s_procedure_code", "m_procedure_code_oid"))
 
     # Required: procedure_occurrence_id, person_id, procedure_concept_id, procedure_date, procedure_type_concept_id
     procedure_rules_encounter = [(("s_procedure_code", "m_procedure_code_oid"), ProcedureCodeMapper,
                                  {"CONCEPT_ID".lower(): "procedure_source_concept_id",
                                   "MAPPED_CONCEPT_ID".lower(): "procedure_concept_id"}),
-                                (":row_id", row_map_offset("procedure_occurrence_id", procedure_id_start),
+                                (":row_id", row_map_offset("procedure_occurrence_id", procedure_id_start,
+                                                           procedure_max_id),
                                   {"procedure_occurrence_id": "procedure_occurrence_id"}),
                                  ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                                  ("s_encounter_id", s_encounter_id_mapper,
@@ -1149,7 +1721,9 @@ def create_visit_rules(json_map_directory, s_person_id_mapper, k_care_site_mappe
     return visit_rules
 
 
-def create_measurement_and_observation_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, snomed_mapper, snomed_code_mapper):
+def create_measurement_and_observation_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, snomed_mapper, snomed_code_mapper,
+                                             measurement_id_start=0, measurement_max_id=None, observation_id_start=0,
+                                             observation_max_id=None):
     """Generate rules for mapping PH_F_Result to Measurement"""
 
     ucum_json = os.path.join(json_map_directory, "concept_code_UCUM.json")
@@ -1189,7 +1763,8 @@ def create_measurement_and_observation_rules(json_map_directory, s_person_id_map
 
     value_source_mapper = FilterHasKeyValueMapper(["s_result_numeric", "m_result_text", "s_result_datetime", "s_result_code"])
 
-    measurement_rules = [(":row_id", "measurement_id"),
+    measurement_rules = [(":row_id", row_map_offset("measurement_id", measurement_id_start, measurement_max_id),
+                          {"measurement_id": "measurement_id"}),
                          ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                          ("s_encounter_id", s_encounter_id_mapper, {"visit_occurrence_id": "visit_occurrence_id"}),
                          ("s_obtained_datetime", DateTimeWithTZ(), {"datetime": "measurement_datetime"}),
@@ -1214,7 +1789,9 @@ def create_measurement_and_observation_rules(json_map_directory, s_person_id_map
                          ("s_result_numeric_upper", FloatMapper(), "range_high")]
 
     # TODO: observation_type_concept_id <- "Observation recorded from EHR"
-    measurement_observation_rules = [(":row_id", "observation_id"),
+    measurement_observation_rules = [(":row_id", row_map_offset("observation_id", observation_id_start,
+                                                                observation_max_id),
+                                      {"observation_id": "observation_id"}),
                                      ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                                      ("s_encounter_id", s_encounter_id_mapper,
                                       {"visit_occurrence_id": "visit_occurrence_id"}),
@@ -1312,16 +1889,16 @@ def generate_rxcui_drug_code_mapper(json_map_directory):
                                                     CodeMapperClassSqliteJSONClass(multum_drug_json, "s_drug_code")),  # 1
                                                   CodeMapperClassSqliteJSONClass(multum_drug_mmdc_json, "s_drug_code"),  # 2
                                                   KeyTranslator({"s_drug_code": "RXNORM_ID"}),  # 3
-                                                  CodeMapperClassSqliteJSONClass(ndc_code_mapper_json, "s_drug_code")  # 4
-                                                  ))
+                                                  CodeMapperClassSqliteJSONClass(ndc_code_mapper_json, "s_drug_code"),  # 4
+                                                  pure=True))
     else:
 
         # Non MULTUM enabled mapper
 
         drug_code_mapper = ChainMapper(CaseMapper(case_mapper_drug_code,
                                                   KeyTranslator({"s_drug_code": "RXNORM_ID"}),  # 0
-                                                  CodeMapperClassSqliteJSONClass(ndc_code_mapper_json, "s_drug_code")  # 1
-                                                  ))
+                                                  CodeMapperClassSqliteJSONClass(ndc_code_mapper_json, "s_drug_code"),  # 1
+                                                  pure=True))
 
     return drug_code_mapper
 
@@ -1343,7 +1920,8 @@ def generate_drug_name_mapper(json_map_directory, drug_field_name="s_drug_text")
 
     rxnorm_name_mapper_chained = CascadeMapper(rxnorm_name_mapper,
                                                ChainMapper(
-                                                           TransformMapper(string_to_cap_first_letters), rxnorm_name_mapper))
+                                                           TransformMapper(string_to_cap_first_letters, pure=True),
+                                                           rxnorm_name_mapper))
 
     return rxnorm_name_mapper_chained
 
@@ -1352,7 +1930,8 @@ def generate_drug_name_alternative_mapper(json_map_directory):
     return generate_drug_name_mapper(json_map_directory, "s_drug_alternative_txt")
 
 
-def create_medication_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, snomed_mapper, snomed_code_mapper, row_offset):
+def create_medication_rules(json_map_directory, s_person_id_mapper, s_encounter_id_mapper, snomed_mapper,
+                            snomed_code_mapper, row_offset, max_id=None):
 
     # TODO: Increase mapping coverage of drugs - while likely need manual overrides
 
@@ -1515,7 +2094,7 @@ def create_medication_rules(json_map_directory, s_person_id_mapper, s_encounter_
                                CodeMapperDictClass(routes_to_concept_id_dict)))
 
     # Required # drug_exposure_id, person_id, drug_concept_id, drug_exposure_start_date, drug_type_concept_id
-    medication_rules = [(":row_id", row_map_offset("drug_exposure_id", row_offset),
+    medication_rules = [(":row_id", row_map_offset("drug_exposure_id", row_offset, max_id),
                                       {"drug_exposure_id": "drug_exposure_id"}),
                         ("s_person_id", s_person_id_mapper, {"person_id": "person_id"}),
                         ("s_encounter_id", s_encounter_id_mapper, {"visit_occurrence_id": "visit_occurrence_id"}),
@@ -1557,16 +2136,142 @@ def person_router_obj(input_dict):
             return NoOutputClass()
 
 
+person_router_obj.input_fields = ["i_exclude", "s_birth_datetime"]
+
+
+#### Stage Graph ####
+
+# JSON files in the json_map_directory which the stages look up in SQLite databases; files of the drug stage
+# which do not exist are skipped
+stage_sqlite_lookup_files = {
+    "visit": ["concept_code_SNOMED.json"],
+    "measurement": ["concept_code_SNOMED.json", "concept_name_SNOMED.json", "concept_code_UCUM.json",
+                    "LOINC_with_parent.json"],
+    "condition": ["concept_code_SNOMED.json", "ICD9CM_with_parent.json", "ICD10CM_with_parent.json"],
+    "procedure": ["concept_code_SNOMED.json", "ICD9Proc_with_parent.json", "ICD10PCS_with_parent.json",
+                  "CPT4_with_parent.json", "HCPCS_with_parent.json"],
+    "drug_exposure": ["concept_code_SNOMED.json", "concept_name_SNOMED.json", "rxnorm_multum.csv.MULDRUG_ID.json",
+                      "RxNorm_MMSL_GN.json", "rxnorm_multum_drug.csv.MULDRUG_ID.json",
+                      "rxnorm_multum_mmdc.csv.MULDRUG_ID.json", "NDC_with_parent.json", "concept_name_RxNorm.json",
+                      "RxNorm_with_parent.json", "select_n_in__ot___from___select_bn_rxcui.csv.bn_rxcui.json",
+                      "select_tt_n_sbdf__ott___from___select_bn.csv.bn_rxcui.json",
+                      "select_n_in__ot___from___select_bn_rxcui.csv.bn_str.json",
+                      "select_tt_n_sbdf__ott___from___select_bn.csv.bn_str.json", "concept_id_RxNorm.json"]
+}
+
+
+def sqlite_lookup_files(config, stage_name):
+    return [os.path.join(config["json_map_directory"], json_file_name)
+            for json_file_name in stage_sqlite_lookup_files.get(stage_name, [])]
+
+
+# Stages are listed in the order they run with a single worker. The result, condition, procedure and medication
+# stages write to the same tables in ID ranges allocated before the run, so they only depend on the id maps.
+mapping_stage_graph = MappingStageGraph([
+    MappingStage("location", location_stage, ["source_location.csv"],
+                 ["location_cdm.csv", "location_id_map", "location_cdm.csv.json"]),
+    MappingStage("person", person_stage, ["source_person.csv", "location_id_map"],
+                 ["person_cdm.csv", "person_id_map", "person_cdm.csv.json"]),
+    MappingStage("death", death_stage, ["source_person.csv", "person_id_map"], ["death_cdm.csv"]),
+    MappingStage("observation_period", observation_period_stage, ["source_observation_period.csv", "person_id_map"],
+                 ["observation_period_cdm.csv"]),
+    MappingStage("care_site", care_site_stage, ["source_care_site.csv"],
+                 ["care_site_cdm.csv", "care_site_id_map", "care_site_cdm.csv.json"]),
+    MappingStage("visit", visit_stage, ["source_encounter.csv", "person_id_map", "care_site_id_map"],
+                 ["visit_occurrence_cdm.csv", "visit_occurrence_id_map", "visit_occurrence_cdm.csv.json"]),
+    MappingStage("visit_detail", visit_detail_stage,
+                 ["source_encounter_detail.csv", "person_id_map", "care_site_id_map", "visit_occurrence_id_map"],
+                 ["visit_detail_cdm.csv"]),
+    MappingStage("payer_plan_period", payer_plan_period_stage, ["source_encounter_coverage.csv", "person_id_map"],
+                 ["payer_plan_period_cdm.csv"]),
+    MappingStage("measurement", measurement_stage,
+                 ["source_result.csv", "person_id_map", "visit_occurrence_id_map"],
+                 ["measurement_encounter_cdm.csv", "observation_measurement_encounter_cdm.csv"]),
+    MappingStage("condition", condition_stage,
+                 ["source_condition.csv", "person_id_map", "visit_occurrence_id_map"],
+                 ["condition_occurrence_dx_cdm.csv", "measurement_dx_cdm.csv", "observation_dx_cdm.csv",
+                  "procedure_dx_cdm.csv"]),
+    MappingStage("procedure", procedure_stage,
+                 ["source_procedure.csv", "person_id_map", "visit_occurrence_id_map"],
+                 ["procedure_cdm.csv", "measurement_proc_cdm.csv", "observation_proc_cdm.csv",
+                  "drug_exposure_proc_cdm.csv", "device_exposure_proc_cdm.csv"]),
+    MappingStage("drug_exposure", drug_exposure_stage,
+                 ["source_medication.csv", "person_id_map", "visit_occurrence_id_map"],
+                 ["drug_exposure_cdm.csv"])
+], lookup_files=sqlite_lookup_files)
+
 
 if __name__ == "__main__":
 
     arg_parse_obj = argparse.ArgumentParser(description="Transform prepared source to an OHDSI mapped CSV files")
     arg_parse_obj.add_argument("-c", "--config-file-name", dest="config_file_name", help="JSON config file", default="rw_config.json")
+    arg_parse_obj.add_argument("-n", "--n-workers", dest="n_workers", type=int, default=1,
+                               help="Number of processes used to map the result, condition, procedure and medication files")
+    arg_parse_obj.add_argument("--max-workers", dest="max_workers", type=int, default=1,
+                               help="Number of processes running stages which do not depend on each other")
+    arg_parse_obj.add_argument("--id-block-size", dest="id_block_size", type=int, default=None,
+                               help="IDs reserved for each stage writing to a shared table rather than its input rows")
+    arg_parse_obj.add_argument("--no-persist-id-maps", dest="persist_id_maps", action="store_false", default=True,
+                               help="Do not write the location, person, care site and visit id maps as JSON files")
+    arg_parse_obj.add_argument("--checkpoint-directory", dest="checkpoint_directory", default=None,
+                               help="Checkpoint completed stages in this directory and skip them when rerun")
+    arg_parse_obj.add_argument("--resume", dest="resume", action="store_true", default=False,
+                               help="Resume a stage which did not complete from its last committed rows")
+    arg_parse_obj.add_argument("--commit-rows", dest="commit_rows", type=int, default=100000,
+                               help="Rows mapped between commits of a stage run with --checkpoint-directory")
+    arg_parse_obj.add_argument("--previous-output-directory", dest="previous_output_csv_directory", default=None,
+                               help="Map only the changed persons against the CDM files of a previous full or delta run")
+    arg_parse_obj.add_argument("--changed-persons-file", dest="changed_persons_file_name", default=None,
+                               help="File with the s_person_id of each changed person for a delta run")
+    arg_parse_obj.add_argument("--previous-input-directory", dest="previous_input_csv_directory", default=None,
+                               help="Prepared source snapshot of the previous run which is diffed for a delta run")
+    arg_parse_obj.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=None,
+                               help="Map input files in blocks of rows")
+    arg_parse_obj.add_argument("--compile-rules", dest="compile_rules", action="store_true", default=False,
+                               help="Compile mapping rules into generated Python functions")
+    arg_parse_obj.add_argument("--memoize-rules", dest="memoize_rules", action="store_true", default=False,
+                               help="Cache the results of mappers which depend only on their input values")
+    arg_parse_obj.add_argument("--project-input-fields", dest="project_input_fields", action="store_true",
+                               default=False, help="Read only the fields of the input files which are used")
+    arg_parse_obj.add_argument("--pipeline", dest="pipeline", action="store_true", default=False,
+                               help="Read and write files in separate threads while mapping")
+    arg_parse_obj.add_argument("--profile-directory", dest="profile_directory", default=None,
+                               help="Profile the rules of each stage and write the reports to this directory")
+    arg_parse_obj.add_argument("--lookup-cache-size", dest="lookup_cache_size", type=int, default=250000,
+                               help="Maximum number of values cached by each vocabulary lookup")
+    arg_parse_obj.add_argument("--lookup-miss-cache-size", dest="lookup_miss_cache_size", type=int, default=250000,
+                               help="Maximum number of values not found which are cached by each vocabulary lookup")
+    arg_parse_obj.add_argument("--lookup-cache-mb", dest="lookup_cache_mb", type=int, default=None,
+                               help="Maximum size in MB of the values cached by each vocabulary lookup")
+    arg_parse_obj.add_argument("--prefetch-size", dest="prefetch_size", type=int, default=None,
+                               help="Prefetch vocabulary lookups for blocks of this many rows")
+    arg_parse_obj.add_argument("--warm-start-lookups", dest="warm_start_lookups", default=False, action="store_true",
+                               help="Start vocabulary lookup caches from the hot codes and misses of the last run")
+    arg_parse_obj.add_argument("--non-unique-key-policy", dest="non_unique_key_policy", default="first",
+                               choices=NonUniqueKeyResolver.policies,
+                               help="How vocabulary codes mapping to several concepts are resolved when lookups are built")
     arg_obj = arg_parse_obj.parse_args()
 
+    if arg_obj.lookup_cache_mb is not None:
+        lookup_cache_bytes = arg_obj.lookup_cache_mb * 1024 * 1024
+    else:
+        lookup_cache_bytes = None
+    set_lookup_cache_defaults(arg_obj.lookup_cache_size, arg_obj.lookup_miss_cache_size, lookup_cache_bytes,
+                              arg_obj.warm_start_lookups)
+    set_non_unique_key_policy(arg_obj.non_unique_key_policy)
+
     print("Reading config file '%s'" % arg_obj.config_file_name)
     with open(arg_obj.config_file_name, "r") as f:
         config_dict = json.load(f)
 
-    main(config_dict["csv_input_directory"], config_dict["csv_output_directory"], config_dict["json_map_directory"])
+    main(config_dict["csv_input_directory"], config_dict["csv_output_directory"], config_dict["json_map_directory"],
+         n_workers=arg_obj.n_workers, batch_size=arg_obj.batch_size, compile_rules=arg_obj.compile_rules,
+         project_input_fields=arg_obj.project_input_fields, pipeline=arg_obj.pipeline,
+         profile_directory=arg_obj.profile_directory, prefetch_size=arg_obj.prefetch_size,
+         memoize_rules=arg_obj.memoize_rules, max_workers=arg_obj.max_workers,
+         id_block_size=arg_obj.id_block_size, persist_id_maps=arg_obj.persist_id_maps,
+         checkpoint_directory=arg_obj.checkpoint_directory, resume=arg_obj.resume, commit_rows=arg_obj.commit_rows,
+         previous_output_csv_directory=arg_obj.previous_output_csv_directory,
+         changed_persons_file_name=arg_obj.changed_persons_file_name,
+         previous_input_csv_directory=arg_obj.previous_input_csv_directory)
 
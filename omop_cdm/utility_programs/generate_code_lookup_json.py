@@ -8,6 +8,13 @@ import json
 import os
 import argparse
 import sys
+import time
+
+try:
+    from mapping_classes import artifact_rebuild_reason, write_artifact_manifest, estimate_rebuild_seconds
+except(ImportError):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], os.path.pardir, os.path.pardir, "src")))
+    from mapping_classes import artifact_rebuild_reason, write_artifact_manifest, estimate_rebuild_seconds
 
 
 def open_csv_file(file_name, mode="r"):
@@ -19,11 +26,60 @@ def open_csv_file(file_name, mode="r"):
         return open(file_name, newline="", mode=mode, encoding="utf8")
 
 
-def main(source_vocabulary_directory, output_json_directory=None, delimiter="\t"):
-    """Build files for needed vocabulary"""
+def artifact_is_stale(artifact_file_name, source_file_names, stale_artifacts):
+    """Add an artifact to stale_artifacts when it is not current with its sources or one of its sources is
+    itself rebuilt"""
+    rebuilt_file_names = [x[0] for x in stale_artifacts]
+    rebuilt_source_file_names = [x for x in source_file_names if x in rebuilt_file_names]
+    if len(rebuilt_source_file_names):
+        rebuild_reason = "source '%s' is rebuilt" % rebuilt_source_file_names[0]
+    else:
+        rebuild_reason = artifact_rebuild_reason(artifact_file_name, source_file_names)
+
+    if rebuild_reason is None:
+        return False
+    else:
+        stale_artifacts += [(artifact_file_name, source_file_names, rebuild_reason)]
+        return True
+
+
+def build_artifact(artifact_file_name, source_file_names, build_function, *args):
+    """Call build_function(*args) and write the manifest of the artifact it builds"""
+    start_time = time.time()
+    build_function(*args)
+    write_artifact_manifest(artifact_file_name, source_file_names, time.time() - start_time)
+
+
+def print_rebuild_report(stale_artifacts):
+    """Print the artifacts which would be rebuilt with an estimate of the cost"""
+    total_seconds = 0.0
+    n_without_estimate = 0
+    for artifact_file_name, source_file_names, rebuild_reason in stale_artifacts:
+        source_size = sum([os.path.getsize(x) for x in source_file_names if os.path.exists(x)])
+        estimated_seconds = estimate_rebuild_seconds(artifact_file_name, source_file_names)
+        if estimated_seconds is None:
+            n_without_estimate += 1
+            estimate_text = "no previous build time"
+        else:
+            total_seconds += estimated_seconds
+            estimate_text = "about %.1f seconds" % estimated_seconds
+
+        print("Would rebuild '%s': %s (reads %.1f MB, %s)" % (artifact_file_name, rebuild_reason,
+                                                            source_size / 1048576.0, estimate_text))
+
+    print("%s artifacts would be rebuilt taking about %.1f seconds" % (len(stale_artifacts), total_seconds))
+    if n_without_estimate:
+        print("%s artifacts have no previous build time to estimate from" % n_without_estimate)
+
+
+def main(source_vocabulary_directory, output_json_directory=None, delimiter="\t", check=False):
+    """Build files for needed vocabulary. Files are only rebuilt when their manifest shows that the files they
+    were derived from have changed. With check the files which would be rebuilt are reported and returned."""
     if output_json_directory is None:
         output_json_directory = source_vocabulary_directory
 
+    stale_artifacts = []
+
     concept_csv = os.path.join(source_vocabulary_directory, "CONCEPT.csv")
     vocabularies = []
 
@@ -51,101 +107,141 @@ def main(source_vocabulary_directory, output_json_directory=None, delimiter="\t"
             for field_to_key_on in fields_to_key_on:
                 file_vocabulary_name = field_to_key_on + "_" + vocabulary_name + ".json"
                 path_vocabulary_name = os.path.join(output_json_directory, file_vocabulary_name)
-                if not os.path.exists(path_vocabulary_name):
+                if artifact_is_stale(path_vocabulary_name, [concept_csv], stale_artifacts) and not check:
                     print("Generating '%s'" % file_vocabulary_name)
-                    csv_file_name_to_keyed_json(concept_csv, path_vocabulary_name, field_to_key_on,
-                                                [("VOCABULARY_ID".lower(), vocabulary), ("INVALID_REASON".lower(), "")])
+                    build_artifact(path_vocabulary_name, [concept_csv], csv_file_name_to_keyed_json, concept_csv,
+                                   path_vocabulary_name, field_to_key_on,
+                                   [("VOCABULARY_ID".lower(), vocabulary), ("INVALID_REASON".lower(), "")])
 
     concept_relationship_csv = os.path.join(source_vocabulary_directory, "CONCEPT_RELATIONSHIP.csv")
     concept_relationship_json = os.path.join(output_json_directory, "concept_relationship.json")
     # Build a master dict
-    if not(os.path.exists(concept_relationship_json)):
+    if artifact_is_stale(concept_relationship_json, [concept_relationship_csv], stale_artifacts) and not check:
         print("Generating '%s'" % concept_relationship_json)
-        csv_file_name_to_keyed_json(concept_relationship_csv, concept_relationship_json, "CONCEPT_ID_1".lower(),
-                                    ("RELATIONSHIP_ID".lower(), "Maps to"))
-
-    with open_csv_file(concept_csv, "r") as f:
-        dict_reader = csv.DictReader(f, delimiter=delimiter)
-        concept_dict_vocabulary = {}
-        for row_dict in dict_reader:
-            concept_dict_vocabulary[row_dict["CONCEPT_ID".lower()]] = row_dict["VOCABULARY_ID".lower()]
-
-        global_concept_json = os.path.join(output_json_directory, "global_concept_vocabulary.json")
-        print("Generating '%s'" % global_concept_json)
-        with open(global_concept_json, "w") as fw:
-            json.dump(concept_dict_vocabulary, fw, sort_keys=True, indent=4, separators=(',', ': '))
-
-    with open_csv_file(concept_csv) as f:
-        dict_reader = csv.DictReader(f, delimiter=delimiter)
-        concept_dict_domain = {}
-        for row_dict in dict_reader:
-            concept_dict_domain[row_dict["CONCEPT_ID".lower()]] = row_dict["DOMAIN_ID".lower()]
-
-        global_concept_domain_json = os.path.join(output_json_directory, "global_concept_domain.json")
-        print("Generating '%s'" % global_concept_json)
-        with open(global_concept_domain_json, "w") as fw:
-            json.dump(concept_dict_vocabulary, fw, sort_keys=True, indent=4, separators=(',', ': '))
+        build_artifact(concept_relationship_json, [concept_relationship_csv], csv_file_name_to_keyed_json,
+                       concept_relationship_csv, concept_relationship_json, "CONCEPT_ID_1".lower(),
+                       ("RELATIONSHIP_ID".lower(), "Maps to"))
 
+    global_concept_json = os.path.join(output_json_directory, "global_concept_vocabulary.json")
+    global_concept_domain_json = os.path.join(output_json_directory, "global_concept_domain.json")
     vocabularies_with_maps = ["ICD9CM", "ICD9Proc", "ICD10CM", "ICD10PCS", "Multum", "LOINC", "CPT4", "HCPCS", "NDC",
                               "RxNorm"]
 
+    global_concept_is_stale = artifact_is_stale(global_concept_json, [concept_csv], stale_artifacts)
+    global_concept_domain_is_stale = artifact_is_stale(global_concept_domain_json, [concept_csv], stale_artifacts)
+    vocabularies_to_annotate = []
     for vocabulary_id in vocabularies_with_maps:
+        vocabulary_json = os.path.join(output_json_directory, "concept_code_" + vocabulary_id + ".json")
+        concept_with_parent_json = os.path.join(output_json_directory, vocabulary_id + "_with_parent.json")
+        if artifact_is_stale(concept_with_parent_json, [vocabulary_json, concept_relationship_json, concept_csv],
+                             stale_artifacts):
+            vocabularies_to_annotate += [vocabulary_id]
+
+    if check:
+        # SQLite and sorted key lookup files are rebuilt by the mapper the next time they are used
+        for artifact_file_name, source_file_names, rebuild_reason in list(stale_artifacts):
+            for derived_file_name in [artifact_file_name + ".db3", artifact_file_name + ".skl"]:
+                if os.path.exists(derived_file_name):
+                    artifact_is_stale(derived_file_name, [artifact_file_name], stale_artifacts)
+
+        print_rebuild_report(stale_artifacts)
+        return stale_artifacts
+
+    # The concept file is only read again when a global file is stale or the annotation needs the dicts
+    concept_dict_vocabulary = None
+    if global_concept_is_stale or len(vocabularies_to_annotate):
+        start_time = time.time()
+        concept_dict_vocabulary = read_concept_field_dict(concept_csv, "VOCABULARY_ID".lower(), delimiter)
+
+        if global_concept_is_stale:
+            print("Generating '%s'" % global_concept_json)
+            with open(global_concept_json, "w") as fw:
+                json.dump(concept_dict_vocabulary, fw, sort_keys=True, indent=4, separators=(',', ': '))
+            write_artifact_manifest(global_concept_json, [concept_csv], time.time() - start_time)
+
+    concept_dict_domain = None
+    if global_concept_domain_is_stale or len(vocabularies_to_annotate):
+        start_time = time.time()
+        concept_dict_domain = read_concept_field_dict(concept_csv, "DOMAIN_ID".lower(), delimiter)
+
+        if global_concept_domain_is_stale:
+            print("Generating '%s'" % global_concept_domain_json)
+            with open(global_concept_domain_json, "w") as fw:
+                json.dump(concept_dict_domain, fw, sort_keys=True, indent=4, separators=(',', ': '))
+            write_artifact_manifest(global_concept_domain_json, [concept_csv], time.time() - start_time)
+
+    for vocabulary_id in vocabularies_to_annotate:
         print("Annotating '%s'" % vocabulary_id)
         vocabulary_json = os.path.join(output_json_directory, "concept_code_" + vocabulary_id + ".json")
 
         concept_with_parent_json = os.path.join(output_json_directory, vocabulary_id + "_with_parent.json")
 
-        if not os.path.exists(concept_with_parent_json):
-            with open(vocabulary_json, "r") as fj:
-                vocabulary_dict = json.load(fj)
-
-            with open(concept_relationship_json, "r") as fj:
-                concept_rel_dict = json.load(fj)
-
-            for concept_code in vocabulary_dict:
-                concept_dict = vocabulary_dict[concept_code]
-                concept_id = concept_dict["CONCEPT_ID".lower()]
-                if concept_id in concept_rel_dict:
-                    try:
-                        mapped_concept_id = concept_rel_dict[concept_id]["CONCEPT_ID_2".lower()]
-                    except TypeError:
-
-                        # Filter out OMOP Extension
-                        # If only OMOP Extension then include
-
-                        multiple_concepts = concept_rel_dict[concept_id]
-                        omop_extensions = []
-                        everything_else = []
-                        for concept_rel in multiple_concepts:
-                            concept_id = concept_rel["concept_id_2"]
-                            vocabulary = concept_dict_vocabulary[concept_id]
-                            if vocabulary == "OMOP Extension":
-                                omop_extensions += [concept_rel]
-                            else:
-                                everything_else += [concept_rel]
-
-                        omop_extensions.sort(key=lambda x: x["VALID_END_DATE".lower()], reverse=True)
-                        everything_else.sort(key=lambda x: x["VALID_END_DATE".lower()], reverse=True)
-
-                        sorted_multiple_concepts = everything_else + omop_extensions
-                        mapped_concept_id = sorted_multiple_concepts[0]["CONCEPT_ID_2".lower()]
-
-                    concept_dict["MAPPED_CONCEPT_ID".lower()] = mapped_concept_id
-                    if mapped_concept_id in concept_dict_vocabulary:
-                        concept_dict["MAPPED_CONCEPT_VOCAB".lower()] = concept_dict_vocabulary[mapped_concept_id]
-                    else:
-                        concept_dict["MAPPED_CONCEPT_VOCAB".lower()] = None
-
-                    if mapped_concept_id in concept_dict_domain:
-                        concept_dict["MAPPED_CONCEPT_DOMAIN".lower()] = concept_dict_domain[mapped_concept_id]
-                    else:
-                        concept_dict["MAPPED_CONCEPT_DOMAIN".lower()] = None
+        concept_with_parent_sources = [vocabulary_json, concept_relationship_json, concept_csv]
+        start_time = time.time()
+        with open(vocabulary_json, "r") as fj:
+            vocabulary_dict = json.load(fj)
+
+        with open(concept_relationship_json, "r") as fj:
+            concept_rel_dict = json.load(fj)
+
+        for concept_code in vocabulary_dict:
+            concept_dict = vocabulary_dict[concept_code]
+            concept_id = concept_dict["CONCEPT_ID".lower()]
+            if concept_id in concept_rel_dict:
+                try:
+                    mapped_concept_id = concept_rel_dict[concept_id]["CONCEPT_ID_2".lower()]
+                except TypeError:
+
+                    # Filter out OMOP Extension
+                    # If only OMOP Extension then include
+
+                    multiple_concepts = concept_rel_dict[concept_id]
+                    omop_extensions = []
+                    everything_else = []
+                    for concept_rel in multiple_concepts:
+                        concept_id = concept_rel["concept_id_2"]
+                        vocabulary = concept_dict_vocabulary[concept_id]
+                        if vocabulary == "OMOP Extension":
+                            omop_extensions += [concept_rel]
+                        else:
+                            everything_else += [concept_rel]
+
+                    omop_extensions.sort(key=lambda x: x["VALID_END_DATE".lower()], reverse=True)
+                    everything_else.sort(key=lambda x: x["VALID_END_DATE".lower()], reverse=True)
+
+                    sorted_multiple_concepts = everything_else + omop_extensions
+                    mapped_concept_id = sorted_multiple_concepts[0]["CONCEPT_ID_2".lower()]
+
+                concept_dict["MAPPED_CONCEPT_ID".lower()] = mapped_concept_id
+                if mapped_concept_id in concept_dict_vocabulary:
+                    concept_dict["MAPPED_CONCEPT_VOCAB".lower()] = concept_dict_vocabulary[mapped_concept_id]
+                else:
+                    concept_dict["MAPPED_CONCEPT_VOCAB".lower()] = None
 
+                if mapped_concept_id in concept_dict_domain:
+                    concept_dict["MAPPED_CONCEPT_DOMAIN".lower()] = concept_dict_domain[mapped_concept_id]
                 else:
-                    concept_dict["MAPPED_CONCEPT_ID".lower()] = None
+                    concept_dict["MAPPED_CONCEPT_DOMAIN".lower()] = None
+
+            else:
+                concept_dict["MAPPED_CONCEPT_ID".lower()] = None
+
+        with open(concept_with_parent_json, "w") as fw:
+            json.dump(vocabulary_dict, fw, sort_keys=True, indent=4, separators=(',', ': '))
+        write_artifact_manifest(concept_with_parent_json, concept_with_parent_sources, time.time() - start_time)
+
+    return stale_artifacts
+
+
+def read_concept_field_dict(concept_csv, field_name, delimiter="\t"):
+    """Read a dict from concept_id to the value of a field of the concept file"""
+    with open_csv_file(concept_csv, "r") as f:
+        dict_reader = csv.DictReader(f, delimiter=delimiter)
+        concept_field_dict = {}
+        for row_dict in dict_reader:
+            concept_field_dict[row_dict["CONCEPT_ID".lower()]] = row_dict[field_name]
 
-            with open(concept_with_parent_json, "w") as fw:
-                json.dump(vocabulary_dict, fw, sort_keys=True, indent=4, separators=(',', ': '))
+    return concept_field_dict
 
 
 def csv_file_name_to_keyed_json(csv_file_name, json_file_name, field_to_key_on, filter_pairs=None, delimiter="\t"):
@@ -196,10 +292,12 @@ if __name__ == "__main__":
 
     arg_parse_obj.add_argument("-c", "--config-file-name", dest="config_file_name", help="JSON config file",
                                default="cdm_config.json")
+    arg_parse_obj.add_argument("--check", dest="check", default=False, action="store_true",
+                               help="Report the files which would be rebuilt and an estimate of the time it takes")
     arg_obj = arg_parse_obj.parse_args()
 
     print("Reading config file '%s'" % arg_obj.config_file_name)
     with open(arg_obj.config_file_name, "r") as fc:
         config_dict = json.load(fc)
 
-    main(config_dict["json_map_directory"])
\ No newline at end of file
+    main(config_dict["json_map_directory"], check=arg_obj.check)
\ No newline at end of file
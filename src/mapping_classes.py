@@ -7,10 +7,33 @@ import csv
 import logging
 from timeit import default_timer as timer
 import os
-import sqlalchemy as sa
+import shutil
+import glob
+import copy
+import multiprocessing
+import weakref
+import linecache
+import collections.abc
+import operator
+import threading
+import queue
+import sqlite3
+import urllib.parse
+import mmap
+import struct
+import array
 import sys
-
-import csv
+import hashlib
+import bisect
+import heapq
+import pickle
+import atexit
+import concurrent.futures
+
+try:
+    import fcntl
+except ImportError:  # Builds of an artifact are not serialised across processes without fcntl
+    fcntl = None
 
 class CaseInsensitiveDictReader(csv.DictReader):
     def __init__(self, *args, **kwargs):
@@ -51,8 +74,10 @@ class InputClassRealization(object):
 
 
 class InputClassCSVRealization(InputClassRealization):
-    """Class for representing a CSV source to be read from"""
-    def __init__(self, csv_file_name, input_class_obj):
+    """Class for representing a CSV source to be read from. A realization can be restricted to a byte range of the
+    file (start_offset, end_offset) which must fall on line boundaries; start_row_id is the ':row_id' of the
+    first row read."""
+    def __init__(self, csv_file_name, input_class_obj, start_offset=None, end_offset=None, start_row_id=1):
         self.csv_file_name = csv_file_name
         self.force_ascii = True
         self.input_class = input_class_obj
@@ -62,14 +87,45 @@ class InputClassCSVRealization(InputClassRealization):
         else:
             self.input_class_has_fields = False
 
-        if self.force_ascii and sys.version_info[0] == 2:
-            f = open(csv_file_name, 'rb')
-        else:
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        self.projection = None
 
-            f = open(csv_file_name, newline='', encoding="utf-8")
-        self.csv_dict = CaseInsensitiveDictReader(f)
+        self.f = open(csv_file_name, "rb")
+        header_line = self.f.readline()
+        self.header_offset = len(header_line)
+        self.position = self.header_offset
 
-        self.i = 1
+        if start_offset is not None and start_offset > self.header_offset:
+            self.f.seek(start_offset)
+            self.position = start_offset
+
+        field_names = next(csv.reader([header_line.decode("utf-8")]))
+        self.csv_dict = self._reader(field_names)
+
+        self.i = start_row_id
+
+    def _reader(self, field_names):
+        return CaseInsensitiveDictReader(self._line_iterator(), fieldnames=field_names)
+
+    def _line_iterator(self):
+        """Yield decoded lines keeping track of the byte position in the file"""
+        for line in self.f:
+            if self.end_offset is not None and self.position >= self.end_offset:
+                break
+            self.position += len(line)
+            yield line.decode("utf-8")
+
+    def shard(self, start_offset, end_offset, start_row_id):
+        """Return a realization of the same file restricted to a byte range"""
+        realization_obj = self.__class__(self.csv_file_name, self.input_class, start_offset, end_offset, start_row_id)
+        if self.projection is not None:
+            realization_obj.project(self.projection)
+        return realization_obj
+
+    def project(self, fields):
+        """Restrict the fields of each row to fields. Returns False if the realization does not support it."""
+        return False
 
     def __next__(self):
         row_dict = self.csv_dict.__next__()
@@ -85,42 +141,312 @@ class InputClassCSVRealization(InputClassRealization):
         return row_dict
 
     def next(self):
+        return self.__next__()
+
+    def __iter__(self):
+        return self
+
+
+_missing_value = object()
+_not_cached = object()
+
 
-        if sys.version_info[0] == 2:
-            row_dict = self.csv_dict.next()
+class CSVRowRecord(collections.abc.MutableMapping):
+    """Mapping view of a CSV row. Values are held in a list and looked up through a field index which is shared by
+    every row read from the same file. Keys which are not in the index are held in a separate dict."""
+
+    __slots__ = ("_values", "_field_index", "_extra")
+
+    def __init__(self, values, field_index):
+        self._values = values
+        self._field_index = field_index
+        self._extra = None
+
+    def __getitem__(self, key):
+        if key in self._field_index:
+            value = self._values[self._field_index[key]]
+            if value is not _missing_value:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in self._field_index:
+            return self._values[self._field_index[key]] is not _missing_value
+        elif self._extra is not None:
+            return key in self._extra
         else:
-            row_dict = self.csv_dict.__next__()
+            return False
+
+    def __setitem__(self, key, value):
+        if key in self._field_index:
+            self._values[self._field_index[key]] = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self:
+            if key in self._field_index:
+                self._values[self._field_index[key]] = _missing_value
+            else:
+                del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        values = self._values
+        for key in self._field_index:
+            if values[self._field_index[key]] is not _missing_value:
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        n_keys = len(self._field_index)
+        if _missing_value in self._values:  # Only a deleted field holds _missing_value
+            values = self._values
+            for i in self._field_index.values():
+                if values[i] is _missing_value:
+                    n_keys -= 1
+        if self._extra is not None:
+            n_keys += len(self._extra)
+        return n_keys
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
 
-        row_dict[":row_id"] = self.i
 
+class InputClassCSVTupleRealization(InputClassCSVRealization):
+    """Faster CSV source which yields CSVRowRecord objects in place of dicts. The header is lower cased and indexed
+    once and the defaults for fields of the input class missing from the header are computed once."""
+
+    def _reader(self, field_names):
+        field_names = [field_name.lower() for field_name in field_names]
+        self.n_fields = len(field_names)
+
+        field_index = {}
+        for i, field_name in enumerate(field_names):
+            field_index[field_name] = i
+
+        # A repeated column name keeps the position of its last occurrence as in csv.DictReader. After the CSV
+        # columns come ':row_id' and then the input class fields which are not in the header.
+        field_index[":row_id"] = self.n_fields
+
+        self.missing_defaults = []
         if self.input_class_has_fields:
-            fields = self.input_class.fields()
-            for field in fields:
-                if field not in row_dict:
-                    row_dict[field] = ""
+            for field in self.input_class.fields():
+                if field not in field_index:
+                    field_index[field] = self.n_fields + 1 + len(self.missing_defaults)
+                    self.missing_defaults += [""]
+
+        self.field_names = field_names
+        self.field_index = field_index
+        self.positions = None
+        return csv.reader(self._line_iterator())
+
+    def project(self, fields):
+        """Only keep the columns in fields in each row. Input class fields missing from the file and ':row_id'
+        are kept."""
+        positions = []
+        field_index = {}
+        for field_name in self.field_names:
+            if field_name in fields and field_name not in field_index:
+                field_index[field_name] = len(positions)
+                positions += [self.field_index[field_name]]
+
+        n_positions = len(positions)
+        field_index[":row_id"] = n_positions
+        for field in self.field_index:
+            if self.field_index[field] > self.n_fields:
+                field_index[field] = self.field_index[field] - self.n_fields + n_positions
+
+        self.projection = list(fields)
+        self.positions = positions
+        self.field_index = field_index
+
+        return True
+
+    def __next__(self):
+        values = self.csv_dict.__next__()
+        while not values:  # Skip blank lines like csv.DictReader
+            values = self.csv_dict.__next__()
+
+        n_values = len(values)
+        extra_values = None
+        if n_values < self.n_fields:
+            values += [None] * (self.n_fields - n_values)
+        elif n_values > self.n_fields:
+            extra_values = values[self.n_fields:]
+            del values[self.n_fields:]
+
+        if self.positions is not None:
+            values = [values[position] for position in self.positions]
+            extra_values = None
+
+        values.append(self.i)
+        if self.missing_defaults:
+            values.extend(self.missing_defaults)
+
+        row_record = CSVRowRecord(values, self.field_index)
+        if extra_values is not None:
+            row_record[None] = extra_values
 
         self.i += 1
-        return row_dict
+        return row_record
 
-    def __iter__(self):
-        return self
+
+def _count_csv_rows(csv_file_name, start_offset, end_offset):
+    """Count non-blank lines in a byte range of a file"""
+    n_rows = 0
+    with open(csv_file_name, "rb") as f:
+        f.seek(start_offset)
+        position = start_offset
+        for line in f:
+            if position >= end_offset:
+                break
+            position += len(line)
+            if len(line.rstrip(b"\r\n")):
+                n_rows += 1
+    return n_rows
+
+
+def compute_csv_shards(csv_file_name, n_shards):
+    """Split a CSV file into at most n_shards byte ranges which start and end on line boundaries. Returns a list of
+    (start_offset, end_offset) pairs which cover the rows after the header. Assumes that quoted fields do not
+    contain line breaks."""
+
+    file_size = os.path.getsize(csv_file_name)
+    with open(csv_file_name, "rb") as f:
+        header_offset = len(f.readline())
+
+        boundaries = [header_offset]
+        data_size = file_size - header_offset
+        if data_size <= 0:
+            return []
+
+        for k in range(1, n_shards):
+            target_offset = header_offset + (data_size * k) // n_shards
+            f.seek(target_offset - 1)
+            f.readline()  # Advance to the start of the next line
+            boundary = f.tell()
+            if boundaries[-1] < boundary < file_size:
+                boundaries += [boundary]
+
+    boundaries += [file_size]
+
+    return [(boundaries[k], boundaries[k + 1]) for k in range(len(boundaries) - 1) if boundaries[k] < boundaries[k + 1]]
+
+
+def count_csv_rows(csv_file_name):
+    """Count the rows after the header of a CSV file. Assumes that quoted fields do not contain line breaks."""
+    with open(csv_file_name, "rb") as f:
+        header_offset = len(f.readline())
+    return _count_csv_rows(csv_file_name, header_offset, os.path.getsize(csv_file_name))
+
+
+def read_csv_header(csv_file_name):
+    with open(csv_file_name, "rb") as f:
+        header_line = f.readline()
+    return next(csv.reader([header_line.decode("utf-8")]), [])
+
+
+def _keyed_csv_lines(csv_file_name, key_field_name):
+    """Yield (key, line) for each non-blank line after the header of a CSV file, where key is the value of
+    key_field_name in the line and line is the undecoded line. Assumes that quoted fields do not contain line
+    breaks."""
+    with open(csv_file_name, "rb") as f:
+        field_names = next(csv.reader([f.readline().decode("utf-8")]), [])
+        key_i = [field_name.lower() for field_name in field_names].index(key_field_name.lower())
+
+        lines = collections.deque()
+
+        def decoded_lines():
+            for line in f:
+                if len(line.rstrip(b"\r\n")):
+                    lines.append(line)
+                    yield line.decode("utf-8")
+
+        for row in csv.reader(decoded_lines()):
+            yield row[key_i], lines.popleft()
+
+
+def csv_key_digests(csv_file_name, key_field_name):
+    """Summarize the rows of a CSV file by their value of key_field_name. Returns {key: (n_rows, digest)} where
+    digest is the sum of the hashes of the rows so that it does not depend on the order of the rows."""
+    key_digests = {}
+    for key, line in _keyed_csv_lines(csv_file_name, key_field_name):
+        line_hash = int.from_bytes(hashlib.blake2b(line.rstrip(b"\r\n"), digest_size=8).digest(), "little")
+        n_rows, digest = key_digests.get(key, (0, 0))
+        key_digests[key] = (n_rows + 1, (digest + line_hash) & 0xFFFFFFFFFFFFFFFF)
+    return key_digests
+
+
+def changed_csv_keys(previous_csv_file_name, csv_file_name, key_field_name):
+    """Return the set of values of key_field_name whose rows differ between two versions of a CSV file, including
+    keys in only one of them. Every key is changed if the headers differ."""
+    previous_key_digests = csv_key_digests(previous_csv_file_name, key_field_name)
+    key_digests = csv_key_digests(csv_file_name, key_field_name)
+    keys = set(previous_key_digests) | set(key_digests)
+
+    if read_csv_header(previous_csv_file_name) != read_csv_header(csv_file_name):
+        return keys
+    else:
+        return set([key for key in keys if previous_key_digests.get(key) != key_digests.get(key)])
+
+
+def filter_csv_file(csv_file_name, filtered_csv_file_name, key_field_name, keys):
+    """Write the header and the lines of a CSV file whose value of key_field_name is in keys to
+    filtered_csv_file_name. Lines are copied unchanged. Returns the number of rows written."""
+    n_rows = 0
+    temp_file_name = filtered_csv_file_name + ".%s.tmp" % os.getpid()
+    try:
+        with open(temp_file_name, "wb") as fw:
+            with open(csv_file_name, "rb") as f:
+                fw.write(f.readline())
+            for key, line in _keyed_csv_lines(csv_file_name, key_field_name):
+                if key in keys:
+                    fw.write(line)
+                    n_rows += 1
+        os.replace(temp_file_name, filtered_csv_file_name)
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+    return n_rows
 
 
 class OutputClassRealization(object):
     """Super Class for an output source"""
-    pass
+
+    def flush(self):
+        pass
 
 
 class OutputClassCSVRealization(OutputClassRealization):
-    """Write output to CSV file"""
-    def __init__(self, csv_file_name, output_class_obj, field_list=None, force_ascii=True):
+    """Write output to CSV file. Rows are buffered and written with writerows every batch_size rows; write_time
+    is the time spent formatting and writing the buffered rows. With id_map_fields, a (source value field, id field)
+    pair, the id written for each source value is captured and returned by id_map."""
+    def __init__(self, csv_file_name, output_class_obj, field_list=None, force_ascii=True, batch_size=1000,
+                 buffer_size=1048576, id_map_fields=None):
 
+        self.csv_file_name = csv_file_name
         self.force_ascii = force_ascii
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
 
-        if self.force_ascii and sys.version_info[0] == 2:
-            self.fw = open(csv_file_name, "wb")
-        else:
-            self.fw = open(csv_file_name, "w", newline="", encoding="utf-8")
+        self.fw = open(csv_file_name, "w", newline="", encoding="utf-8", buffering=buffer_size)
 
         self.output_class = output_class_obj
         if field_list is None:
@@ -128,35 +454,194 @@ class OutputClassCSVRealization(OutputClassRealization):
         else:
             self.field_list = field_list
 
-        self.force_ascii = force_ascii
+        if len(self.field_list) == 1:
+            field = self.field_list[0]
+            self.row_getter = lambda row_dict: (row_dict[field],)
+        else:
+            self.row_getter = operator.itemgetter(*self.field_list)
 
         self.csv_writer = csv.writer(self.fw)
         self.csv_writer.writerow(self.field_list)
 
+        self.rows_to_write = []
+        self.write_time = 0.0
+
+        self.id_map_fields = id_map_fields
+        if id_map_fields is not None:
+            self.captured_ids = {}
+        else:
+            self.captured_ids = None
+
         self.i = 1
 
     def write(self, row_dict):
-        row_to_write = []
-        for field in self.field_list:
-            if field in row_dict:
-                value_to_write = row_dict[field]
-                if self.force_ascii and sys.version_info[0] == 2:
-                    if value_to_write.__class__ in (u"".__class__, "".__class__):
-                        value_to_write = value_to_write.decode("ascii", "ignore").encode("ascii")
-                row_to_write += [value_to_write]
-            else:
-                row_to_write += [""]
-        self.csv_writer.writerow(row_to_write)
+        try:
+            row_to_write = self.row_getter(row_dict)
+        except KeyError:  # Fields missing from row_dict are written as empty strings
+            row_to_write = [row_dict.get(field, "") for field in self.field_list]
+
+        if self.captured_ids is not None:
+            source_value_field, id_field = self.id_map_fields
+            self.captured_ids[csv_text(row_dict.get(source_value_field))] = row_dict.get(id_field)
+
+        self.rows_to_write.append(row_to_write)
+        if len(self.rows_to_write) >= self.batch_size:
+            self._write_rows()
+
         self.i += 1
 
+    def _write_rows(self):
+        start_time = timer()
+        self.csv_writer.writerows(self.rows_to_write)
+        self.rows_to_write = []
+        self.write_time += timer() - start_time
+
+    def shard(self, csv_file_name):
+        """Return a realization with the same fields which writes to a separate file"""
+        return self.__class__(csv_file_name, self.output_class, self.field_list, self.force_ascii, self.batch_size,
+                              self.buffer_size, self.id_map_fields)
+
+    def flush(self):
+        if len(self.rows_to_write):
+            self._write_rows()
+        self.fw.flush()
+
+    def append_csv_file(self, csv_file_name):
+        """Append the rows of a CSV file, written with the same fields, skipping its header"""
+        self.flush()
+        with open(csv_file_name, "r", newline="", encoding="utf-8") as f:
+            f.readline()
+            shutil.copyfileobj(f, self.fw)
+            self.fw.flush()
+
+        if self.captured_ids is not None:
+            source_value_index = self.field_list.index(self.id_map_fields[0])
+            id_index = self.field_list.index(self.id_map_fields[1])
+            with open(csv_file_name, "r", newline="", encoding="utf-8") as f:
+                csv_reader = csv.reader(f)
+                next(csv_reader)
+                for row in csv_reader:
+                    if len(row):
+                        self.captured_ids[row[source_value_index]] = row[id_index]
+
+    def id_map(self):
+        """Return the ids captured for the source values as a SourceValueIdMap"""
+        return SourceValueIdMap(self.id_map_fields[1], self.captured_ids)
+
     def close(self):
+        if not self.fw.closed:
+            self.flush()
         self.fw.close()
 
 
+def csv_text(value):
+    """The text csv.writer writes for a value"""
+    if value is None:
+        return ""
+    else:
+        return str(value)
+
+
+class SourceValueIdMap(object):
+    """A compact lookup of the ids generated for source values. The source values are held sorted in a list and
+    integer ids in an array. get returns {id_field_name: id} with the id as text, as a JSON map written from the
+    CDM file does. json_file_name is set when the map is persisted as a JSON map."""
+
+    def __init__(self, id_field_name, id_dict):
+        self.id_field_name = id_field_name
+        self.json_file_name = None
+        self.keys = sorted(id_dict.keys())
+        ids = [id_dict[key] for key in self.keys]
+        if len([value for value in ids if value.__class__ != int]):
+            self.ids = [csv_text(value) for value in ids]
+        else:
+            self.ids = array.array("q", ids)
+
+    def _index(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        else:
+            return None
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        if i is None:
+            return default
+        else:
+            return {self.id_field_name: str(self.ids[i])}
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i is None:
+            raise KeyError(key)
+        return {self.id_field_name: str(self.ids[i])}
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def items(self):
+        for key, value in zip(self.keys, self.ids):
+            yield key, {self.id_field_name: str(value)}
+
+
 class MapperClass(object):
     """A superclass that maps a {'key1': 'value1'} -> {'f1': f1(key1), 'f2': f2(key1)}"""
 
 
+def map_batch_by_row(mapper_obj, input_columns, n_rows):
+    """Apply map to each row of a block of rows given as {field: [value_1, ..., value_n]}"""
+    if len(input_columns):
+        fields = list(input_columns.keys())
+        return [mapper_obj.map(dict(zip(fields, values))) for values in zip(*input_columns.values())]
+    else:
+        return [mapper_obj.map({}) for k in range(n_rows)]
+
+
+def map_batch_by_distinct_values(mapper_obj, input_columns, n_rows):
+    """Apply map once for each distinct combination of input values in a block of rows. Only for mappers whose
+    result depends on the input values alone and which do not modify the input dict. Rows with the same input values
+    share the same result dict."""
+
+    if len(input_columns) == 0:
+        return [mapper_obj.map({})] * n_rows
+
+    mapped_values = {}
+    results = []
+    if len(input_columns) == 1:
+        field, column = list(input_columns.items())[0]
+        for value in column:
+            result = mapped_values.get(value)
+            if result is None:
+                result = mapper_obj.map({field: value})
+                mapped_values[value] = result
+            results += [result]
+    else:
+        fields = list(input_columns.keys())
+        for values in zip(*input_columns.values()):
+            result = mapped_values.get(values)
+            if result is None:
+                result = mapper_obj.map(dict(zip(fields, values)))
+                mapped_values[values] = result
+            results += [result]
+
+    return results
+
+
+def apply_map_batch(mapper_obj, input_columns, n_rows):
+    """Map a block of rows using the mapper's map_batch and falling back to mapping row by row"""
+    if hasattr(mapper_obj, "map_batch"):
+        return mapper_obj.map_batch(input_columns, n_rows)
+    else:
+        return map_batch_by_row(mapper_obj, input_columns, n_rows)
+
+
 class CodeMapperClass(MapperClass):
     """Maps a code to a single or multiple codes in output"""
     pass
@@ -201,14 +686,35 @@ class CodeMapperDictClass(CodeMapperClass):
         else:
             return {}
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
+
+lookup_files_opened = set()  # JSON lookup files opened by code mappers, recorded in stage checkpoints
+
 
 class CoderMapperJSONClass(CodeMapperClass):
-    """A code mapper that reads code from a JSON dict of dicts"""
+    """A code mapper that reads code from a JSON dict of dicts. If a current sorted key lookup file (json_file_name
+    + ".skl") exists it is memory mapped instead of loading the JSON, with the values looked up cached in an LRU
+    cache of lookup_cache_defaults["cache_size"] keys. Keys which map to a list are resolved when loaded with
+    non_unique_key_policy, see NonUniqueKeyResolver."""
 
-    def __init__(self, json_file_name, field_name=None):
+    def __init__(self, json_file_name, field_name=None, non_unique_key_policy=None):
         self.field_name = field_name
-        with open(json_file_name) as f:
-            self.mapper_dict = json.load(f)
+        lookup_files_opened.add(os.path.abspath(json_file_name))
+        if non_unique_key_policy is None:
+            non_unique_key_policy = lookup_build_defaults["non_unique_key_policy"]
+
+        skl_file_name = current_sorted_key_lookup_file_name(json_file_name, non_unique_key_policy)
+        if skl_file_name is not None:
+            self.mapper_dict = SortedKeyLookup(skl_file_name, lookup_cache_defaults["cache_size"])
+        else:
+            with open(json_file_name) as f:
+                self.mapper_dict = json.load(f)
+
+            non_unique_key_resolver = NonUniqueKeyResolver(non_unique_key_policy)
+            non_unique_key_resolver.resolve_dict(self.mapper_dict)
+            non_unique_key_resolver.log_summary(json_file_name)
 
     def map(self, input_dict):
 
@@ -223,11 +729,10 @@ class CoderMapperJSONClass(CodeMapperClass):
             else:
                 return {}
 
-            if value in self.mapper_dict:
-                mapped_dict_instance = self.mapper_dict[value]
-                if mapped_dict_instance.__class__ == [].__class__:
+            mapped_dict_instance = self.mapper_dict.get(value, _missing_value)
+            if mapped_dict_instance is not _missing_value:
+                if mapped_dict_instance.__class__ == [].__class__:  # Lookups written without resolving keys
                     mapped_dict_instance = mapped_dict_instance[0]
-                    logging.error("Map '%s' to non-unique value" % value)
 
                 return mapped_dict_instance
             else:
@@ -235,291 +740,1431 @@ class CoderMapperJSONClass(CodeMapperClass):
         else:
             return {}
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
 
-class CodeMapperClassSqliteJSONClass(CodeMapperClass):
-    """For large JSON files we build a SQLite database and cache in memory what we access"""
 
-    def __init__(self, json_file_name, field_name=None):
-        self.field_name = field_name
+class CoderMapperIdMapClass(CoderMapperJSONClass):
+    """A code mapper that reads codes from a SourceValueIdMap captured while a CDM file was written or, when id_map
+    is a file name, from the JSON map it was persisted as. The JSON map is loaded into a dict rather than memory
+    mapped, as the id of every row is looked up."""
 
-        self.db_file_name = json_file_name + ".db3"
-        self.json_file_name = json_file_name
+    def __init__(self, id_map, field_name=None):
+        self.field_name = field_name
+        if id_map.__class__ == str:
+            lookup_files_opened.add(os.path.abspath(id_map))
+            with open(id_map) as f:
+                self.mapper_dict = json.load(f)
+        else:
+            self.mapper_dict = id_map
+
+
+def iterate_json_object_items(json_file_name, chunk_size=1048576):
+    """Iterate over the (key, value JSON text) pairs of a file holding a single JSON object without loading the
+    whole file"""
+
+    json_decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+
+    with open(json_file_name, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        end_of_file = False
+
+        def read_more(buffer, position):
+            chunk = f.read(chunk_size)
+            return buffer[position:] + chunk, 0, len(chunk) == 0
+
+        def next_token(buffer, position, end_of_file):
+            """Skip whitespace and return the position of the next character"""
+            while True:
+                while position < len(buffer) and buffer[position] in whitespace:
+                    position += 1
+                if position < len(buffer) or end_of_file:
+                    return buffer, position, end_of_file
+                buffer, position, end_of_file = read_more(buffer, position)
+
+        def decode(buffer, position, end_of_file):
+            """Decode a JSON value. A value is only complete when followed by a separator as a number at the end of
+            the buffer may be cut off."""
+            while True:
+                try:
+                    value, end_position = json_decoder.raw_decode(buffer, position)
+                    separator_position = end_position
+                    while separator_position < len(buffer) and buffer[separator_position] in whitespace:
+                        separator_position += 1
+                    if end_of_file or buffer[separator_position:separator_position + 1] in (",", ":", "}"):
+                        return value, buffer, position, end_position, end_of_file
+                except ValueError:
+                    if end_of_file:
+                        raise
+                buffer, position, end_of_file = read_more(buffer, position)
+
+        buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+        if buffer[position:position + 1] != "{":
+            raise ValueError("'%s' does not contain a JSON object" % json_file_name)
+        position += 1
+
+        buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+        if buffer[position:position + 1] == "}":
+            return
+
+        while True:
+            buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+            key, buffer, key_position, position, end_of_file = decode(buffer, position, end_of_file)
+
+            buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+            if buffer[position:position + 1] != ":":
+                raise ValueError("Expected ':' after key '%s' in '%s'" % (key, json_file_name))
+            position += 1
+
+            buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+            value, buffer, start_position, position, end_of_file = decode(buffer, position, end_of_file)
+            yield key, buffer[start_position:position]
+
+            buffer, position, end_of_file = next_token(buffer, position, end_of_file)
+            separator = buffer[position:position + 1]
+            position += 1
+            if separator == "}":
+                return
+            elif separator != ",":
+                raise ValueError("Expected ',' or '}' after value of key '%s' in '%s'" % (key, json_file_name))
+
+
+class NonUniqueKeyResolver(object):
+    """Resolve the keys of a vocabulary which map to a list of entries to a single entry when a lookup is built.
+    The tie break policy is one of "first", "latest_valid_end_date" (ties keep the first) or
+    "non_omop_extension_first" (the first entry not in the OMOP Extension vocabulary). Resolved keys are counted
+    so they can be reported once instead of on each lookup."""
+
+    policies = ["first", "latest_valid_end_date", "non_omop_extension_first"]
+
+    def __init__(self, policy="first"):
+        if policy not in self.policies:
+            raise ValueError("Non-unique key policy '%s' is not one of %s" % (policy, self.policies))
+
+        self.policy = policy
+        self.n_non_unique_keys = 0
+
+    def _field_value(self, entry, field_name):
+        if entry.__class__ == {}.__class__:
+            if field_name in entry:
+                return entry[field_name]
+            else:
+                return entry.get(field_name.upper())
+        else:
+            return None
 
-        if os.path.exists(self.db_file_name):
-            self.connection, self.meta_data = self._create_connection()
+    def resolve(self, values):
+        """Select one of a list of entries"""
+        self.n_non_unique_keys += 1
+
+        if self.policy == "latest_valid_end_date":
+            valid_end_dates = [self._field_value(x, "valid_end_date") or "" for x in values]
+            return values[valid_end_dates.index(max(valid_end_dates))]
+        elif self.policy == "non_omop_extension_first":
+            for value in values:
+                if self._field_value(value, "vocabulary_id") != "OMOP Extension":
+                    return value
+            return values[0]
         else:
-            self.connection, self.meta_data = self._build_sqlite_db()
+            return values[0]
 
-        self.mapper_dict_cache = {}
-        self.missed_mapper_dict_cache = {} # hold values that are missed so we don't make multiple expensive lookups to file
+    def resolve_items(self, items):
+        """Resolve (key, value JSON text) pairs as they stream to a builder"""
+        for key, json_value_text in items:
+            if json_value_text[:1] == "[":
+                values = json.loads(json_value_text)
+                if len(values):
+                    json_value_text = json.dumps(self.resolve(values))
+            yield key, json_value_text
 
-    def _create_connection(self):
-        connection_string = "sqlite:///" + self.db_file_name
-        engine = sa.create_engine(connection_string)
-        connection = engine.connect()
-        meta_data = sa.MetaData(connection)
-        meta_data.reflect()
+    def resolve_dict(self, mapper_dict):
+        for key in mapper_dict:
+            values = mapper_dict[key]
+            if values.__class__ == [].__class__ and len(values):
+                mapper_dict[key] = self.resolve(values)
 
-        return connection, meta_data
+        return mapper_dict
 
-    def _build_sqlite_db(self):
+    def log_summary(self, file_name):
+        if self.n_non_unique_keys:
+            logging.info("Resolved %s non-unique keys in '%s' with policy '%s'" % (self.n_non_unique_keys, file_name,
+                                                                                  self.policy))
 
-        if os.path.exists(self.db_file_name):
-            os.remove(self.db_file_name)
 
-        connection,  meta_data = self._create_connection()
+# Tie break policy used to resolve non-unique keys when lookups are built; see NonUniqueKeyResolver
+lookup_build_defaults = {"non_unique_key_policy": "first"}
 
-        lookup_table = sa.Table("lookup_table", meta_data,
-                                sa.Column("key_string", sa.String(255), index=True, unique=True),
-                                sa.Column("json_value_text", sa.Text))
 
-        meta_data.create_all()
+def set_non_unique_key_policy(non_unique_key_policy):
+    """Set the default policy for resolving non-unique keys of the lookups built afterwards"""
+    NonUniqueKeyResolver(non_unique_key_policy)
+    lookup_build_defaults["non_unique_key_policy"] = non_unique_key_policy
 
-        transaction = connection.begin()
-        logging.info("Building SQLite database for '%s'" % self.json_file_name)
-        try:
-            with open(self.json_file_name, "r") as f:
-                json_dict = json.load(f)
 
-                for key in json_dict:
+def _non_unique_key_build_options(non_unique_key_policy):
+    return {"non_unique_key_policy": non_unique_key_policy}
 
-                    key_value = json_dict[key]
-                    key_dict = {"key_string": key, "json_value_text": json.dumps(key_value)}
-                    connection.execute(lookup_table.insert(key_dict))
-        except:
-            transaction.commit()
-            raise
 
-        transaction.commit()
+def build_sqlite_lookup_db(json_file_name, db_file_name, batch_size=50000, non_unique_key_resolver=None):
+    """Load the key value pairs of a JSON object into the lookup_table of a new SQLite file. Rows are inserted in
+    batches with an in-memory journal and syncing off and the unique key index is built after loading. If a key
+    is repeated the last value is kept as with json.load. Keys mapping to a list of entries are resolved by the
+    NonUniqueKeyResolver if one is given. Returns the number of keys."""
 
-        return connection, meta_data
+    items = iterate_json_object_items(json_file_name)
+    if non_unique_key_resolver is not None:
+        items = non_unique_key_resolver.resolve_items(items)
 
-    def _look_up_value(self, key):
+    connection = sqlite3.connect(db_file_name)
+    try:
+        connection.execute("PRAGMA journal_mode = MEMORY")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("PRAGMA cache_size = -262144")
 
-        lookup_table = self.meta_data.tables["lookup_table"]
-        sql_expression = lookup_table.select().where(lookup_table.c.key_string == key)
-        cursor = self.connection.execute(sql_expression)
-        rows = list(cursor)
+        connection.execute("CREATE TABLE lookup_table (key_string VARCHAR(255), json_value_text TEXT)")
+
+        n_keys = 0
+        rows = []
+        for key, json_value_text in items:
+            rows.append((key, json_value_text))
+            if len(rows) == batch_size:
+                connection.executemany("INSERT INTO lookup_table (key_string, json_value_text) VALUES (?, ?)", rows)
+                n_keys += len(rows)
+                rows = []
         if len(rows):
-            key_value = json.loads(rows[0].json_value_text)
-            return key_value
-        else:
-            return None
+            connection.executemany("INSERT INTO lookup_table (key_string, json_value_text) VALUES (?, ?)", rows)
+            n_keys += len(rows)
 
-    def map(self, input_dict):
+        try:
+            connection.execute("CREATE UNIQUE INDEX ix_lookup_table_key_string ON lookup_table (key_string)")
+        except sqlite3.IntegrityError:
+            connection.execute("DELETE FROM lookup_table WHERE rowid NOT IN "
+                               "(SELECT MAX(rowid) FROM lookup_table GROUP BY key_string)")
+            connection.execute("CREATE UNIQUE INDEX ix_lookup_table_key_string ON lookup_table (key_string)")
+            n_keys = connection.execute("SELECT COUNT(*) FROM lookup_table").fetchone()[0]
 
-        if len(input_dict):
-            if self.field_name is None:
-                key = list(input_dict.keys())[0]
-            else:
-                key = self.field_name
+        connection.commit()
+    finally:
+        connection.close()
 
-            if key in input_dict:
-                value = input_dict[key]
-            else:
-                return {}
+    return n_keys
 
-            if len(value):  # We only look for values that exist
-                if value in self.mapper_dict_cache:  # We have seen this value before
-                    mapped_dict_instance = self.mapper_dict_cache[value]
-                    if mapped_dict_instance.__class__ == [].__class__:
-                        mapped_dict_instance = mapped_dict_instance[0]
-                        logging.error("Map '%s' to non-unique value selecting the first item" % value)
 
-                    return mapped_dict_instance
+def artifact_manifest_file_name(artifact_file_name):
+    return artifact_file_name + ".manifest.json"
 
-                else: # The value is not in our cache
 
-                    if value in self.missed_mapper_dict_cache:  # We check to see if the value is in our miss cache
-                        self.missed_mapper_dict_cache[value] += 1
-                        return {}
-                    else:
-                        read_from_db_value = self._look_up_value(value)
-                        if read_from_db_value is None:
-                            self.missed_mapper_dict_cache[value] = 1  # If the value is missed add to cache
-                            return {}
-                        else:
-                            self.mapper_dict_cache[value] = read_from_db_value
-                            mapped_dict_instance = read_from_db_value
-                            if mapped_dict_instance.__class__ == [].__class__:
-                                mapped_dict_instance = mapped_dict_instance[0]
-                                logging.error("Map '%s' to non-unique value selecting the first item" % value)
-                            return mapped_dict_instance
-            else:
-                return {}
-        else:
-            return {}
+_file_hashes = {}  # (file name, size, modification time) -> SHA-256 hex digest
 
 
-class IdentityMapper(MapperClass):
-    """Simple maps to the same value"""
+def hash_file(file_name, chunk_size=1048576):
+    """SHA-256 hex digest of the contents of a file. Digests are cached until the size or modification time of
+    the file changes."""
+    file_stat = os.stat(file_name)
+    file_key = (os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime_ns)
+    if file_key in _file_hashes:
+        return _file_hashes[file_key]
 
-    def __init__(self):
-        pass
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        chunk = f.read(chunk_size)
+        while len(chunk):
+            file_hash.update(chunk)
+            chunk = f.read(chunk_size)
 
-    def map(self, input_dict):
-        return input_dict
+    _file_hashes[file_key] = file_hash.hexdigest()
+    return _file_hashes[file_key]
 
 
-class HasNonEmptyValue(MapperClass):
-    """Tests whether a field has a value other than '' or null"""
+def write_artifact_manifest(artifact_file_name, source_file_names, build_seconds=None, build_options=None,
+                            build_summary=None):
+    """Record the size, modification time and content hash of the files an artifact was derived from, together
+    with the size of the artifact, how long it took to build, the options it was built with and a summary of the
+    build"""
 
-    def map(self, input_dict):
-        key = list(input_dict.keys())[0]
-        key_value = input_dict[key]
+    source_file_names = [source_file_names] if source_file_names.__class__ == str else source_file_names
+    manifest_dict = {"artifact_size": os.path.getsize(artifact_file_name), "build_seconds": build_seconds,
+                     "build_options": build_options, "build_summary": build_summary, "sources": []}
+    for source_file_name in source_file_names:
+        source_stat = os.stat(source_file_name)
+        manifest_dict["sources"] += [{"file_name": os.path.abspath(source_file_name), "size": source_stat.st_size,
+                                      "mtime": source_stat.st_mtime, "sha256": hash_file(source_file_name)}]
 
-        if key_value is not None:
-            if len(key_value):
-                if key_value != "null":
-                    return {"non_empty_value": True}
+    with open(artifact_manifest_file_name(artifact_file_name), "w") as fw:
+        json.dump(manifest_dict, fw, indent=4)
 
-        return {}
+    return manifest_dict
 
 
-class TransformMapper(MapperClass):
-    """Applies a transformation for example, lower or upper case"""
+def read_artifact_manifest(artifact_file_name):
+    manifest_file_name = artifact_manifest_file_name(artifact_file_name)
+    if os.path.exists(manifest_file_name):
+        try:
+            with open(manifest_file_name) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+    else:
+        return None
 
-    def __init__(self, func):
-        self.func = func
 
-    def map(self, input_dict):
+def artifact_rebuild_reason(artifact_file_name, source_file_names, build_options=None):
+    """Return why an artifact has to be rebuilt from its sources with build_options or None if its manifest shows
+    it is current. A source whose size and modification time are unchanged is not hashed; one which was only
+    touched has its manifest entry updated."""
 
-        mapped_dict = {}
-        for key in input_dict:
-            mapped_dict[key] = self.func(input_dict[key])
+    source_file_names = [source_file_names] if source_file_names.__class__ == str else source_file_names
+    if not os.path.exists(artifact_file_name):
+        return "does not exist"
 
-        return mapped_dict
+    manifest_dict = read_artifact_manifest(artifact_file_name)
+    if manifest_dict is None:
+        return "has no manifest"
 
+    if manifest_dict["artifact_size"] != os.path.getsize(artifact_file_name):
+        return "was changed after it was built"
 
-class FunctionMapper(MapperClass):
-    def __init__(self, mapper_func, key_name="mapped_value"):
-        self.mapper_func = mapper_func
-        self.key_name = key_name
+    if manifest_dict.get("build_options") != build_options:
+        return "was built with different options"
 
-    def map(self, input_dict):
-        return {self.key_name: self.mapper_func(input_dict)}
+    source_file_names = [os.path.abspath(x) for x in source_file_names]
+    if source_file_names != [x["file_name"] for x in manifest_dict["sources"]]:
+        return "was built from different sources"
 
+    touched = False
+    for source_dict in manifest_dict["sources"]:
+        source_file_name = source_dict["file_name"]
+        if not os.path.exists(source_file_name):
+            return "source '%s' does not exist" % source_file_name
 
-class PassThroughFunctionMapper(FunctionMapper):
+        source_stat = os.stat(source_file_name)
+        if source_stat.st_size != source_dict["size"]:
+            return "source '%s' changed size" % source_file_name
+        elif source_stat.st_mtime != source_dict["mtime"]:
+            if hash_file(source_file_name) != source_dict["sha256"]:
+                return "source '%s' changed" % source_file_name
+            source_dict["mtime"] = source_stat.st_mtime
+            touched = True
 
-    def map(self, input_dict):
-        return self.mapper_func(input_dict)
+    if touched:
+        try:
+            with open(artifact_manifest_file_name(artifact_file_name), "w") as fw:
+                json.dump(manifest_dict, fw, indent=4)
+        except OSError:
+            pass
 
+    return None
 
-class CaseMapper(MapperClass):
-    """Case function returns an integer 0....n where it then evaluates"""
-    def __init__(self, case_function, *map_cases):
-        self.case_function = case_function
-        self.map_cases = map_cases
 
-    def map(self, input_dict):
-        case_value = self.case_function(input_dict)
-        return self.map_cases[case_value].map(input_dict)
+def artifact_version(artifact_file_name):
+    """A hash of the source hashes and build options in the manifest of an artifact, or None without a manifest"""
+    manifest_dict = read_artifact_manifest(artifact_file_name)
+    if manifest_dict is None:
+        return None
 
+    version_dict = {"sources": [x["sha256"] for x in manifest_dict["sources"]],
+                    "build_options": manifest_dict.get("build_options")}
+    return hashlib.sha256(json.dumps(version_dict, sort_keys=True).encode("utf-8")).hexdigest()
 
-class ChainMapper(MapperClass):
-    """Chain together separate mappers and applies each mapper from left to right."""
-    def __init__(self, *mapper_classes):
-        self.mapper_classes = mapper_classes
 
-    def map(self, input_dict):
-        result_dict = {}
-        i = 0
-        for mapper_class in self.mapper_classes:
-            if i == 0:
-                result_dict = mapper_class.map(input_dict)
-            else:
-                result_dict = mapper_class.map(result_dict)
-            i += 1
+def estimate_rebuild_seconds(artifact_file_name, source_file_names):
+    """Estimate the time to rebuild an artifact by scaling its last build time by the change in size of its
+    sources. Returns None when the artifact has not been built with a manifest."""
 
-        return result_dict
+    source_file_names = [source_file_names] if source_file_names.__class__ == str else source_file_names
+    manifest_dict = read_artifact_manifest(artifact_file_name)
+    if manifest_dict is None or manifest_dict["build_seconds"] is None:
+        return None
 
+    built_size = sum([x["size"] for x in manifest_dict["sources"]])
+    source_size = sum([os.path.getsize(x) for x in source_file_names if os.path.exists(x)])
+    if built_size:
+        return manifest_dict["build_seconds"] * source_size / built_size
+    else:
+        return manifest_dict["build_seconds"]
+
+
+_sorted_key_lookup_magic = b"SKLOOKUP"
+
+
+sorted_key_lookup_chunk_size = 1000000
+
+
+def _write_sorted_run(chunk, run_file_name):
+    """Write the (key, value) pairs of a dict of bytes sorted by key as length prefixed records"""
+    with open(run_file_name, "wb") as fw:
+        for key in sorted(chunk):
+            value = chunk[key]
+            fw.write(struct.pack("<II", len(key), len(value)))
+            fw.write(key)
+            fw.write(value)
+
+
+def _read_sorted_run(run_file_name, run_i):
+    with open(run_file_name, "rb") as f:
+        while True:
+            record_header = f.read(8)
+            if len(record_header) < 8:
+                break
+            key_length, value_length = struct.unpack("<II", record_header)
+            yield (f.read(key_length), run_i), f.read(value_length)
+
+
+def _merge_sorted_runs(run_file_names):
+    """Merge sorted run files into (key, value) pairs sorted by key. A key repeated across runs keeps the value
+    of the last run."""
+    last_key = None
+    last_value = None
+    for (key, run_i), value in heapq.merge(*[_read_sorted_run(run_file_name, run_i)
+                                             for run_i, run_file_name in enumerate(run_file_names)]):
+        if last_key is not None and key != last_key:
+            yield last_key, last_value
+        last_key = key
+        last_value = value
+    if last_key is not None:
+        yield last_key, last_value
+
+
+def write_sorted_key_lookup(items, skl_file_name, chunk_size=None):
+    """Write (key, value JSON text) pairs to a sorted key lookup file: a header with the number of keys, the
+    offsets of the keys and of the values and then the UTF-8 keys in sorted order followed by their values. If a
+    key is repeated the last value is kept. Pairs are sorted in chunks of chunk_size and merged from temporary
+    run files, so only one chunk is held in memory. Returns the number of keys."""
+
+    if chunk_size is None:
+        chunk_size = sorted_key_lookup_chunk_size
+
+    temp_file_name = skl_file_name + ".%s.tmp" % os.getpid()
+    part_file_names = [temp_file_name + suffix for suffix in (".key_offsets", ".value_offsets", ".keys", ".values")]
+    run_file_names = []
+    try:
+        chunk = {}
+        for key, json_value_text in items:
+            chunk[key.encode("utf-8")] = json_value_text.encode("utf-8")
+            if len(chunk) >= chunk_size:
+                run_file_names.append(temp_file_name + ".run%s" % len(run_file_names))
+                _write_sorted_run(chunk, run_file_names[-1])
+                chunk = {}
+
+        if len(run_file_names):
+            if len(chunk):
+                run_file_names.append(temp_file_name + ".run%s" % len(run_file_names))
+                _write_sorted_run(chunk, run_file_names[-1])
+                chunk = {}
+            sorted_items = _merge_sorted_runs(run_file_names)
+        else:
+            sorted_items = ((key, chunk[key]) for key in sorted(chunk))
+
+        n_keys = 0
+        with open(part_file_names[0], "wb") as fwko, open(part_file_names[1], "wb") as fwvo, \
+                open(part_file_names[2], "wb") as fwk, open(part_file_names[3], "wb") as fwv:
+            key_offset = 0
+            value_offset = 0
+            key_offsets = array.array("Q", [0])
+            value_offsets = array.array("Q", [0])
+            for key, value in sorted_items:
+                fwk.write(key)
+                fwv.write(value)
+                key_offset += len(key)
+                value_offset += len(value)
+                key_offsets.append(key_offset)
+                value_offsets.append(value_offset)
+                n_keys += 1
+
+                if len(key_offsets) >= 65536:
+                    _write_offsets(key_offsets, fwko)
+                    _write_offsets(value_offsets, fwvo)
+                    key_offsets = array.array("Q")
+                    value_offsets = array.array("Q")
+
+            _write_offsets(key_offsets, fwko)
+            _write_offsets(value_offsets, fwvo)
+
+        with open(temp_file_name, "wb") as fw:
+            fw.write(_sorted_key_lookup_magic)
+            fw.write(struct.pack("<Q", n_keys))
+            for part_file_name in part_file_names:
+                with open(part_file_name, "rb") as f:
+                    shutil.copyfileobj(f, fw, 1048576)
+        os.replace(temp_file_name, skl_file_name)
+    finally:
+        for file_name in [temp_file_name] + part_file_names + run_file_names:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    return n_keys
+
+
+def _write_offsets(offsets, fw):
+    if sys.byteorder == "big":  # Offsets are stored little endian
+        offsets.byteswap()
+    offsets.tofile(fw)
+
+
+def build_sorted_key_lookup(json_file_name, skl_file_name=None, non_unique_key_policy=None):
+    """Stream a JSON object into a sorted key lookup file which by default is written next to it. Non-unique keys
+    are resolved with non_unique_key_policy or by default with lookup_build_defaults["non_unique_key_policy"]."""
+
+    if skl_file_name is None:
+        skl_file_name = json_file_name + ".skl"
+    if non_unique_key_policy is None:
+        non_unique_key_policy = lookup_build_defaults["non_unique_key_policy"]
+
+    start_time = timer()
+    non_unique_key_resolver = NonUniqueKeyResolver(non_unique_key_policy)
+    n_keys = write_sorted_key_lookup(non_unique_key_resolver.resolve_items(iterate_json_object_items(json_file_name)),
+                                     skl_file_name)
+    build_seconds = timer() - start_time
+    write_artifact_manifest(skl_file_name, [json_file_name], build_seconds,
+                            _non_unique_key_build_options(non_unique_key_policy),
+                            {"n_keys": n_keys, "non_unique_keys": non_unique_key_resolver.n_non_unique_keys})
+    logging.info("Wrote %s keys to '%s' in %s seconds" % (n_keys, skl_file_name, build_seconds))
+    non_unique_key_resolver.log_summary(skl_file_name)
+
+    return skl_file_name
+
+
+def current_sorted_key_lookup_file_name(json_file_name, non_unique_key_policy=None):
+    """Return the sorted key lookup file for a JSON file if it exists and its manifest shows it was built from the
+    current JSON file with the non-unique key policy"""
+
+    if json_file_name.endswith(".skl"):
+        return json_file_name
+    if non_unique_key_policy is None:
+        non_unique_key_policy = lookup_build_defaults["non_unique_key_policy"]
+
+    skl_file_name = json_file_name + ".skl"
+    if os.path.exists(skl_file_name) and artifact_rebuild_reason(
+            skl_file_name, [json_file_name], _non_unique_key_build_options(non_unique_key_policy)) is None:
+        return skl_file_name
+
+    return None
+
+
+class SortedKeyLookup(object):
+    """A read only dict like view of a memory mapped sorted key lookup file. Keys are found by binary search and
+    values are decoded from JSON when looked up. The file is opened in milliseconds and its pages are shared
+    between the processes which map it. Every index_step-th key is held in a list which is bisected before the
+    search of the file narrows to index_step keys. With a cache_size the values of keys looked up, and keys which are
+    missing, are kept in an LRU cache of that many keys so that repeated keys are neither searched nor decoded."""
+
+    index_step = 64
+
+    def __init__(self, skl_file_name, cache_size=None):
+        self.skl_file_name = skl_file_name
+        self.cache_size = cache_size
+        self._open()
+
+    def _open(self):
+        with open(self.skl_file_name, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[0:8] != _sorted_key_lookup_magic:
+            self.mmap.close()
+            raise ValueError("'%s' is not a sorted key lookup file" % self.skl_file_name)
+
+        self.n_keys = struct.unpack_from("<Q", self.mmap, 8)[0]
+        offsets_size = 8 * (self.n_keys + 1)
+        self.key_offsets = self._offsets(16, offsets_size)
+        self.value_offsets = self._offsets(16 + offsets_size, offsets_size)
+        self.keys_start = 16 + 2 * offsets_size
+        self.values_start = self.keys_start + self.key_offsets[self.n_keys]
+
+        self.index_keys = [self._key(i) for i in range(0, self.n_keys, self.index_step)]
+
+        if self.cache_size is None:
+            self.cache = None
+        else:
+            self.cache = LRUCache(self.cache_size)
 
-class CascadeMapper(MapperClass):
-    """Runs through mappers until one returns a results"""
+    def _offsets(self, start, size):
+        if sys.byteorder == "little":
+            return memoryview(self.mmap)[start:start + size].cast("Q")
+        else:
+            offsets = array.array("Q", self.mmap[start:start + size])
+            offsets.byteswap()
+            return offsets
 
-    def __init__(self, *mapper_classes):
-        self.mapper_classes = mapper_classes
+    def _key(self, i):
+        return self.mmap[self.keys_start + self.key_offsets[i]:self.keys_start + self.key_offsets[i + 1]]
 
-    def map(self, input_dict):
+    def _find(self, key):
+        if key.__class__ != str:  # Keys of a JSON object are strings
+            return None
 
-        for mapper_class in self.mapper_classes:
-            result_dict = mapper_class.map(input_dict)
+        key = key.encode("utf-8")
+        block = bisect.bisect_right(self.index_keys, key) - 1
+        if block < 0:
+            return None
+        elif self.index_keys[block] == key:
+            return block * self.index_step
+
+        low = block * self.index_step + 1
+        high = min(low - 1 + self.index_step, self.n_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
 
-            if len(result_dict):
-                return result_dict
+        if low < self.n_keys and self._key(low) == key:
+            return low
+        else:
+            return None
 
-        return {}
+    def _get(self, key, default):
+        i = self._find(key)
+        if i is None:
+            return default
+        else:
+            return json.loads(self.mmap[self.values_start + self.value_offsets[i]:
+                                        self.values_start + self.value_offsets[i + 1]].decode("utf-8"))
 
+    def get(self, key, default=None):
+        if self.cache is None or key.__class__ != str:
+            return self._get(key, default)
 
-class CascadeKeyMapper(MapperClass):
-    """Runs through mappers until one returns a results with a specific key"""
+        value = self.cache.get(key, _not_cached)
+        if value is _not_cached:
+            value = self._get(key, _missing_value)
+            self.cache.put(key, value)
 
-    def __init__(self, key, *mapper_classes):
-        self.mapper_classes = mapper_classes
-        self.key = key
+        if value is _missing_value:
+            return default
+        else:
+            return value
 
-    def map(self, input_dict):
+    def __getitem__(self, key):
+        value = self.get(key, _missing_value)
+        if value is _missing_value:
+            raise KeyError(key)
+        return value
 
-        for mapper_class in self.mapper_classes:
-            result_dict = mapper_class.map(input_dict)
-            if self.key in result_dict:
-                return result_dict
+    def __contains__(self, key):
+        return self._find(key) is not None
 
-        return {}
+    def __len__(self):
+        return self.n_keys
 
+    def __iter__(self):
+        for i in range(self.n_keys):
+            yield self._key(i).decode("utf-8")
 
-class FilterHasKeyValueMapper(MapperClass):
+    def close(self):
+        if self.key_offsets.__class__ == memoryview:
+            self.key_offsets.release()
+            self.value_offsets.release()
+        self.mmap.close()
 
-    """Return only a single key which matches a key and has a value"""
+    def __getstate__(self):
+        return {"skl_file_name": self.skl_file_name, "cache_size": self.cache_size}
 
-    def __init__(self, keys_to_track, empty_values=("", "null"), empty_value=None):
-        self.keys_to_track = keys_to_track
-        self.empty_values = empty_values
-        self.empty_value = empty_value
+    def __setstate__(self, state):
+        self.skl_file_name = state["skl_file_name"]
+        self.cache_size = state["cache_size"]
+        self._open()
 
-    def map(self, input_dict):
 
-        for key in self.keys_to_track:
-            if key in input_dict:
-                if self.empty_value is None:
-                    if input_dict[key] not in self.empty_values:
-                        return {key: input_dict[key]}
-                else:
-                    if input_dict[key] != self.empty_value:
-                        return {key: input_dict[key]}
+class LRUCache(object):
+    """Least recently used cache bounded by a number of items and optionally by the sum of the sizes given when
+    items are added. Counts hits, misses and evictions."""
 
-        return {}
+    def __init__(self, max_size=None, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
 
+        self.items = collections.OrderedDict()
+        self.item_sizes = {}
+        self.n_bytes = 0
 
-class SingleMatchAddValueMapper(MapperClass):
-    """Match a key in the first position and then value and then ejects a value"""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def __init__(self, pattern_match, key_replace):
-        key_to_match, value_to_match = pattern_match
-        self.key_to_match = key_to_match
-        self.value_to_match = value_to_match
-        self.key_replace = key_replace
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=1):
+        if key in self.items:
+            self.n_bytes -= self.item_sizes.pop(key, 0)
+            del self.items[key]
+
+        self.items[key] = value
+        if self.max_bytes is not None:
+            self.item_sizes[key] = size
+            self.n_bytes += size
+
+        while (self.max_size is not None and len(self.items) > self.max_size) or \
+                (self.max_bytes is not None and self.n_bytes > self.max_bytes and len(self.items) > 1):
+            evicted_key, evicted_value = self.items.popitem(last=False)
+            self.n_bytes -= self.item_sizes.pop(evicted_key, 0)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.items
 
-    def map(self, input_dict):
+    def __len__(self):
+        return len(self.items)
 
-        if self.key_to_match in input_dict:
-            value_to_test = input_dict[self.key_to_match]
-            if value_to_test == self.value_to_match:
-                new_key, new_value = self.key_replace
-                input_dict[new_key] = new_value
-                return input_dict
-            else:
-                return input_dict
-        else:
-            return input_dict
+    def clear(self):
+        self.items.clear()
+        self.item_sizes.clear()
+        self.n_bytes = 0
 
+    def statistics(self):
+        return {"size": len(self.items), "bytes": self.n_bytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
 
-class SingleMatchOnlyValueMapper(SingleMatchAddValueMapper):
-    def map(self, input_dict):
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-        dict_copy = {}
-        for k in input_dict:
+
+# Memory mapped I/O size in bytes and page cache size (negative is in KiB) for each SQLite lookup connection
+sqlite_lookup_pragmas = {"mmap_size": 268435456, "cache_size": -65536}
+
+_look_up_sql = "SELECT json_value_text FROM lookup_table WHERE key_string = ?"
+
+
+# Cache bounds used by CodeMapperClassSqliteJSONClass when none are given; None is unbounded
+lookup_cache_defaults = {"cache_size": 250000, "miss_cache_size": 250000, "cache_bytes": None, "warm_start": False}
+
+
+def set_lookup_cache_defaults(cache_size=None, miss_cache_size=None, cache_bytes=None, warm_start=False):
+    """Set the default cache bounds and warm start of the SQLite lookups created afterwards"""
+    lookup_cache_defaults["cache_size"] = cache_size
+    lookup_cache_defaults["miss_cache_size"] = miss_cache_size
+    lookup_cache_defaults["cache_bytes"] = cache_bytes
+    lookup_cache_defaults["warm_start"] = warm_start
+
+
+class ArtifactBuildLock(object):
+    """An exclusive lock on a lock file next to an artifact which serialises builds of the artifact across
+    processes"""
+
+    def __init__(self, artifact_file_name):
+        self.lock_file_name = artifact_file_name + ".lock"
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.lock_file_name, "a")
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+
+def build_sqlite_lookup_artifact(json_file_name, non_unique_key_policy="first"):
+    """Build the SQLite database of a JSON lookup file, json_file_name + ".db3", unless it is current. The
+    database is streamed into a temporary file which replaces it when complete, so readers of the old database
+    are not interrupted. Builds are serialised with an ArtifactBuildLock and a process which waited for another
+    process's build uses that database. Returns the database file name."""
+
+    db_file_name = json_file_name + ".db3"
+    build_options = _non_unique_key_build_options(non_unique_key_policy)
+    if artifact_rebuild_reason(db_file_name, [json_file_name], build_options) is None:
+        return db_file_name
+
+    with ArtifactBuildLock(db_file_name):
+        rebuild_reason = artifact_rebuild_reason(db_file_name, [json_file_name], build_options)
+        if rebuild_reason is None:
+            return db_file_name
+
+        logging.info("SQLite database '%s' %s" % (db_file_name, rebuild_reason))
+        logging.info("Building SQLite database for '%s'" % json_file_name)
+        start_time = timer()
+
+        temp_db_file_name = db_file_name + ".%s.tmp" % os.getpid()
+        non_unique_key_resolver = NonUniqueKeyResolver(non_unique_key_policy)
+        try:
+            n_keys = build_sqlite_lookup_db(json_file_name, temp_db_file_name,
+                                            non_unique_key_resolver=non_unique_key_resolver)
+            os.replace(temp_db_file_name, db_file_name)
+        finally:
+            if os.path.exists(temp_db_file_name):
+                os.remove(temp_db_file_name)
+
+        build_seconds = timer() - start_time
+        write_artifact_manifest(db_file_name, [json_file_name], build_seconds, build_options,
+                                {"n_keys": n_keys, "non_unique_keys": non_unique_key_resolver.n_non_unique_keys})
+        logging.info("Loaded %s keys in %s seconds" % (n_keys, build_seconds))
+        non_unique_key_resolver.log_summary(db_file_name)
+
+    return db_file_name
+
+
+class SqliteLookupStore(object):
+    """A SQLite database built from a JSON file with LRU caches of found and missed values. A store is shared by the
+    CodeMapperClassSqliteJSONClass views of a JSON file, see get_sqlite_lookup_store(). With warm_start the caches
+    are loaded from the profile saved by the last run and the keys found are counted, see
+    save_warm_start_profile(). Once more than twice hit_count_size keys are counted only the hit_count_size
+    most counted are kept."""
+
+    hit_count_size = 100000
+
+    def __init__(self, json_file_name, cache_size=None, miss_cache_size=None, cache_bytes=None,
+                 non_unique_key_policy="first", warm_start=False):
+
+        self.db_file_name = json_file_name + ".db3"
+        self.json_file_name = json_file_name
+        self.non_unique_key_policy = non_unique_key_policy
+
+        build_sqlite_lookup_artifact(self.json_file_name, non_unique_key_policy)
+        self.connection = self._create_connection()
+
+        build_summary = read_artifact_manifest(self.db_file_name)["build_summary"] or {}
+        self.non_unique_keys = build_summary.get("non_unique_keys", 0)
+
+        self.db_file_stat = self._db_file_stat()
+
+        self.mapper_dict_cache = LRUCache(cache_size, cache_bytes)
+        self.missed_mapper_dict_cache = LRUCache(miss_cache_size)  # hold values that are missed so we don't make multiple expensive lookups to file
+        self.db_lookups = 0
+
+        self.hit_counts = collections.Counter()
+        self.warm_start = warm_start
+        if warm_start:
+            self.load_warm_start_profile()
+
+        _sqlite_lookup_stores_opened.add(self)
+
+    def _db_file_stat(self):
+        file_stat = []
+        for file_name in [self.db_file_name, self.json_file_name]:
+            if not os.path.exists(file_name):
+                return None
+            stat = os.stat(file_name)
+            file_stat += [(stat.st_ino, stat.st_size, stat.st_mtime_ns)]
+
+        return file_stat
+
+    def is_current(self):
+        """False when the SQLite file has been removed or rebuilt or the JSON file has changed since the store was
+        opened"""
+        return self.db_file_stat is not None and self._db_file_stat() == self.db_file_stat
+
+    def _create_connection(self):
+        """Open the database read only and immutable so SQLite skips locking and change detection"""
+        connection_uri = "file:%s?mode=ro&immutable=1" % urllib.parse.quote(os.path.abspath(self.db_file_name))
+        connection = sqlite3.connect(connection_uri, uri=True, check_same_thread=False)
+        connection.execute("PRAGMA mmap_size=%d" % sqlite_lookup_pragmas["mmap_size"])
+        connection.execute("PRAGMA cache_size=%d" % sqlite_lookup_pragmas["cache_size"])
+        self.cursor = connection.cursor()
+
+        return connection
+
+    def _look_up_value_text(self, key):
+
+        self.db_lookups += 1
+        # The statement text is constant so sqlite3 reuses the prepared statement from its cache
+        row = self.cursor.execute(_look_up_sql, (key,)).fetchone()
+        if row is not None:
+            return row[0]
+        else:
+            return None
+
+    def _look_up_value(self, key):
+
+        json_value_text = self._look_up_value_text(key)
+        if json_value_text is not None:
+            key_value = json.loads(json_value_text)
+            return key_value
+        else:
+            return None
+
+    def look_up(self, value):
+        """Return the decoded value for a key through the caches or None when the key is missing"""
+
+        mapped_value = self.mapper_dict_cache.get(value)
+        if mapped_value is None:  # The value is not in our cache
+
+            if self.missed_mapper_dict_cache.get(value) is not None:  # We check to see if the value is in our miss cache
+                return None
+            else:
+                json_value_text = self._look_up_value_text(value)
+                if json_value_text is None:
+                    self.missed_mapper_dict_cache.put(value, 1)  # If the value is missed add to cache
+                    return None
+                else:
+                    mapped_value = json.loads(json_value_text)
+                    self.mapper_dict_cache.put(value, mapped_value, len(value) + len(json_value_text))
+
+        if self.warm_start:
+            self.hit_counts[value] += 1
+            if len(self.hit_counts) > 2 * self.hit_count_size:
+                self._prune_hit_counts()
+
+        return mapped_value
+
+    def count_hits(self, hit_counts):
+        """Add a dict of hit counts of found keys to those of the store"""
+        self.hit_counts.update(hit_counts)
+        if len(self.hit_counts) > 2 * self.hit_count_size:
+            self._prune_hit_counts()
+
+    def _prune_hit_counts(self):
+        self.hit_counts = collections.Counter(dict(self.hit_counts.most_common(self.hit_count_size)))
+
+    def prefetch(self, values, chunk_size=900):
+        """Look up the values which are in neither cache with one query per chunk_size values and add the results
+        to the caches"""
+        values_to_look_up = []
+        seen_values = set()
+        for value in values:
+            if value and value not in seen_values and value not in self.mapper_dict_cache and \
+                    value not in self.missed_mapper_dict_cache:
+                seen_values.add(value)
+                values_to_look_up.append(value)
+
+        cursor = self.connection.cursor()
+        try:
+            for i in range(0, len(values_to_look_up), chunk_size):
+                chunk = values_to_look_up[i:i + chunk_size]
+                self.db_lookups += 1
+                cursor.execute("SELECT key_string, json_value_text FROM lookup_table WHERE key_string IN (%s)" %
+                               ",".join(["?"] * len(chunk)), chunk)
+                found_values = set()
+                for key_string, json_value_text in cursor.fetchall():
+                    found_values.add(key_string)
+                    self.mapper_dict_cache.put(key_string, json.loads(json_value_text),
+                                               len(key_string) + len(json_value_text))
+                for value in chunk:
+                    if value not in found_values:
+                        self.missed_mapper_dict_cache.put(value, 1)
+        finally:
+            cursor.close()
+
+    def cache_statistics(self):
+        """Counters of the found and missed value caches and of database lookups"""
+        return {"json_file_name": self.json_file_name, "db_lookups": self.db_lookups,
+                "non_unique_keys": self.non_unique_keys,
+                "cache": self.mapper_dict_cache.statistics(),
+                "miss_cache": self.missed_mapper_dict_cache.statistics()}
+
+    def reset_cache_statistics(self):
+        self.db_lookups = 0
+        self.mapper_dict_cache.reset_statistics()
+        self.missed_mapper_dict_cache.reset_statistics()
+
+    def warm_start_file_name(self):
+        return self.db_file_name + ".warm.json"
+
+    def warm_start_profile(self, n_hot_keys=10000):
+        """The n_hot_keys found keys with the highest hit counts, most counted first, their counts and all the
+        cached misses with the version of the database they were looked up in"""
+        hot_key_counts = self.hit_counts.most_common(n_hot_keys)
+        return {"artifact_version": artifact_version(self.db_file_name),
+                "hot_keys": [key for key, count in hot_key_counts],
+                "hit_counts": [count for key, count in hot_key_counts],
+                "misses": list(self.missed_mapper_dict_cache.items.keys())}
+
+    def save_warm_start_profile(self, n_hot_keys=10000):
+        """Save the warm start profile of the store, see warm_start_profile()"""
+
+        profile_dict = self.warm_start_profile(n_hot_keys)
+
+        warm_start_file_name = self.warm_start_file_name()
+        temp_file_name = warm_start_file_name + ".%s.tmp" % os.getpid()
+        try:
+            with open(temp_file_name, "w") as fw:
+                json.dump(profile_dict, fw)
+            os.replace(temp_file_name, warm_start_file_name)
+        finally:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+
+    def load_warm_start_profile(self):
+        """Prefetch the hot keys and add the misses of a saved profile to the caches. A profile saved for another
+        version of the database is ignored. Returns True if the profile was loaded."""
+
+        warm_start_file_name = self.warm_start_file_name()
+        if not os.path.exists(warm_start_file_name):
+            return False
+
+        try:
+            with open(warm_start_file_name) as f:
+                profile_dict = json.load(f)
+        except ValueError:
+            logging.warning("Ignoring unreadable warm start profile '%s'" % warm_start_file_name)
+            return False
+
+        if not self.add_warm_start_profile(profile_dict, add_hit_counts=False):
+            logging.info("Ignoring warm start profile '%s' saved for another version of '%s'" %
+                         (warm_start_file_name, self.db_file_name))
+            return False
+
+        logging.info("Warm started '%s' with %s keys and %s misses" % (self.db_file_name,
+                                                                      len(profile_dict["hot_keys"]),
+                                                                      len(profile_dict["misses"])))
+        return True
+
+    def add_warm_start_profile(self, profile_dict, add_hit_counts=True):
+        """Prefetch the hot keys and add the misses of a profile to the caches. With add_hit_counts the hit counts
+        of the profile are added to those of the store, a profile without counts counts each hot key once. Returns
+        False for a profile of another version of the database."""
+        if profile_dict["artifact_version"] != artifact_version(self.db_file_name):
+            return False
+
+        self.prefetch(profile_dict["hot_keys"])
+        if add_hit_counts:
+            hit_counts = profile_dict.get("hit_counts", [1] * len(profile_dict["hot_keys"]))
+            self.count_hits(dict(zip(profile_dict["hot_keys"], hit_counts)))
+        for value in profile_dict["misses"]:
+            self.missed_mapper_dict_cache.put(value, 1)
+        return True
+
+
+_sqlite_lookup_stores = {}
+_sqlite_lookup_stores_opened = weakref.WeakSet()
+
+
+def get_sqlite_lookup_store(json_file_name, cache_size=None, miss_cache_size=None, cache_bytes=None,
+                            non_unique_key_policy="first", warm_start=False):
+    """Return the store for a JSON file shared across the process. Lookups asking for different cache bounds or
+    non-unique key policies get separate stores and a store is reopened when its SQLite file has been removed or
+    rebuilt."""
+
+    store_key = (os.path.abspath(json_file_name), cache_size, miss_cache_size, cache_bytes, non_unique_key_policy)
+    lookup_store = _sqlite_lookup_stores.get(store_key)
+    if lookup_store is None or not lookup_store.is_current():
+        lookup_store = SqliteLookupStore(json_file_name, cache_size, miss_cache_size, cache_bytes,
+                                         non_unique_key_policy, warm_start)
+        _sqlite_lookup_stores[store_key] = lookup_store
+    elif warm_start and not lookup_store.warm_start:
+        lookup_store.warm_start = True
+        lookup_store.load_warm_start_profile()
+
+    return lookup_store
+
+
+class CodeMapperClassSqliteJSONClass(CodeMapperClass):
+    """For large JSON files we build a SQLite database and cache in memory what we access. Found and missed values
+    are held in LRU caches bounded by cache_size and miss_cache_size items and by cache_bytes of JSON text. Bounds
+    which are not given are taken from lookup_cache_defaults; a bound of None is unbounded. Mappers of the same
+    JSON file are views on one shared SqliteLookupStore unless shared is False. Keys which map to a list are
+    resolved when the database is built with non_unique_key_policy, see NonUniqueKeyResolver. With warm_start
+    the caches start from the hot keys and misses saved by the last run."""
+
+    _default = object()
+
+    def __init__(self, json_file_name, field_name=None, cache_size=_default, miss_cache_size=_default,
+                 cache_bytes=_default, shared=True, non_unique_key_policy=None, warm_start=_default):
+        self.field_name = field_name
+
+        self.db_file_name = json_file_name + ".db3"
+        self.json_file_name = json_file_name
+        lookup_files_opened.add(os.path.abspath(json_file_name))
+
+        if cache_size is self._default:
+            cache_size = lookup_cache_defaults["cache_size"]
+        if miss_cache_size is self._default:
+            miss_cache_size = lookup_cache_defaults["miss_cache_size"]
+        if cache_bytes is self._default:
+            cache_bytes = lookup_cache_defaults["cache_bytes"]
+        if non_unique_key_policy is None:
+            non_unique_key_policy = lookup_build_defaults["non_unique_key_policy"]
+        if warm_start is self._default:
+            warm_start = lookup_cache_defaults["warm_start"]
+
+        if shared:
+            self.lookup_store = get_sqlite_lookup_store(json_file_name, cache_size, miss_cache_size, cache_bytes,
+                                                        non_unique_key_policy, warm_start)
+        else:
+            self.lookup_store = SqliteLookupStore(json_file_name, cache_size, miss_cache_size, cache_bytes,
+                                                  non_unique_key_policy, warm_start)
+
+    @property
+    def connection(self):
+        return self.lookup_store.connection
+
+    @property
+    def mapper_dict_cache(self):
+        return self.lookup_store.mapper_dict_cache
+
+    @property
+    def missed_mapper_dict_cache(self):
+        return self.lookup_store.missed_mapper_dict_cache
+
+    @property
+    def db_lookups(self):
+        return self.lookup_store.db_lookups
+
+    def _look_up_value(self, key):
+        return self.lookup_store._look_up_value(key)
+
+    def map(self, input_dict):
+
+        if len(input_dict):
+            if self.field_name is None:
+                key = list(input_dict.keys())[0]
+            else:
+                key = self.field_name
+
+            if key in input_dict:
+                value = input_dict[key]
+            else:
+                return {}
+
+            if len(value):  # We only look for values that exist
+                mapped_dict_instance = self.lookup_store.look_up(value)
+                if mapped_dict_instance is None:
+                    return {}
+                else:
+                    return mapped_dict_instance
+            else:
+                return {}
+        else:
+            return {}
+
+    def prefetch(self, values, chunk_size=900):
+        self.lookup_store.prefetch(values, chunk_size)
+
+    def prefetch_batch(self, input_columns):
+        """Prefetch the values of the column a block of rows is looked up by"""
+        if len(input_columns):
+            if self.field_name is None:
+                field = list(input_columns.keys())[0]
+            else:
+                field = self.field_name
+            if field in input_columns:
+                self.prefetch(input_columns[field])
+
+    def cache_statistics(self):
+        return self.lookup_store.cache_statistics()
+
+    def reset_cache_statistics(self):
+        self.lookup_store.reset_cache_statistics()
+
+    def map_batch(self, input_columns, n_rows):
+        self.prefetch_batch(input_columns)
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
+
+def prefetch_lookups(mapper_obj, input_columns, n_rows):
+    """Walk a mapper and its nested mappers and prefetch the lookups a block of rows, given as
+    {field: [value_1, ..., value_n]}, will need. The first mapper of a ChainMapper, every mapper of a
+    CascadeMapper and, for the rows selected by its case function, each mapper of a CaseMapper are prefetched."""
+
+    if hasattr(mapper_obj, "prefetch_batch"):
+        mapper_obj.prefetch_batch(input_columns)
+    elif mapper_obj.__class__ == ChainMapper:
+        if len(mapper_obj.mapper_classes):
+            prefetch_lookups(mapper_obj.mapper_classes[0], input_columns, n_rows)
+    elif mapper_obj.__class__ == CascadeMapper:
+        for child_mapper_obj in mapper_obj.mapper_classes:
+            prefetch_lookups(child_mapper_obj, input_columns, n_rows)
+    elif mapper_obj.__class__ == CaseMapper:
+        fields = list(input_columns.keys())
+        case_rows = {}
+        for k in range(n_rows):
+            row_dict = {field: input_columns[field][k] for field in fields}
+            try:
+                case_value = mapper_obj.case_function(row_dict)
+            except Exception:
+                continue
+            if case_value in case_rows:
+                case_rows[case_value] += [k]
+            else:
+                case_rows[case_value] = [k]
+
+        for case_value in case_rows:
+            if case_value.__class__ == int and 0 <= case_value < len(mapper_obj.map_cases):
+                rows = case_rows[case_value]
+                case_columns = {field: [input_columns[field][k] for k in rows] for field in fields}
+                prefetch_lookups(mapper_obj.map_cases[case_value], case_columns, len(rows))
+    elif mapper_obj.__class__ in (ProfiledMapper, MemoizedMapper):
+        prefetch_lookups(mapper_obj.mapper_obj, input_columns, n_rows)
+    elif mapper_obj.__class__ == ContextMemoizedMapper:
+        if mapper_obj.fields is not None:
+            input_columns = {field: input_columns[field] for field in mapper_obj.fields if field in input_columns}
+        prefetch_lookups(mapper_obj.mapper_obj, input_columns, n_rows)
+
+
+def _reconnect_sqlite_lookup_stores():
+    """SQLite connections cannot be shared with a forked process so each child opens its own. Stores whose file
+    has been removed or rebuilt are not reopened as connecting would create an empty database."""
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        if lookup_store.is_current():
+            lookup_store.connection = lookup_store._create_connection()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reconnect_sqlite_lookup_stores)
+
+
+def save_warm_start_profiles():
+    """Save the warm start profile of each current SQLite lookup store opened with warm start"""
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        if lookup_store.warm_start and lookup_store.is_current():
+            try:
+                lookup_store.save_warm_start_profile()
+            except OSError:
+                logging.warning("Unable to save warm start profile for '%s'" % lookup_store.db_file_name)
+
+
+atexit.register(save_warm_start_profiles)
+
+
+def warm_start_profiles():
+    """The warm start profiles of the current SQLite lookup stores opened with warm start keyed by database file"""
+    profiles = {}
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        if lookup_store.warm_start and lookup_store.is_current():
+            profiles[lookup_store.db_file_name] = lookup_store.warm_start_profile()
+    return profiles
+
+
+def _reset_warm_start_hit_counts():
+    """Clear the hit counts of the SQLite lookup stores so that a worker only returns the hits of its shard"""
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        lookup_store.hit_counts = collections.Counter()
+
+
+def merge_warm_start_profiles(profiles):
+    """Add the warm start profiles of worker processes to the caches and hit counts of the lookup stores of this
+    process, so that the profiles it saves include the lookups of the workers"""
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        if lookup_store.warm_start and lookup_store.db_file_name in profiles and lookup_store.is_current():
+            lookup_store.add_warm_start_profile(profiles[lookup_store.db_file_name])
+
+
+def log_lookup_cache_statistics(reset=True):
+    """Log the cache counters of each SQLite lookup store and by default reset them so they cover a single stage"""
+    lookup_cache_statistics = []
+    for lookup_store in list(_sqlite_lookup_stores_opened):
+        cache_statistics = lookup_store.cache_statistics()
+        lookup_cache_statistics += [cache_statistics]
+        logging.info("Lookup cache statistics: %s" % json.dumps(cache_statistics))
+        if reset:
+            lookup_store.reset_cache_statistics()
+
+    return lookup_cache_statistics
+
+
+class IdentityMapper(MapperClass):
+    """Simple maps to the same value"""
+
+    def __init__(self):
+        pass
+
+    def map(self, input_dict):
+        return input_dict
+
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_row(self, input_columns, n_rows)
+
+
+class HasNonEmptyValue(MapperClass):
+    """Tests whether a field has a value other than '' or null"""
+
+    def map(self, input_dict):
+        key = list(input_dict.keys())[0]
+        key_value = input_dict[key]
+
+        if key_value is not None:
+            if len(key_value):
+                if key_value != "null":
+                    return {"non_empty_value": True}
+
+        return {}
+
+
+class TransformMapper(MapperClass):
+    """Applies a transformation for example, lower or upper case. Set pure if func depends only on its argument and
+    has no side effects so that the mapper can be memoized."""
+
+    def __init__(self, func, pure=False):
+        self.func = func
+        self.pure = pure
+
+    def map(self, input_dict):
+
+        mapped_dict = {}
+        for key in input_dict:
+            mapped_dict[key] = self.func(input_dict[key])
+
+        return mapped_dict
+
+
+class FunctionMapper(MapperClass):
+    def __init__(self, mapper_func, key_name="mapped_value"):
+        self.mapper_func = mapper_func
+        self.key_name = key_name
+
+    def map(self, input_dict):
+        return {self.key_name: self.mapper_func(input_dict)}
+
+
+class PassThroughFunctionMapper(FunctionMapper):
+
+    def map(self, input_dict):
+        return self.mapper_func(input_dict)
+
+
+class CaseMapper(MapperClass):
+    """Case function returns an integer 0....n where it then evaluates. Set pure if case_function depends only on
+    its input and has no side effects so that the mapper can be memoized."""
+    def __init__(self, case_function, *map_cases, pure=False):
+        self.case_function = case_function
+        self.map_cases = map_cases
+        self.pure = pure
+
+    def map(self, input_dict):
+        case_value = self.case_function(input_dict)
+        return self.map_cases[case_value].map(input_dict)
+
+
+class ChainMapper(MapperClass):
+    """Chain together separate mappers and applies each mapper from left to right."""
+    def __init__(self, *mapper_classes):
+        self.mapper_classes = mapper_classes
+
+    def map(self, input_dict):
+        result_dict = {}
+        i = 0
+        for mapper_class in self.mapper_classes:
+            if i == 0:
+                result_dict = mapper_class.map(input_dict)
+            else:
+                result_dict = mapper_class.map(result_dict)
+            i += 1
+
+        return result_dict
+
+
+class CascadeMapper(MapperClass):
+    """Runs through mappers until one returns a results"""
+
+    def __init__(self, *mapper_classes):
+        self.mapper_classes = mapper_classes
+
+    def map(self, input_dict):
+
+        for mapper_class in self.mapper_classes:
+            result_dict = mapper_class.map(input_dict)
+
+            if len(result_dict):
+                return result_dict
+
+        return {}
+
+    def map_batch(self, input_columns, n_rows):
+        """Apply each mapper in turn to the rows for which the previous mappers returned no result"""
+        results = [None] * n_rows
+        pending_rows = list(range(n_rows))
+        for mapper_class in self.mapper_classes:
+            if not len(pending_rows):
+                break
+
+            if len(pending_rows) == n_rows:
+                pending_columns = input_columns
+            else:
+                pending_columns = {}
+                for field in input_columns:
+                    column = input_columns[field]
+                    pending_columns[field] = [column[k] for k in pending_rows]
+
+            mapped_rows = apply_map_batch(mapper_class, pending_columns, len(pending_rows))
+            still_pending_rows = []
+            for k, result_dict in zip(pending_rows, mapped_rows):
+                if len(result_dict):
+                    results[k] = result_dict
+                else:
+                    still_pending_rows += [k]
+            pending_rows = still_pending_rows
+
+        for k in pending_rows:
+            results[k] = {}
+
+        return results
+
+
+class CascadeKeyMapper(MapperClass):
+    """Runs through mappers until one returns a results with a specific key"""
+
+    def __init__(self, key, *mapper_classes):
+        self.mapper_classes = mapper_classes
+        self.key = key
+
+    def map(self, input_dict):
+
+        for mapper_class in self.mapper_classes:
+            result_dict = mapper_class.map(input_dict)
+            if self.key in result_dict:
+                return result_dict
+
+        return {}
+
+
+class FilterHasKeyValueMapper(MapperClass):
+
+    """Return only a single key which matches a key and has a value"""
+
+    def __init__(self, keys_to_track, empty_values=("", "null"), empty_value=None):
+        self.keys_to_track = keys_to_track
+        self.empty_values = empty_values
+        self.empty_value = empty_value
+
+    def map(self, input_dict):
+
+        for key in self.keys_to_track:
+            if key in input_dict:
+                if self.empty_value is None:
+                    if input_dict[key] not in self.empty_values:
+                        return {key: input_dict[key]}
+                else:
+                    if input_dict[key] != self.empty_value:
+                        return {key: input_dict[key]}
+
+        return {}
+
+
+class SingleMatchAddValueMapper(MapperClass):
+    """Match a key in the first position and then value and then ejects a value"""
+
+    def __init__(self, pattern_match, key_replace):
+        key_to_match, value_to_match = pattern_match
+        self.key_to_match = key_to_match
+        self.value_to_match = value_to_match
+        self.key_replace = key_replace
+
+    def map(self, input_dict):
+
+        if self.key_to_match in input_dict:
+            value_to_test = input_dict[self.key_to_match]
+            if value_to_test == self.value_to_match:
+                new_key, new_value = self.key_replace
+                input_dict[new_key] = new_value
+                return input_dict
+            else:
+                return input_dict
+        else:
+            return input_dict
+
+
+class SingleMatchOnlyValueMapper(SingleMatchAddValueMapper):
+    def map(self, input_dict):
+
+        dict_copy = {}
+        for k in input_dict:
             dict_copy[k] = input_dict
 
         if self.key_to_match in input_dict:
@@ -552,6 +2197,9 @@ class ReplacementMapper(MapperClass):
 
         return translated_dict
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class ConstantMapper(MapperClass):
     """Always returns the same thing in a map operation no matter what the input is"""
@@ -562,6 +2210,9 @@ class ConstantMapper(MapperClass):
     def map(self, void_dict):
         return self.mapping_result
 
+    def map_batch(self, input_columns, n_rows):
+        return [self.mapping_result] * n_rows
+
 
 class KeyTranslator(object):
     """Translate keys in a dict to a different key"""
@@ -586,12 +2237,36 @@ class KeyTranslator(object):
     def map(self, dict_to_map):
         return self.translate(dict_to_map)
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
+    def translate_batch(self, dicts_to_map):
+        """Translate a list of dicts translating each distinct dict object once"""
+        translated_dicts = {}
+        results = []
+        for dict_to_map in dicts_to_map:
+            translated_dict = translated_dicts.get(id(dict_to_map))
+            if translated_dict is None:
+                translated_dict = self.translate(dict_to_map)
+                translated_dicts[id(dict_to_map)] = translated_dict
+            results += [translated_dict]
+
+        return results
+
 
 def single_key_translator(map_field_from, map_field_to):
     """Create a simple key translator mapping a single key to a second key"""
     return KeyTranslator({map_field_from: map_field_to})
 
 
+def translate_batch(key_translator, dicts_to_map):
+    """Translate a list of dicts using translate_batch of the translator if it has one"""
+    if hasattr(key_translator, "translate_batch"):
+        return key_translator.translate_batch(dicts_to_map)
+    else:
+        return [key_translator.translate(dict_to_map) for dict_to_map in dicts_to_map]
+
+
 class IdentityTranslator(KeyTranslator):
     def __init__(self):
         pass
@@ -599,6 +2274,9 @@ class IdentityTranslator(KeyTranslator):
     def translate(self, dict_to_map):
         return dict_to_map
 
+    def translate_batch(self, dicts_to_map):
+        return list(dicts_to_map)
+
 
 class ConcatenateMapper(object):
     """Concatenate several fields together"""
@@ -638,6 +2316,146 @@ class LeftStringMapper(MapperClass):
         return new_dict
 
 
+class MappingContext(object):
+    """Holds the results of memoized mappers for the row being mapped so that a router, the rules and post_map_func
+    which apply the same mapper to the same values share a single lookup. RunMapperAgainstSingleInputRealization
+    marks the start and end of each row (or of each block of rows in batch mode)."""
+
+    def __init__(self):
+        self.results = {}
+        self.active = False
+        self.hits = 0
+        self.misses = 0
+
+    def begin_row(self):
+        self.results.clear()
+        self.active = True
+
+    def end_row(self):
+        self.results.clear()
+        self.active = False
+
+    def memoize(self, mapper_obj, fields=None):
+        """Wrap a mapper so its results are shared within a row"""
+        return ContextMemoizedMapper(mapper_obj, self, fields)
+
+
+class ContextMemoizedMapper(MapperClass):
+    """Memoizes the result of a mapper in a MappingContext. If fields is given only those fields of the input are
+    passed to the mapper, so a router can pass the whole row and share the result with a rule on those fields.
+    Fields missing from the input are left out, as a rule leaves out fields missing from the row."""
+
+    def __init__(self, mapper_obj, mapping_context, fields=None):
+        self.mapper_obj = mapper_obj
+        self.mapping_context = mapping_context
+        self.fields = fields
+
+    def map(self, input_dict):
+        if self.fields is not None:
+            input_dict = {field: input_dict[field] for field in self.fields if field in input_dict}
+        key = (self, tuple(input_dict.items()))
+
+        mapping_context = self.mapping_context
+        if not mapping_context.active:
+            return self.mapper_obj.map(input_dict)
+
+        if key in mapping_context.results:
+            mapping_context.hits += 1
+            return mapping_context.results[key]
+        else:
+            mapping_context.misses += 1
+            result = self.mapper_obj.map(input_dict)
+            mapping_context.results[key] = result
+            return result
+
+
+class MemoizedMapper(MapperClass):
+    """Caches the results of a mapper which is a pure function of its input values in an LRU cache of cache_size
+    input combinations. The mapper is called with a copy of the input so mappers which modify their input, such as
+    SingleMatchAddValueMapper, change neither the caller's dict nor a cached result. Unless copy_results is False
+    each call returns a copy of the cached result so the caller may modify it."""
+
+    def __init__(self, mapper_obj, cache_size=10000, copy_results=True):
+        self.mapper_obj = mapper_obj
+        self.cache = LRUCache(cache_size)
+        self.copy_results = copy_results
+
+    def map(self, input_dict):
+        try:
+            key = tuple(input_dict.items())
+            result = self.cache.get(key)
+        except TypeError:  # Inputs which cannot be hashed are not cached
+            return self.mapper_obj.map(dict(input_dict))
+
+        if result is None:
+            result = self.mapper_obj.map(dict(input_dict))
+            self.cache.put(key, result)
+
+        if self.copy_results and result.__class__ == dict:
+            return dict(result)
+        else:
+            return result
+
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
+    def cache_statistics(self):
+        return self.cache.statistics()
+
+
+# Mappers whose result depends only on their input values and which can be memoized in a tree of composite mappers
+_pure_mapper_classes = (CoderMapperStaticClass, CodeMapperDictClass, CoderMapperJSONClass,
+                        CodeMapperClassSqliteJSONClass, IdentityMapper, HasNonEmptyValue, FilterHasKeyValueMapper,
+                        SingleMatchAddValueMapper, SingleMatchOnlyValueMapper, ReplacementMapper, ConstantMapper,
+                        KeyTranslator, ConcatenateMapper, LeftStringMapper, MemoizedMapper)
+_composite_mapper_classes = (ChainMapper, CascadeMapper, CascadeKeyMapper, CaseMapper)
+
+
+def is_pure_mapper(mapper_obj):
+    """True for a mapper known to be pure. A TransformMapper is only pure when its caller marks it so."""
+    if mapper_obj.__class__ == TransformMapper:
+        return mapper_obj.pure
+    else:
+        return mapper_obj.__class__ in _pure_mapper_classes
+
+
+def is_memoizable_mapper(mapper_obj, depth=0):
+    """True for a ChainMapper, CascadeMapper, CascadeKeyMapper or CaseMapper whose nested mappers are all composite
+    mappers or mappers known to be pure. A CaseMapper also has to be marked pure as its case function may have side
+    effects. Single pure mappers are cheaper to call than to memoize."""
+    if mapper_obj.__class__ not in _composite_mapper_classes or depth > 16:
+        return False
+
+    if mapper_obj.__class__ == CaseMapper:
+        if not mapper_obj.pure:
+            return False
+        child_mapper_objs = mapper_obj.map_cases
+    else:
+        child_mapper_objs = mapper_obj.mapper_classes
+
+    for child_mapper_obj in child_mapper_objs:
+        if is_pure_mapper(child_mapper_obj):
+            continue
+        elif not is_memoizable_mapper(child_mapper_obj, depth + 1):
+            return False
+
+    return True
+
+
+def memoize_mapper(mapper_obj, cache_size=10000, memoized_mappers=None):
+    """Wrap a memoizable mapper in a MemoizedMapper whose results are only read by the caller. A mapper found in
+    memoized_mappers, a dict of id(mapper_obj) to its wrapper, reuses that wrapper."""
+    if not is_memoizable_mapper(mapper_obj):
+        return mapper_obj
+
+    if memoized_mappers is None:
+        memoized_mappers = {}
+    if id(mapper_obj) not in memoized_mappers:
+        memoized_mappers[id(mapper_obj)] = (mapper_obj, MemoizedMapper(mapper_obj, cache_size, copy_results=False))
+
+    return memoized_mappers[id(mapper_obj)][1]
+
+
 class InputOutputMapperInstance(object):
     """A single mapping rule"""
     def __init__(self, map_function=IdentityMapper(), key_translator=IdentityTranslator()):
@@ -647,48 +2465,318 @@ class InputOutputMapperInstance(object):
     def map(self, input_dict):
         return self.key_translator.translate(self.map_function.map(input_dict))
 
+    def map_batch(self, input_columns, n_rows):
+        return translate_batch(self.key_translator, apply_map_batch(self.map_function, input_columns, n_rows))
+
+
+def equivalent_mappers(mapper_obj_1, mapper_obj_2, depth=0):
+    """Two mappers are equivalent if they are the same object or instances of the same class whose attributes are
+    equal or are themselves equivalent mappers"""
+    if mapper_obj_1 is mapper_obj_2:
+        return True
+    elif depth > 16:
+        return False
+    elif mapper_obj_1.__class__ is not mapper_obj_2.__class__:
+        return False
+    elif mapper_obj_1.__class__ in (tuple, list):
+        return len(mapper_obj_1) == len(mapper_obj_2) and \
+            all([equivalent_mappers(x1, x2, depth + 1) for x1, x2 in zip(mapper_obj_1, mapper_obj_2)])
+    elif isinstance(mapper_obj_1, (MapperClass, KeyTranslator)):
+        attributes_1 = mapper_obj_1.__dict__
+        attributes_2 = mapper_obj_2.__dict__
+        if attributes_1.keys() != attributes_2.keys():
+            return False
+        for attribute in attributes_1:
+            if not equivalent_mappers(attributes_1[attribute], attributes_2[attribute], depth + 1):
+                return False
+        return True
+    else:
+        try:
+            return bool(mapper_obj_1 == mapper_obj_2)
+        except Exception:
+            return False
+
+
+class InputOutputMapper(object):
+    """Basic class that applies a map and a key translation. Rules which apply equivalent mappers to the
+    same input fields share a single evaluation of the mapper for each row."""
+    def __init__(self, field_mapper_instances):
+        self.field_mapper_instances = field_mapper_instances
+        self._map_counter = [0]  # Number of rows mapped
+        self._build_evaluation_plan()
+
+    def _build_evaluation_plan(self):
+        """Build a list of (fields, mapper_instance, shared_index) where shared_index is the index of the first rule
+        with the same fields and an equivalent map function or None if the rule shares no evaluation"""
+
+        groups = []  # [(fields, map_function, [rule indices])]
+        rule_groups = []
+        for field, mapper_instance in self.field_mapper_instances:
+            if field.__class__ != tuple:
+                field = (field, )
+
+            rule_group = None
+            if mapper_instance.__class__ == InputOutputMapperInstance and \
+                    mapper_instance.map_function.__class__ != IdentityMapper:
+                for group in groups:
+                    if group[0] == field and equivalent_mappers(group[1], mapper_instance.map_function):
+                        rule_group = group
+                        break
+                if rule_group is None:
+                    rule_group = (field, mapper_instance.map_function, [])
+                    groups += [rule_group]
+                rule_group[2].append(len(rule_groups))
+
+            rule_groups += [rule_group]
+
+        self._evaluation_plan = []
+        for k in range(len(self.field_mapper_instances)):
+            field, mapper_instance = self.field_mapper_instances[k]
+            if field.__class__ != tuple:
+                field = (field, )
+
+            rule_group = rule_groups[k]
+            if rule_group is not None and len(rule_group[2]) > 1:
+                shared_index = rule_group[2][0]
+            else:
+                shared_index = None
+
+            self._evaluation_plan += [(field, mapper_instance, shared_index)]
+
+    def map(self, input_dict):
+        mapped_dict = {}
+        shared_results = {}
+        self._map_counter[0] += 1
+
+        for field, mapper_instance, shared_index in self._evaluation_plan:
+
+            if shared_index is not None and shared_index in shared_results:
+                mapped_dict_instance = mapper_instance.key_translator.translate(shared_results[shared_index])
+            else:
+                field_dict = {}
+                for single_field in field:
+                    try:
+                        single_field_value = input_dict[single_field]
+                    except KeyError:
+                        logging.error("Cannot find key %s" % single_field)
+                        logging.error(input_dict)
+                        raise
+                    field_dict[single_field] = single_field_value
+
+                if shared_index is None:
+                    mapped_dict_instance = mapper_instance.map(field_dict)
+                else:
+                    shared_result = mapper_instance.map_function.map(field_dict)
+                    shared_results[shared_index] = shared_result
+                    mapped_dict_instance = mapper_instance.key_translator.translate(shared_result)
+
+            for key in mapped_dict_instance:
+                mapped_dict[key] = mapped_dict_instance[key]
+
+        #
+        # logging.debug(input_dict)
+        # logging.debug(mapped_dict)
+
+        return mapped_dict
+
+    def statistics(self):
+        """For each rule the number of times the mapper was evaluated and the number of evaluations saved by reusing
+        the result of an earlier rule"""
+        rows_mapped = self._map_counter[0]
+        rule_statistics = []
+        for k in range(len(self._evaluation_plan)):
+            field, mapper_instance, shared_index = self._evaluation_plan[k]
+            if mapper_instance.__class__ == InputOutputMapperInstance:
+                mapper_name = mapper_instance.map_function.__class__.__name__
+            else:
+                mapper_name = mapper_instance.__class__.__name__
+
+            if shared_index is not None and shared_index != k:
+                evaluated, reused = 0, rows_mapped
+            else:
+                evaluated, reused = rows_mapped, 0
+
+            rule_statistics += [{"rule": k, "fields": list(field), "mapper": mapper_name,
+                                 "shared_with_rule": shared_index, "evaluated": evaluated, "reused": reused}]
+
+        return rule_statistics
+
+    def memoize(self, cache_size=10000, memoized_mappers=None):
+        """Wrap the memoizable mappers of the rules in MemoizedMapper, see is_memoizable_mapper()"""
+        if memoized_mappers is None:
+            memoized_mappers = {}
+        for field, mapper_instance in self.field_mapper_instances:
+            if mapper_instance.__class__ == InputOutputMapperInstance:
+                mapper_instance.map_function = memoize_mapper(mapper_instance.map_function, cache_size,
+                                                              memoized_mappers)
+
+    def input_fields(self):
+        """Input fields which are read by the rules"""
+        fields = []
+        for field, mapper_instance in self.field_mapper_instances:
+            if field.__class__ != tuple:
+                field = (field, )
+            for single_field in field:
+                if single_field not in fields:
+                    fields += [single_field]
+
+        return fields
+
+    def map_batch(self, input_columns, n_rows):
+        """Map a block of n_rows rows given as {field: [value_1, ..., value_n]} and return a list of mapped dicts.
+        Each rule is applied to the whole block; identity rules are assigned column by column."""
+        mapped_rows = [{} for k in range(n_rows)]
+        shared_results = {}
+        self._map_counter[0] += n_rows
+
+        for field, mapper_instance, shared_index in self._evaluation_plan:
+
+            field_columns = {}
+            for single_field in field:
+                try:
+                    field_columns[single_field] = input_columns[single_field]
+                except KeyError:
+                    logging.error("Cannot find key %s" % single_field)
+                    raise
+
+            if mapper_instance.__class__ == InputOutputMapperInstance and \
+                    mapper_instance.map_function.__class__ == IdentityMapper and \
+                    mapper_instance.key_translator.__class__ in (IdentityTranslator, KeyTranslator):
+                _assign_identity_columns(mapped_rows, field_columns, mapper_instance.key_translator)
+                continue
+
+            if shared_index is None:
+                mapped_dict_instances = apply_map_batch(mapper_instance, field_columns, n_rows)
+            else:
+                if shared_index not in shared_results:
+                    shared_results[shared_index] = apply_map_batch(mapper_instance.map_function, field_columns, n_rows)
+                mapped_dict_instances = translate_batch(mapper_instance.key_translator, shared_results[shared_index])
+
+            for mapped_dict, mapped_dict_instance in zip(mapped_rows, mapped_dict_instances):
+                mapped_dict.update(mapped_dict_instance)
+
+        return mapped_rows
+
+    def __len__(self):
+        return len(self.field_mapper_instances)
+
+
+def _assign_identity_columns(mapped_rows, field_columns, key_translator):
+    """Assign input columns directly to the mapped rows for a rule without a map function"""
+    for field in field_columns:
+        column = field_columns[field]
+        if key_translator.__class__ == IdentityTranslator:
+            key = field
+        elif field in key_translator.translate_dict:
+            key = key_translator.translate_dict[field]
+        else:
+            key = field
+            column = [None] * len(mapped_rows)
+
+        for mapped_dict, value in zip(mapped_rows, column):
+            mapped_dict[key] = value
+
+
+class CompiledInputOutputMapper(InputOutputMapper):
+    """An InputOutputMapper whose rules are compiled into a single generated Python function. Identity rules
+    become direct assignments and mapper calls and key translations are emitted as straight-line code. The
+    generated source is available as the attribute source."""
+
+    _compiled_count = 0
+
+    def __init__(self, field_mapper_instances, name="compiled_map"):
+        self.name = name
+        super().__init__(field_mapper_instances)
+
+    def _build_evaluation_plan(self):
+        super()._build_evaluation_plan()
+        self.compile()
+
+    def memoize(self, cache_size=10000, memoized_mappers=None):
+        super().memoize(cache_size, memoized_mappers)
+        self.compile()
+
+    def compile(self):
+        """Generate the source for the rules, then compile and bind it as map"""
+        namespace = {"logging": logging, "map_counter": self._map_counter}
+        field_variables = {}
+        read_lines = []
+        map_lines = []
+
+        def field_variable(single_field):
+            if single_field not in field_variables:
+                variable = "v_%s" % len(field_variables)
+                field_variables[single_field] = variable
+                read_lines.append("        %s = input_dict[%r]" % (variable, single_field))
+            return field_variables[single_field]
+
+        for k in range(len(self._evaluation_plan)):
+            field, mapper_instance, shared_index = self._evaluation_plan[k]
 
-class InputOutputMapper(object):
-    """Basic class that applies a map and a key translation"""
-    def __init__(self, field_mapper_instances):
-        self.field_mapper_instances = field_mapper_instances
+            field_dict_source = "{" + ", ".join(["%r: %s" % (single_field, field_variable(single_field))
+                                                 for single_field in field]) + "}"
 
-    def map(self, input_dict):
-        mapped_dict = {}
+            map_lines.append("    # Rule %s: %r" % (k, field if len(field) > 1 else field[0]))
 
-        for field_mapper_instance in self.field_mapper_instances:
-            field, mapper_instance = field_mapper_instance
-            field_dict = {}
-            if field.__class__ == tuple:
-                pass
-            else:
-                field = (field, )
+            if mapper_instance.__class__ != InputOutputMapperInstance:
+                namespace["i_%s" % k] = mapper_instance.map
+                map_lines.append("    mapped_dict.update(i_%s(%s))" % (k, field_dict_source))
+                continue
 
-            for single_field in field:
-                try:
-                    single_field_value = input_dict[single_field]
-                except KeyError:
-                    logging.error("Cannot find key %s" % single_field)
-                    logging.error(input_dict)
-                    raise
-                field_dict[single_field] = single_field_value
+            map_function = mapper_instance.map_function
+            key_translator = mapper_instance.key_translator
 
-            mapped_dict_instance = mapper_instance.map(field_dict)
+            if map_function.__class__ == IdentityMapper and key_translator.__class__ == IdentityTranslator:
+                for single_field in field:
+                    map_lines.append("    mapped_dict[%r] = %s" % (single_field, field_variables[single_field]))
 
-            for key in mapped_dict_instance:
-                mapped_dict[key] = mapped_dict_instance[key]
+            elif map_function.__class__ == IdentityMapper and key_translator.__class__ == KeyTranslator:
+                for single_field in field:
+                    if single_field in key_translator.translate_dict:
+                        map_lines.append("    mapped_dict[%r] = %s" % (key_translator.translate_dict[single_field],
+                                                                     field_variables[single_field]))
+                    else:
+                        map_lines.append("    mapped_dict[%r] = None" % single_field)
+            else:
+                if shared_index is None or shared_index == k:
+                    r = "r_%s" % k
+                    namespace["m_%s" % k] = map_function.map
+                    map_lines.append("    %s = m_%s(%s)" % (r, k, field_dict_source))
+                else:
+                    r = "r_%s" % shared_index  # Reuse the result of an earlier rule
+
+                if key_translator.__class__ == IdentityTranslator:
+                    map_lines.append("    mapped_dict.update(%s)" % r)
+                elif key_translator.__class__ == KeyTranslator:
+                    namespace["t_%s" % k] = key_translator.translate_dict
+                    map_lines += ["    for key in %s:" % r,
+                                  "        if key in t_%s:" % k,
+                                  "            mapped_dict[t_%s[key]] = %s[key]" % (k, r),
+                                  "        else:",
+                                  "            mapped_dict[key] = None"]
+                else:
+                    namespace["t_%s" % k] = key_translator.translate
+                    map_lines.append("    mapped_dict.update(t_%s(%s))" % (k, r))
 
-        #
-        # logging.debug(input_dict)
-        # logging.debug(mapped_dict)
+        source_lines = ["def %s(input_dict):" % self.name]
+        if len(read_lines):
+            source_lines += ["    try:"] + read_lines + \
+                            ["    except KeyError as e:",
+                             "        logging.error(\"Cannot find key %s\" % e.args[0])",
+                             "        logging.error(input_dict)",
+                             "        raise"]
+        source_lines += ["    map_counter[0] += 1", "    mapped_dict = {}"] + map_lines + ["    return mapped_dict", ""]
+        self.source = "\n".join(source_lines)
 
-        return mapped_dict
+        CompiledInputOutputMapper._compiled_count += 1
+        file_name = "<compiled rules %s %s>" % (self.name, CompiledInputOutputMapper._compiled_count)
+        linecache.cache[file_name] = (len(self.source), None, self.source.splitlines(True), file_name)
+        exec(compile(self.source, file_name, "exec"), namespace)
 
-    def __len__(self):
-        return len(self.field_mapper_instances)
+        self.map = namespace[self.name]
 
 
-def build_input_output_mapper(mapped_field_pairs):
+def build_input_output_mapper(mapped_field_pairs, compile_rules=False, memoize=False, memoize_cache_size=10000):
     """Build an input output mapper based on the following patterns
         [e1, e2, ... , en] where e1 is of type
              1)  str -> Identity Map, Identity Field Translate
@@ -699,6 +2787,9 @@ def build_input_output_mapper(mapped_field_pairs):
              6) ((str1, str2), MapperClassInstance)
              7) ((str1, str2), MapperClassInstance, Dict)
              8) ((str1, str2), MapperClassInstance, TranslatorClassInstance)
+
+        If compile_rules is True the rules are compiled into a single Python function. If memoize is True
+        memoizable mappers are wrapped in a MemoizedMapper caching memoize_cache_size results
     """
 
     string_types = ("".__class__, u"".__class__)
@@ -727,7 +2818,16 @@ def build_input_output_mapper(mapped_field_pairs):
 
                 input_output_mapper_instance_list += [(mapped_field[0], InputOutputMapperInstance(mapper_class_obj, key_translator_obj))]
 
-    return InputOutputMapper(input_output_mapper_instance_list)
+    if memoize:
+        memoized_mappers = {}
+        for field, mapper_instance in input_output_mapper_instance_list:
+            mapper_instance.map_function = memoize_mapper(mapper_instance.map_function, memoize_cache_size,
+                                                          memoized_mappers)
+
+    if compile_rules:
+        return CompiledInputOutputMapper(input_output_mapper_instance_list)
+    else:
+        return InputOutputMapper(input_output_mapper_instance_list)
 
 
 class DirectoryClass(object):
@@ -746,12 +2846,176 @@ class InputOutputMapperDirectory(DirectoryClass):
     def register(self, input_class_obj, output_class_obj, mapper_class_obj):
         self.directory_dict[(input_class_obj.__class__, output_class_obj.__class__)] = mapper_class_obj
 
+    def memoize(self, cache_size=10000):
+        """Memoize the memoizable mappers of each registered InputOutputMapper. A mapper used by several rules or
+        input classes shares one cache."""
+        memoized_mappers = {}
+        for input_class, output_class in self.directory_dict:
+            mapper_class_obj = self.directory_dict[(input_class, output_class)]
+            if hasattr(mapper_class_obj, "memoize"):
+                mapper_class_obj.memoize(cache_size, memoized_mappers)
+
+    def compile(self):
+        """Replace each registered InputOutputMapper with a CompiledInputOutputMapper"""
+        for input_class, output_class in self.directory_dict:
+            mapper_class_obj = self.directory_dict[(input_class, output_class)]
+            if mapper_class_obj.__class__ == InputOutputMapper:
+                self.directory_dict[(input_class, output_class)] = \
+                    CompiledInputOutputMapper(mapper_class_obj.field_mapper_instances,
+                                              "map_%s_to_%s" % (input_class.__name__, output_class.__name__))
+
 
 class OutputClassDirectory(DirectoryClass):
     def register(self, output_class_obj, output_class_realization_obj):
         self.directory_dict[output_class_obj.__class__] = output_class_realization_obj
 
 
+class MapperProfile(object):
+    """Call count, cumulative time and number of empty results of a profiled mapper or function"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.empty_results = 0
+
+    def to_dict(self):
+        profile_dict = {"name": self.name, "calls": self.calls, "time": self.time,
+                        "empty_results": self.empty_results}
+        if self.calls:
+            profile_dict["time_per_call"] = self.time / self.calls
+            profile_dict["empty_result_rate"] = self.empty_results / self.calls
+        else:
+            profile_dict["time_per_call"] = None
+            profile_dict["empty_result_rate"] = None
+        return profile_dict
+
+
+class ProfiledMapper(MapperClass):
+    """Records calls, time and empty results of a mapper"""
+
+    def __init__(self, mapper_obj, profile):
+        self.mapper_obj = mapper_obj
+        self.profile = profile
+
+    def map(self, input_dict):
+        start_time = timer()
+        result_dict = self.mapper_obj.map(input_dict)
+        self.profile.time += timer() - start_time
+        self.profile.calls += 1
+        if not len(result_dict):
+            self.profile.empty_results += 1
+        return result_dict
+
+    def map_batch(self, input_columns, n_rows):
+        start_time = timer()
+        results = apply_map_batch(self.mapper_obj, input_columns, n_rows)
+        self.profile.time += timer() - start_time
+        self.profile.calls += n_rows
+        for result_dict in results:
+            if not len(result_dict):
+                self.profile.empty_results += 1
+        return results
+
+
+class MappingProfiler(object):
+    """Profiles the rules of the mappers registered for an input class, the nested Chain, Cascade and Case mappers,
+    the router and post_map_func of a RunMapperAgainstSingleInputRealization. At the end of each run a report
+    ranked by cumulative time is written as JSON to report_directory, numbered in the order of the runs. Times of
+    nested mappers are included in the time of the mappers containing them."""
+
+    def __init__(self, report_directory=None):
+        self.report_directory = report_directory
+        self.profiles = []
+        self.n_reports = 0
+
+    def _profile(self, name):
+        profile = MapperProfile(name)
+        self.profiles += [profile]
+        return profile
+
+    def profile_function(self, func, name):
+        """Wrap a router, pre_map_func or post_map_func"""
+        profile = self._profile(name)
+
+        def profiled_function(input_dict):
+            start_time = timer()
+            result = func(input_dict)
+            profile.time += timer() - start_time
+            profile.calls += 1
+            return result
+
+        if hasattr(func, "input_fields"):
+            profiled_function.input_fields = func.input_fields
+
+        return profiled_function
+
+    def profile_mapper(self, mapper_obj, name):
+        """Return a profiled copy of a mapper with its nested mappers profiled"""
+        if mapper_obj.__class__ in (ChainMapper, CascadeMapper):
+            mapper_obj = copy.copy(mapper_obj)
+            mapper_obj.mapper_classes = tuple([self.profile_mapper(child_mapper_obj, "%s > %s[%s]" %
+                                                                   (name, mapper_obj.__class__.__name__, i))
+                                               for i, child_mapper_obj in enumerate(mapper_obj.mapper_classes)])
+        elif mapper_obj.__class__ == CaseMapper:
+            mapper_obj = copy.copy(mapper_obj)
+            mapper_obj.map_cases = tuple([self.profile_mapper(child_mapper_obj, "%s > CaseMapper[%s]" % (name, i))
+                                          for i, child_mapper_obj in enumerate(mapper_obj.map_cases)])
+
+        return ProfiledMapper(mapper_obj, self._profile("%s > %s" % (name, mapper_obj.__class__.__name__)))
+
+    def profile_input_output_mapper(self, input_output_mapper_obj, name):
+        """Return a copy of an InputOutputMapper with the map function of each rule profiled. Rules which share
+        an evaluation share the profiled mapper so that they still share it."""
+
+        if not hasattr(input_output_mapper_obj, "_evaluation_plan"):
+            return input_output_mapper_obj
+
+        field_mapper_instances = []
+        profiled_map_functions = {}
+        for k, (field, mapper_instance) in enumerate(input_output_mapper_obj.field_mapper_instances):
+            if mapper_instance.__class__ == InputOutputMapperInstance and \
+                    mapper_instance.map_function.__class__ != IdentityMapper:
+                shared_index = input_output_mapper_obj._evaluation_plan[k][2]
+                if shared_index is not None and shared_index in profiled_map_functions:
+                    map_function = profiled_map_functions[shared_index]
+                else:
+                    map_function = self.profile_mapper(mapper_instance.map_function, "%s rule %s %s" %
+                                                       (name, k, field))
+                    profiled_map_functions[k] = map_function
+                mapper_instance = InputOutputMapperInstance(map_function, mapper_instance.key_translator)
+            field_mapper_instances += [(field, mapper_instance)]
+
+        if input_output_mapper_obj.__class__ == CompiledInputOutputMapper:
+            return CompiledInputOutputMapper(field_mapper_instances, input_output_mapper_obj.name)
+        else:
+            return InputOutputMapper(field_mapper_instances)
+
+    def report(self, stage_name, output_realizations=(), total_time=None):
+        """Rank the profiles by time, write them as JSON and reset the profiles"""
+        ranked_profiles = sorted([profile.to_dict() for profile in self.profiles], key=lambda x: -x["time"])
+
+        writers = []
+        for output_realization_obj in output_realizations:
+            if hasattr(output_realization_obj, "write_time"):
+                writers += [{"name": output_realization_obj.csv_file_name, "rows": output_realization_obj.i - 1,
+                             "time": output_realization_obj.write_time}]
+
+        report_dict = {"stage": stage_name, "total_time": total_time, "profiles": ranked_profiles,
+                       "writers": writers}
+
+        self.n_reports += 1
+        if self.report_directory is not None:
+            report_file_name = os.path.join(self.report_directory, "profile_%02d_%s.json" % (self.n_reports,
+                                                                                           stage_name))
+            with open(report_file_name, "w") as fw:
+                json.dump(report_dict, fw, indent=2)
+            logging.info("Wrote profile to '%s'" % report_file_name)
+
+        self.profiles = []
+        return report_dict
+
+
 class RunMapper(object):
     """Executes the map"""
     pass
@@ -761,7 +3025,8 @@ class RunMapperAgainstSingleInputRealization(RunMapper):
     """Main class for running a mapping process"""
 
     def __init__(self, input_class_realization_obj, input_output_directory_obj, output_directory_obj, output_class_func,
-                 pre_map_func=None, post_map_func=None):
+                 pre_map_func=None, post_map_func=None, mapping_context=None, project_input_fields=False,
+                 profiler=None, prefetch_size=None):
         self.input_class_realization_obj = input_class_realization_obj
         self.input_output_directory_obj = input_output_directory_obj
         self.output_directory_obj = output_directory_obj
@@ -769,42 +3034,277 @@ class RunMapperAgainstSingleInputRealization(RunMapper):
 
         self.pre_map_func = pre_map_func
         self.post_map_func = post_map_func
+        self.mapping_context = mapping_context
+
+        self.project_input_fields = project_input_fields
+        self._input_fields_projected = False
+
+        self.profiler = profiler
+        self.profile_report = None
+
+        self.prefetch_size = prefetch_size
+
+        # With a commit_file_name the rows mapped are committed every commit_rows rows, see _commit
+        self.commit_file_name = None
+        self.commit_rows = 100000
 
         self.rows_run = 0
+        self.mapping_results = {}
 
         self.output_classes_written = []
 
-    def run(self, n_rows=10000):
-
-        i = 0
-        j = 0
+    def run(self, n_rows=10000, batch_size=None):
+        """Map every row of the input realization. When batch_size is set rows are routed and mapped in blocks of
+        batch_size rows using the columnar map_batch of the registered mappers."""
 
-        mapping_results = {}  # Stores counts of how many rows are mapped to specific classes
+        self.mapping_results = {}  # Stores counts of how many rows are mapped to specific classes
+        self.rows_mapped = 0
         input_class = self.input_class_realization_obj.input_class.__class__
 
         global_start_time = timer()
-        start_time = timer()
         logging.info("Mapping input %s" % input_class)
-        for row_dict in self.input_class_realization_obj:
 
-            if self.pre_map_func is not None:
-                row_dict = self.pre_map_func(row_dict)
+        if self.project_input_fields:
+            self._project_input_fields()
+
+        if self.commit_file_name is not None:
+            start_i = self._resume()
+        else:
+            start_i = 0
 
-            output_class_obj = self.output_class_func(row_dict)
-            output_class = output_class_obj.__class__
+        if self.profiler is not None:
+            unprofiled_state = self._start_profiling(input_class)
 
-            if output_class in mapping_results:
-                mapping_results[output_class] += 1
+        try:
+            if batch_size is None:
+                i = self._run_rows(input_class, n_rows, start_i)
             else:
-                mapping_results[output_class] = 1
+                i = self._run_batches(input_class, n_rows, batch_size, start_i)
+        finally:
+            if self.profiler is not None:
+                self._stop_profiling(unprofiled_state)
+
+        self.rows_run = i
 
-            if output_class == NoOutputClass().__class__:
+        global_end_time = timer()
+        total_time = global_end_time - global_start_time
+
+        logging.info("Total time %s seconds" % total_time)
+        if i:
+            logging.info("Rate per %s rows: %s" % (n_rows, n_rows * (total_time * 1.0)/i,))
+        else:
+            logging.info("No rows")
+
+        logging.info("%s" % self.mapping_results)
+        self._log_rule_statistics(input_class)
+
+        if self.mapping_context is not None:
+            logging.info("Mapping context hits: %s misses: %s" % (self.mapping_context.hits,
+                                                                 self.mapping_context.misses))
+
+        for output_class_inst in self.output_classes_written:
+            output_class_inst.close()
+            if hasattr(output_class_inst, "write_time"):
+                logging.info("Wrote %s rows to '%s' in %s seconds" % (output_class_inst.i - 1,
+                                                                     output_class_inst.csv_file_name,
+                                                                     output_class_inst.write_time))
+
+        if self.profiler is not None:
+            self.profile_report = self.profiler.report(input_class.__name__, self.output_classes_written, total_time)
+
+        if self.commit_file_name is not None and os.path.exists(self.commit_file_name):
+            os.remove(self.commit_file_name)
+
+    def _commit(self, rows_run):
+        """Flush the output files to disk and record their sizes with the position in the input file so that a
+        run which fails can be resumed from this row"""
+        output_sizes = {}
+        for output_class_inst in self.output_classes_written:
+            output_class_inst.flush()
+            os.fsync(output_class_inst.fw.fileno())
+            output_sizes[output_class_inst.csv_file_name] = os.path.getsize(output_class_inst.csv_file_name)
+
+        input_realization_obj = self.input_class_realization_obj
+        input_stat = os.stat(input_realization_obj.csv_file_name)
+        commit_dict = {"input_file_name": os.path.abspath(input_realization_obj.csv_file_name),
+                       "input_size": input_stat.st_size, "input_mtime": input_stat.st_mtime,
+                       "input_offset": input_realization_obj.position, "next_row_id": input_realization_obj.i,
+                       "rows_run": rows_run, "outputs": output_sizes}
+
+        temp_file_name = self.commit_file_name + ".%s.tmp" % os.getpid()
+        with open(temp_file_name, "w") as fw:
+            json.dump(commit_dict, fw, indent=4)
+        os.replace(temp_file_name, self.commit_file_name)
+
+    def _resume(self):
+        """Continue from the rows recorded in the commit file. The committed output files must have been moved
+        aside by prepare_resume before the output realizations were created. Returns the number of rows already
+        run."""
+        commit_dict = read_commit(self.commit_file_name)
+        if commit_dict is None:
+            return 0
+
+        input_realization_obj = self.input_class_realization_obj
+        input_stat = os.stat(input_realization_obj.csv_file_name)
+        if commit_dict["input_file_name"] != os.path.abspath(input_realization_obj.csv_file_name) or \
+                commit_dict["input_size"] != input_stat.st_size or commit_dict["input_mtime"] != input_stat.st_mtime:
+            logging.warning("Input '%s' changed since rows were committed; mapping from the first row"
+                            % input_realization_obj.csv_file_name)
+            discard_commit(self.commit_file_name)
+            return 0
+
+        output_realizations = {}
+        for output_class in self.output_directory_obj.directory_dict:
+            output_class_inst = self.output_directory_obj[output_class]
+            if hasattr(output_class_inst, "csv_file_name"):
+                output_realizations[output_class_inst.csv_file_name] = output_class
+
+        for csv_file_name in commit_dict["outputs"]:
+            output_class_inst = self._output_class_instance(output_realizations[csv_file_name])
+            output_class_inst.append_csv_file(committed_file_name(csv_file_name))
+            os.remove(committed_file_name(csv_file_name))
+
+        self.input_class_realization_obj = input_realization_obj.shard(commit_dict["input_offset"], None,
+                                                                       commit_dict["next_row_id"])
+        input_realization_obj.f.close()
+
+        logging.info("Resuming '%s' after %s committed rows" % (input_realization_obj.csv_file_name,
+                                                             commit_dict["rows_run"]))
+        return commit_dict["rows_run"]
+
+    def _start_profiling(self, input_class):
+        """Replace the router, pre_map_func, post_map_func and the mappers for the input class with profiled
+        copies. Returns what is needed to restore them."""
+        unprofiled_state = (self.output_class_func, self.pre_map_func, self.post_map_func,
+                            dict(self.input_output_directory_obj.directory_dict))
+
+        self.output_class_func = self.profiler.profile_function(self.output_class_func, "router")
+        if self.pre_map_func is not None:
+            self.pre_map_func = self.profiler.profile_function(self.pre_map_func, "pre_map_func")
+        if self.post_map_func is not None:
+            self.post_map_func = self.profiler.profile_function(self.post_map_func, "post_map_func")
+
+        directory_dict = self.input_output_directory_obj.directory_dict
+        for input_output_class_pair in directory_dict:
+            if input_output_class_pair[0] == input_class:
+                directory_dict[input_output_class_pair] = \
+                    self.profiler.profile_input_output_mapper(directory_dict[input_output_class_pair],
+                                                              input_output_class_pair[1].__name__)
+
+        return unprofiled_state
+
+    def _stop_profiling(self, unprofiled_state):
+        self.output_class_func, self.pre_map_func, self.post_map_func, directory_dict = unprofiled_state
+
+        # Carry the rows mapped by the profiled copies over to the rule statistics of the mappers
+        for input_output_class_pair in directory_dict:
+            mapper_obj = directory_dict[input_output_class_pair]
+            profiled_mapper_obj = self.input_output_directory_obj.directory_dict[input_output_class_pair]
+            if profiled_mapper_obj is not mapper_obj and hasattr(mapper_obj, "_map_counter"):
+                mapper_obj._map_counter[0] += profiled_mapper_obj._map_counter[0]
+
+        self.input_output_directory_obj.directory_dict.update(directory_dict)
+
+    def required_input_fields(self):
+        """Fields of the input read by the router, pre_map_func and the rules registered for the input class, or
+        None if these cannot be determined. The router and pre_map_func have to list the fields they read in an
+        attribute input_fields; if either does not every field is read. post_map_func is applied to the mapped row
+        and does not read the input."""
+
+        input_class = self.input_class_realization_obj.input_class.__class__
+
+        fields = set()
+        for input_output_class_pair in self.input_output_directory_obj.directory_dict:
+            if input_output_class_pair[0] == input_class:
+                mapper_obj = self.input_output_directory_obj[input_output_class_pair]
+                if hasattr(mapper_obj, "input_fields"):
+                    fields.update(mapper_obj.input_fields())
+                else:
+                    return None
+
+        for func in [self.pre_map_func, self.output_class_func]:
+            if func is not None:
+                if hasattr(func, "input_fields"):
+                    fields.update(func.input_fields)
+                else:
+                    return None
+
+        return fields
+
+    def _project_input_fields(self):
+        """Have the input realization only materialize the fields which are read"""
+        if self._input_fields_projected:
+            return
+        self._input_fields_projected = True
+
+        fields = self.required_input_fields()
+        if fields is None:
+            logging.info("Cannot determine input fields read; reading all fields")
+        elif self.input_class_realization_obj.project(fields):
+            logging.info("Reading input fields: %s" % sorted(fields, key=str))
+
+    def _log_rule_statistics(self, input_class):
+        """Log the number of mapper evaluations saved by rules sharing results"""
+        for input_output_class_pair in self.input_output_directory_obj.directory_dict:
+            mapper_obj = self.input_output_directory_obj[input_output_class_pair]
+            if input_output_class_pair[0] == input_class and hasattr(mapper_obj, "statistics"):
+                rule_statistics = mapper_obj.statistics()
+                evaluations_saved = sum([rule_statistic["reused"] for rule_statistic in rule_statistics])
+                if evaluations_saved:
+                    logging.info("Rules for %s saved %s mapper evaluations: %s" %
+                                 (input_output_class_pair[1].__name__, evaluations_saved,
+                                  [(rule_statistic["rule"], rule_statistic["shared_with_rule"],
+                                    rule_statistic["reused"])
+                                   for rule_statistic in rule_statistics if rule_statistic["reused"]]))
+
+    def _route(self, row_dict):
+        """Determine the output class of a row and keep a count of rows mapped to each class"""
+        output_class = self.output_class_func(row_dict).__class__
+
+        if output_class in self.mapping_results:
+            self.mapping_results[output_class] += 1
+        else:
+            self.mapping_results[output_class] = 1
+
+        return output_class
+
+    def _output_class_instance(self, output_class):
+        output_class_instance = self.output_directory_obj[output_class]
+
+        if output_class_instance not in self.output_classes_written:
+            self.output_classes_written += [output_class_instance]
+
+        return output_class_instance
+
+    def _run_rows(self, input_class, n_rows, i=0):
+
+        start_time = timer()
+        mapping_context = self.mapping_context
+
+        rows = self.input_class_realization_obj
+        commit_rows = None
+        if self.prefetch_size is not None:
+            rows = self._prefetched_rows(input_class, rows)
+            if self.commit_file_name is not None:
+                # Rows are read ahead of the rows mapped
+                logging.warning("Rows are not committed when lookups are prefetched row by row")
+        elif self.commit_file_name is not None:
+            commit_rows = self.commit_rows
+
+        for row_dict in rows:
+
+            if mapping_context is not None:
+                mapping_context.begin_row()
+
+            if self.pre_map_func is not None:
+                row_dict = self.pre_map_func(row_dict)
+
+            output_class = self._route(row_dict)
+
+            if output_class == NoOutputClass:
                 pass  # logger("Row not mapped" + str(row_dict))
             else:
-                output_class_instance = self.output_directory_obj[output_class]
-
-                if output_class_instance not in self.output_classes_written:
-                    self.output_classes_written += [output_class_instance]
+                output_class_instance = self._output_class_instance(output_class)
 
                 mapper_obj = self.input_output_directory_obj[(input_class, output_class)]
 
@@ -819,28 +3319,860 @@ class RunMapperAgainstSingleInputRealization(RunMapper):
 
                 output_class_instance.write(mapped_row_dict)
 
-                j += 1
+                self.rows_mapped += 1
                 #TODO: will need to add a call back function
 
+            if mapping_context is not None:
+                mapping_context.end_row()
+
             if i % n_rows == 0 and i > 0:
                 end_time = timer()
-                logging.info("Read %s rows and mapped %s rows in %s seconds" % (i, j - 1, end_time - start_time))
+                logging.info("Read %s rows and mapped %s rows in %s seconds" % (i, self.rows_mapped - 1,
+                                                                               end_time - start_time))
                 start_time = end_time
 
             i += 1
 
-        self.rows_run = i
+            if commit_rows is not None and i % commit_rows == 0:
+                self._commit(i)
 
-        global_end_time = timer()
-        total_time = global_end_time - global_start_time
+        return i
 
-        logging.info("Total time %s seconds" % total_time)
-        if i:
-            logging.info("Rate per %s rows: %s" % (n_rows, n_rows * (total_time * 1.0)/i,))
-        else:
-            logging.info("No rows")
+    def _run_batches(self, input_class, n_rows, batch_size, i=0):
+
+        start_time = timer()
+        block = []
+        committed_i = i
+        for row_dict in self.input_class_realization_obj:
+
+            if self.pre_map_func is not None:
+                row_dict = self.pre_map_func(row_dict)
+
+            block += [row_dict]
+            if len(block) == batch_size:
+                self._map_block(input_class, block)
+                block = []
+
+                if self.commit_file_name is not None and i + 1 - committed_i >= self.commit_rows:
+                    self._commit(i + 1)
+                    committed_i = i + 1
+
+            if i % n_rows == 0 and i > 0:
+                end_time = timer()
+                logging.info("Read %s rows and mapped %s rows in %s seconds" % (i, self.rows_mapped,
+                                                                               end_time - start_time))
+                start_time = end_time
+
+            i += 1
+
+        if len(block):
+            self._map_block(input_class, block)
+
+        return i
+
+    def _prefetched_rows(self, input_class, rows):
+        """Read rows ahead in blocks of prefetch_size rows and prefetch their lookups"""
+        block = []
+        for row_dict in rows:
+            block.append(row_dict)
+            if len(block) == self.prefetch_size:
+                self._prefetch(input_class, block)
+                for block_row_dict in block:
+                    yield block_row_dict
+                block = []
+
+        if len(block):
+            self._prefetch(input_class, block)
+            for block_row_dict in block:
+                yield block_row_dict
+
+    def _prefetch(self, input_class, block):
+        """Prefetch the lookups of the rules registered for the input class for a block of rows"""
+        prefetched = set()
+        for input_output_class_pair in self.input_output_directory_obj.directory_dict:
+            if input_output_class_pair[0] != input_class:
+                continue
+
+            mapper_obj = self.input_output_directory_obj[input_output_class_pair]
+            for field, mapper_instance in getattr(mapper_obj, "field_mapper_instances", []):
+                if mapper_instance.__class__ != InputOutputMapperInstance or \
+                        mapper_instance.map_function.__class__ == IdentityMapper:
+                    continue
+
+                if field.__class__ != tuple:
+                    field = (field,)
+
+                if (field, id(mapper_instance.map_function)) in prefetched:
+                    continue
+                prefetched.add((field, id(mapper_instance.map_function)))
 
+                try:
+                    input_columns = {single_field: [row_dict[single_field] for row_dict in block]
+                                     for single_field in field}
+                except KeyError:
+                    continue
+
+                prefetch_lookups(mapper_instance.map_function, input_columns, len(block))
+
+    def _map_block(self, input_class, block):
+        """Route a block of rows and map the rows for each output class as columns. A mapping context holds
+        results for the whole block."""
+
+        if self.prefetch_size is not None:
+            self._prefetch(input_class, block)
+
+        if self.mapping_context is not None:
+            self.mapping_context.begin_row()
+
+        rows_by_output_class = {}
+        for row_dict in block:
+            output_class = self._route(row_dict)
+            if output_class != NoOutputClass:
+                if output_class in rows_by_output_class:
+                    rows_by_output_class[output_class] += [row_dict]
+                else:
+                    rows_by_output_class[output_class] = [row_dict]
+
+        for output_class in rows_by_output_class:
+            rows = rows_by_output_class[output_class]
+            output_class_instance = self._output_class_instance(output_class)
+            mapper_obj = self.input_output_directory_obj[(input_class, output_class)]
+
+            if hasattr(mapper_obj, "map_batch"):
+                input_columns = {}
+                for field in mapper_obj.input_fields():
+                    try:
+                        input_columns[field] = [row_dict[field] for row_dict in rows]
+                    except KeyError:
+                        logging.error("Cannot find key %s" % field)
+                        raise
+                mapped_rows = mapper_obj.map_batch(input_columns, len(rows))
+            else:
+                mapped_rows = [mapper_obj.map(row_dict) for row_dict in rows]
+
+            for mapped_row_dict in mapped_rows:
+                if self.post_map_func is not None:
+                    mapped_row_dict = self.post_map_func(mapped_row_dict)
+
+                output_class_instance.write(mapped_row_dict)
+
+            self.rows_mapped += len(rows)
+
+        if self.mapping_context is not None:
+            self.mapping_context.end_row()
+
+    def run_parallel(self, n_workers=None, n_shards=None, n_rows=10000, batch_size=None):
+        """Split the input CSV file into byte range shards and map each shard in a separate worker process. The
+        shard outputs are appended in order to the registered output realizations so that the result including
+        ':row_id' is identical to that of run(). Workers are forked so routers, rules and post_map_func can be
+        closures."""
+
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+
+        if n_shards is None:
+            n_shards = 4 * n_workers
+
+        try:
+            mp_context = multiprocessing.get_context("fork")
+        except ValueError:
+            logging.warning("Forking processes is not supported; running mapper in a single process")
+            return self.run(n_rows=n_rows, batch_size=batch_size)
+
+        csv_file_name = self.input_class_realization_obj.csv_file_name
+        shards = compute_csv_shards(csv_file_name, n_shards)
+
+        global_start_time = timer()
+        logging.info("Mapping input %s in %s shards with %s workers" %
+                     (self.input_class_realization_obj.input_class.__class__, len(shards), n_workers))
+
+        if self.project_input_fields:
+            self._project_input_fields()
+
+        if self.profiler is not None:
+            logging.warning("Mappers are not profiled when run in parallel")
+
+        for output_class_inst in self.output_directory_obj.directory_dict.values():
+            output_class_inst.flush()  # Do not let forked workers inherit unwritten buffers
+
+        global _sharded_runner_obj
+        _sharded_runner_obj = self
+        try:
+            with mp_context.Pool(n_workers) as pool:
+                shard_row_counts = pool.starmap(_count_csv_rows, [(csv_file_name,) + shard for shard in shards])
+
+                shard_arguments = []
+                start_row_id = 1
+                for k in range(len(shards)):
+                    start_offset, end_offset = shards[k]
+                    shard_arguments += [(k, start_offset, end_offset, start_row_id, n_rows, batch_size)]
+                    start_row_id += shard_row_counts[k]
+
+                shard_results = pool.starmap(_run_shard, shard_arguments)
+
+            mapping_results = {}
+            rows_run = 0
+            for shard_rows_run, shard_mapping_results, shard_output_files, shard_profiles in shard_results:
+                merge_warm_start_profiles(shard_profiles)
+                rows_run += shard_rows_run
+                for output_class in shard_mapping_results:
+                    if output_class in mapping_results:
+                        mapping_results[output_class] += shard_mapping_results[output_class]
+                    else:
+                        mapping_results[output_class] = shard_mapping_results[output_class]
+
+                for output_class, shard_csv_file_name in shard_output_files:
+                    output_class_instance = self.output_directory_obj[output_class]
+                    if output_class_instance not in self.output_classes_written:
+                        self.output_classes_written += [output_class_instance]
+                    output_class_instance.append_csv_file(shard_csv_file_name)
+        finally:
+            _sharded_runner_obj = None
+            for output_class_inst in self.output_directory_obj.directory_dict.values():
+                for shard_csv_file_name in glob.glob(glob.escape(output_class_inst.csv_file_name) + ".shard*"):
+                    os.remove(shard_csv_file_name)
+
+        self.rows_run = rows_run
+        self.mapping_results = mapping_results
+
+        logging.info("Total time %s seconds" % (timer() - global_start_time))
         logging.info("%s" % mapping_results)
 
         for output_class_inst in self.output_classes_written:
             output_class_inst.close()
+
+        save_warm_start_profiles()
+
+    def run_pipelined(self, n_rows=10000, batch_size=None, chunk_size=1000, queue_size=4):
+        """Map with the input read by a reader thread and each output written by its own writer thread. Rows are
+        passed between threads in chunks of chunk_size rows through queues holding at most queue_size chunks, which
+        bounds memory. An error in the reader or a writer is raised in the calling thread. Rows are not committed
+        as the reader runs ahead of the rows mapped."""
+
+        if self.project_input_fields:
+            self._project_input_fields()
+
+        input_class_realization_obj = self.input_class_realization_obj
+        output_directory_obj = self.output_directory_obj
+        commit_file_name = self.commit_file_name
+        self.commit_file_name = None
+
+        pipeline_reader_obj = _PipelineReader(input_class_realization_obj, chunk_size, queue_size)
+        pipeline_output_directory_obj = _PipelineOutputClassDirectory(output_directory_obj, chunk_size, queue_size)
+
+        self.input_class_realization_obj = pipeline_reader_obj
+        self.output_directory_obj = pipeline_output_directory_obj
+        try:
+            self.run(n_rows=n_rows, batch_size=batch_size)
+        finally:
+            pipeline_reader_obj.stop()
+            for pipeline_writer_obj in pipeline_output_directory_obj.directory_dict.values():
+                pipeline_writer_obj.stop()
+
+            self.input_class_realization_obj = input_class_realization_obj
+            self.output_directory_obj = output_directory_obj
+            self.commit_file_name = commit_file_name
+            self.output_classes_written = [output_class_inst.output_realization_obj
+                                           if output_class_inst.__class__ == _PipelineWriter else output_class_inst
+                                           for output_class_inst in self.output_classes_written]
+
+
+class _ShardOutputClassDirectory(OutputClassDirectory):
+    """Creates, on first use, a realization writing to a shard file for each output class"""
+
+    def __init__(self, output_directory_obj, shard_suffix):
+        super().__init__()
+        self.output_directory_obj = output_directory_obj
+        self.shard_suffix = shard_suffix
+
+    def __getitem__(self, item):
+        if item not in self.directory_dict:
+            output_class_instance = self.output_directory_obj[item]
+            self.directory_dict[item] = output_class_instance.shard(output_class_instance.csv_file_name +
+                                                                    self.shard_suffix)
+        return self.directory_dict[item]
+
+
+_sharded_runner_obj = None  # Set by the parent process before the workers are forked
+
+
+def _run_shard(shard_index, start_offset, end_offset, start_row_id, n_rows, batch_size):
+    """Map a single shard in a worker process"""
+    runner_obj = copy.copy(_sharded_runner_obj)
+    runner_obj.input_class_realization_obj = runner_obj.input_class_realization_obj.shard(start_offset, end_offset,
+                                                                                          start_row_id)
+    shard_output_directory_obj = _ShardOutputClassDirectory(runner_obj.output_directory_obj,
+                                                            ".shard%04d" % shard_index)
+    runner_obj.output_directory_obj = shard_output_directory_obj
+    runner_obj.output_classes_written = []
+    runner_obj.mapping_results = {}
+    runner_obj.profiler = None
+    runner_obj.commit_file_name = None
+    # Counts inherited from the parent or from an earlier shard would be added to the parent's counts again
+    _reset_warm_start_hit_counts()
+    runner_obj.run(n_rows=n_rows, batch_size=batch_size)
+
+    shard_output_files = [(output_class, shard_output_directory_obj[output_class].csv_file_name)
+                          for output_class in shard_output_directory_obj.directory_dict]
+
+    # atexit handlers are not run when a worker process exits so the profiles are returned to the parent
+    return runner_obj.rows_run, runner_obj.mapping_results, shard_output_files, warm_start_profiles()
+
+
+_end_of_queue = object()
+
+
+class _PipelineReader(object):
+    """Reads an input realization in a separate thread and passes chunks of rows through a bounded queue"""
+
+    def __init__(self, input_class_realization_obj, chunk_size, queue_size):
+        self.input_class_realization_obj = input_class_realization_obj
+        self.input_class = input_class_realization_obj.input_class
+        self.chunk_size = chunk_size
+
+        self.chunk_queue = queue.Queue(queue_size)
+        self.stop_event = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._read, name="pipeline_reader", daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        try:
+            chunk = []
+            for row_dict in self.input_class_realization_obj:
+                chunk.append(row_dict)
+                if len(chunk) == self.chunk_size:
+                    if not self._put(chunk):
+                        return
+                    chunk = []
+            if len(chunk):
+                self._put(chunk)
+        except BaseException as e:
+            self.error = e
+        self._put(_end_of_queue)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunk_queue.get()
+            if chunk is _end_of_queue:
+                if self.error is not None:
+                    raise self.error
+                return
+            for row_dict in chunk:
+                yield row_dict
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class _PipelineWriter(object):
+    """Writes rows to an output realization in a separate thread. Rows are passed in chunks through a bounded
+    queue."""
+
+    def __init__(self, output_realization_obj, chunk_size, queue_size):
+        self.output_realization_obj = output_realization_obj
+        self.chunk_size = chunk_size
+
+        self.chunk = []
+        self.chunk_queue = queue.Queue(queue_size)
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._write, name="pipeline_writer", daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            chunk = self.chunk_queue.get()
+            if chunk is _end_of_queue:
+                return
+            if self.error is None:  # After an error keep draining the queue so that write() does not block
+                try:
+                    for row_dict in chunk:
+                        self.output_realization_obj.write(row_dict)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, row_dict):
+        self.chunk.append(row_dict)
+        if len(self.chunk) == self.chunk_size:
+            if self.error is not None:
+                raise self.error
+            self.chunk_queue.put(self.chunk)
+            self.chunk = []
+
+    def stop(self):
+        """Wait for the queued rows to be written"""
+        if not self.closed:
+            self.closed = True
+            if len(self.chunk):
+                self.chunk_queue.put(self.chunk)
+                self.chunk = []
+            self.chunk_queue.put(_end_of_queue)
+            self.thread.join()
+
+    def close(self):
+        self.stop()
+        if self.error is not None:
+            raise self.error
+        self.output_realization_obj.close()
+
+    def __getattr__(self, item):
+        return getattr(self.output_realization_obj, item)
+
+
+class _PipelineOutputClassDirectory(OutputClassDirectory):
+    """Creates, on first use, a writer thread for each output class"""
+
+    def __init__(self, output_directory_obj, chunk_size, queue_size):
+        super().__init__()
+        self.output_directory_obj = output_directory_obj
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+
+    def __getitem__(self, item):
+        if item not in self.directory_dict:
+            self.directory_dict[item] = _PipelineWriter(self.output_directory_obj[item], self.chunk_size,
+                                                        self.queue_size)
+        return self.directory_dict[item]
+
+
+def committed_file_name(csv_file_name):
+    return csv_file_name + ".committed"
+
+
+def read_commit(commit_file_name):
+    if os.path.exists(commit_file_name):
+        try:
+            with open(commit_file_name) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+    else:
+        return None
+
+
+def discard_commit(commit_file_name):
+    """Remove a commit file and the committed output files moved aside for it"""
+    commit_dict = read_commit(commit_file_name)
+    if commit_dict is not None:
+        for csv_file_name in commit_dict["outputs"]:
+            if os.path.exists(committed_file_name(csv_file_name)):
+                os.remove(committed_file_name(csv_file_name))
+
+    if os.path.exists(commit_file_name):
+        os.remove(commit_file_name)
+
+
+def prepare_resume(commit_file_name):
+    """Truncate the output files recorded in a commit file to their committed size and move them aside, before
+    the output realizations which recreate them are created, so that the run can append them when it resumes. A
+    file already moved aside by an earlier attempt is kept. Returns the commit or None if there is none."""
+    commit_dict = read_commit(commit_file_name)
+    if commit_dict is None:
+        return None
+
+    for csv_file_name, committed_size in commit_dict["outputs"].items():
+        if os.path.exists(committed_file_name(csv_file_name)):
+            continue
+        if not os.path.exists(csv_file_name) or os.path.getsize(csv_file_name) < committed_size:
+            logging.warning("Committed rows of '%s' are missing; mapping from the first row" % csv_file_name)
+            discard_commit(commit_file_name)
+            return None
+
+        with open(csv_file_name, "r+b") as f:
+            f.truncate(committed_size)
+        os.replace(csv_file_name, committed_file_name(csv_file_name))
+
+    return commit_dict
+
+
+class MappingStage(object):
+    """A stage of a mapping which stage_function runs. The stage_function is called with a config dict and a dict of
+    the outputs of earlier stages named in inputs, and returns a dict with a value for each name in outputs. Names in
+    inputs which no stage outputs, such as source files, are external to the graph."""
+
+    def __init__(self, name, stage_function, inputs=None, outputs=None):
+        self.name = name
+        self.stage_function = stage_function
+
+        if inputs is None:
+            inputs = []
+        if outputs is None:
+            outputs = []
+
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def __repr__(self):
+        return "MappingStage(%r, inputs=%r, outputs=%r)" % (self.name, self.inputs, self.outputs)
+
+
+def _execute_stage(stage_obj, config, stage_inputs, checkpoints=None):
+    """Run a stage and return its outputs, the seconds it took and the lookup files opened by its mappers"""
+    start_time = timer()
+    if checkpoints is not None:
+        checkpoints.prepare_stage(stage_obj.name)
+
+    lookup_files_opened.clear()
+    stage_outputs = stage_obj.stage_function(config, stage_inputs)
+    return stage_outputs, timer() - start_time, sorted(lookup_files_opened)
+
+
+def _run_stage(stage_obj, config, stage_inputs, checkpoints=None):
+    """Run a single stage in a worker process. Id maps which were persisted are returned as the file name of their
+    JSON map, which the stages depending on them open, rather than pickled."""
+    stage_outputs, stage_time, lookup_file_names = _execute_stage(stage_obj, config, stage_inputs, checkpoints)
+    if stage_outputs is not None:
+        for output_name, output_value in list(stage_outputs.items()):
+            if output_value.__class__ == SourceValueIdMap and output_value.json_file_name is not None:
+                stage_outputs[output_name] = output_value.json_file_name
+
+    # atexit handlers are not run when a worker process exits
+    save_warm_start_profiles()
+    return stage_outputs, stage_time, lookup_file_names
+
+
+class StageCheckpoints(object):
+    """Completion checkpoints of the stages of a MappingStageGraph kept in checkpoint_directory. A checkpoint holds
+    the pickled outputs of a stage and has a manifest of its input files in input_directory, the checkpoints of the
+    stages it depends on and the files they pass to it, the lookup files its code mappers opened and the files it
+    wrote, built with the options in build_options[stage name]. A stage whose checkpoint is current is skipped and
+    its outputs are loaded from the checkpoint. With resume a stage which did not finish continues from the last
+    rows its runner committed."""
+
+    def __init__(self, checkpoint_directory, input_directory=None, build_options=None, resume=False):
+        self.checkpoint_directory = checkpoint_directory
+        self.input_directory = input_directory
+        if build_options is None:
+            build_options = {}
+        self.build_options = build_options
+        self.resume = resume
+
+        if not os.path.exists(checkpoint_directory):
+            os.makedirs(checkpoint_directory)
+
+    def checkpoint_file_name(self, stage_name):
+        return os.path.join(self.checkpoint_directory, stage_name + ".checkpoint")
+
+    def commit_file_name(self, stage_name):
+        return os.path.join(self.checkpoint_directory, stage_name + ".commit.json")
+
+    def prepare_stage(self, stage_name):
+        """Before a stage runs prepare to resume it from its committed rows or discard them"""
+        if self.resume:
+            prepare_resume(self.commit_file_name(stage_name))
+        else:
+            discard_commit(self.commit_file_name(stage_name))
+
+    def _source_file_names(self, stage_obj, producers, stage_inputs, lookup_file_names, output_file_names):
+        source_file_names = []
+        for input_name in stage_obj.inputs:
+            if input_name in producers:
+                source_file_names += [self.checkpoint_file_name(producers[input_name])]
+                # A file passed on, such as a persisted id map, may change while the checkpoint pickle does not
+                input_value = stage_inputs.get(input_name)
+                if input_value.__class__ == str and os.path.isfile(input_value):
+                    source_file_names += [input_value]
+            elif self.input_directory is not None and os.path.isfile(os.path.join(self.input_directory, input_name)):
+                source_file_names += [os.path.join(self.input_directory, input_name)]
+
+        source_file_names += list(lookup_file_names) + list(output_file_names)
+
+        unique_source_file_names = []
+        for source_file_name in source_file_names:
+            if source_file_name not in unique_source_file_names:
+                unique_source_file_names += [source_file_name]
+        return unique_source_file_names
+
+    def current_outputs(self, stage_obj, producers, stage_inputs):
+        """Return the outputs of a stage run with stage_inputs from its checkpoint or None if the checkpoint is not
+        current"""
+        checkpoint_file_name = self.checkpoint_file_name(stage_obj.name)
+        manifest_dict = read_artifact_manifest(checkpoint_file_name)
+        if manifest_dict is None or manifest_dict.get("build_summary") is None:
+            return None
+
+        build_summary = manifest_dict["build_summary"]
+        source_file_names = self._source_file_names(stage_obj, producers, stage_inputs, build_summary["lookup_files"],
+                                                    build_summary["output_files"])
+        rebuild_reason = artifact_rebuild_reason(checkpoint_file_name, source_file_names,
+                                                 self.build_options.get(stage_obj.name))
+        if rebuild_reason is not None:
+            logging.info("Checkpoint of stage '%s' %s" % (stage_obj.name, rebuild_reason))
+            return None
+
+        with open(checkpoint_file_name, "rb") as f:
+            stage_outputs = pickle.load(f)
+
+        if len([output_name for output_name in stage_obj.outputs if output_name not in stage_outputs]):
+            return None
+
+        return stage_outputs
+
+    def write(self, stage_obj, producers, stage_inputs, stage_outputs, stage_seconds, lookup_file_names):
+        """Checkpoint a stage which completed"""
+        checkpoint_file_name = self.checkpoint_file_name(stage_obj.name)
+        output_file_names = [stage_outputs[output_name] for output_name in stage_obj.outputs
+                             if stage_outputs[output_name].__class__ == str
+                             and os.path.isfile(stage_outputs[output_name])]
+
+        temp_file_name = checkpoint_file_name + ".%s.tmp" % os.getpid()
+        with open(temp_file_name, "wb") as fw:
+            pickle.dump(stage_outputs, fw)
+        os.replace(temp_file_name, checkpoint_file_name)
+
+        write_artifact_manifest(checkpoint_file_name,
+                                self._source_file_names(stage_obj, producers, stage_inputs, lookup_file_names,
+                                                        output_file_names),
+                                stage_seconds, self.build_options.get(stage_obj.name),
+                                {"lookup_files": lookup_file_names, "output_files": output_file_names})
+
+
+class MappingStageGraph(object):
+    """Stages connected by their inputs and outputs into a directed acyclic graph. Stages whose inputs are
+    available run concurrently in a pool of max_workers processes. With a single worker the stages run in
+    the current process in the order they were added, limited by their inputs. With StageCheckpoints stages
+    whose checkpoint is current are skipped. lookup_files(config, stage_name) returns the JSON files a stage looks
+    up in SQLite databases, which are built once before stages run concurrently."""
+
+    def __init__(self, stages=None, lookup_files=None):
+        self.stages = []
+        self.producers = {}
+        self.lookup_files = lookup_files
+        if stages is not None:
+            for stage_obj in stages:
+                self.add(stage_obj)
+
+    def add(self, stage_obj):
+        for output_name in stage_obj.outputs:
+            if output_name in self.producers:
+                raise ValueError("Output '%s' of stage '%s' is also an output of stage '%s'"
+                                 % (output_name, stage_obj.name, self.producers[output_name]))
+
+        for output_name in stage_obj.outputs:
+            self.producers[output_name] = stage_obj.name
+
+        self.stages += [stage_obj]
+
+    def dependencies(self):
+        """Return a dict of the names of the stages each stage depends on"""
+        return {stage_obj.name: set([self.producers[input_name] for input_name in stage_obj.inputs
+                                     if input_name in self.producers])
+                for stage_obj in self.stages}
+
+    def execution_order(self):
+        """Return the names of the stages in the order a single worker runs them"""
+        dependencies = self.dependencies()
+        completed = []
+        while len(completed) < len(self.stages):
+            ready = [stage_obj.name for stage_obj in self.stages if stage_obj.name not in completed
+                     and dependencies[stage_obj.name].issubset(completed)]
+            if not len(ready):
+                raise ValueError("Stages %s have circular inputs"
+                                 % [stage_obj.name for stage_obj in self.stages if stage_obj.name not in completed])
+            completed += [ready[0]]
+
+        return completed
+
+    def _stage_inputs(self, stage_obj, outputs):
+        return {input_name: outputs[input_name] for input_name in stage_obj.inputs if input_name in self.producers}
+
+    def _add_outputs(self, stage_obj, stage_outputs, outputs, stage_time):
+        if stage_outputs is None:
+            stage_outputs = {}
+
+        missing_outputs = [output_name for output_name in stage_obj.outputs if output_name not in stage_outputs]
+        if len(missing_outputs):
+            raise RuntimeError("Stage '%s' did not return outputs %s" % (stage_obj.name, missing_outputs))
+
+        for output_name in stage_obj.outputs:
+            outputs[output_name] = stage_outputs[output_name]
+
+        logging.info("Stage '%s' completed in %.2f seconds" % (stage_obj.name, stage_time))
+
+    def _add_checkpointed_outputs(self, stage_obj, outputs, checkpoints):
+        """Add the outputs of a stage whose checkpoint is current. Returns False if the stage has to run."""
+        if checkpoints is None:
+            return False
+
+        stage_outputs = checkpoints.current_outputs(stage_obj, self.producers, self._stage_inputs(stage_obj, outputs))
+        if stage_outputs is None:
+            return False
+
+        for output_name in stage_obj.outputs:
+            outputs[output_name] = stage_outputs[output_name]
+
+        logging.info("Skipping stage '%s' as its checkpoint is current" % stage_obj.name)
+        return True
+
+    def _complete_stage(self, stage_obj, stage_result, outputs, checkpoints):
+        stage_outputs, stage_time, lookup_file_names = stage_result
+        self._add_outputs(stage_obj, stage_outputs, outputs, stage_time)
+        if checkpoints is not None:
+            checkpoints.write(stage_obj, self.producers, self._stage_inputs(stage_obj, outputs), stage_outputs,
+                              stage_time, lookup_file_names)
+
+    def build_lookup_artifacts(self, config):
+        """Build, or check that they are current, the SQLite databases of the lookup files of the stages"""
+        json_file_names = []
+        if self.lookup_files is not None:
+            for stage_obj in self.stages:
+                for json_file_name in self.lookup_files(config, stage_obj.name):
+                    if json_file_name not in json_file_names and os.path.exists(json_file_name):
+                        json_file_names += [json_file_name]
+
+        for json_file_name in json_file_names:
+            build_sqlite_lookup_artifact(json_file_name, lookup_build_defaults["non_unique_key_policy"])
+
+        return json_file_names
+
+    def _run_serial(self, config, checkpoints):
+        stages_dict = {stage_obj.name: stage_obj for stage_obj in self.stages}
+        outputs = {}
+        for stage_name in self.execution_order():
+            stage_obj = stages_dict[stage_name]
+            if self._add_checkpointed_outputs(stage_obj, outputs, checkpoints):
+                continue
+
+            logging.info("Starting stage '%s'" % stage_name)
+            stage_result = _execute_stage(stage_obj, config, self._stage_inputs(stage_obj, outputs), checkpoints)
+            self._complete_stage(stage_obj, stage_result, outputs, checkpoints)
+        return outputs
+
+    def run(self, config, max_workers=1, checkpoints=None):
+        """Run the stages and return a dict of their outputs"""
+        if max_workers is None or max_workers <= 1:
+            return self._run_serial(config, checkpoints)
+
+        try:
+            mp_context = multiprocessing.get_context("fork")
+        except ValueError:
+            logging.warning("Forking processes is not supported; running stages in a single process")
+            return self._run_serial(config, checkpoints)
+
+        # Stages running concurrently would each build the same databases
+        self.build_lookup_artifacts(config)
+
+        execution_order = self.execution_order()
+        stages_dict = {stage_obj.name: stage_obj for stage_obj in self.stages}
+        outputs = {}
+        dependencies = self.dependencies()
+        completed = []
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=mp_context) as executor:
+            while len(completed) < len(self.stages):
+                ready = [stage_name for stage_name in execution_order if stage_name not in completed and
+                         stage_name not in running.values() and dependencies[stage_name].issubset(completed)]
+
+                skipped = False
+                for stage_name in ready:
+                    stage_obj = stages_dict[stage_name]
+                    if self._add_checkpointed_outputs(stage_obj, outputs, checkpoints):
+                        completed += [stage_name]
+                        skipped = True
+                    else:
+                        logging.info("Starting stage '%s'" % stage_name)
+                        future = executor.submit(_run_stage, stage_obj, config,
+                                                 self._stage_inputs(stage_obj, outputs), checkpoints)
+                        running[future] = stage_name
+
+                if skipped:  # Stages depending on the skipped stages may be ready
+                    continue
+
+                done, not_done = concurrent.futures.wait(list(running.keys()),
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage_name = running.pop(future)
+                    try:
+                        stage_result = future.result()
+                    except Exception:
+                        logging.error("Stage '%s' failed" % stage_name)
+                        for running_future in running:
+                            running_future.cancel()
+                        raise
+
+                    self._complete_stage(stages_dict[stage_name], stage_result, outputs, checkpoints)
+                    completed += [stage_name]
+
+        return outputs
+
+
+class IdRangeAllocator(object):
+    """Assigns each (stage, table) pair a disjoint range of IDs before the stages run. Ranges of a table follow
+    each other in the order they are reserved so that the same reservations give the same IDs. A stage adds the
+    offset of its range to ':row_id', which starts at 1. table_offsets, {table: offset}, start the ranges of a
+    table after IDs which are already in use."""
+
+    def __init__(self, block_size=None, table_offsets=None):
+        self.block_size = block_size
+        self.id_ranges = {}
+        if table_offsets is None:
+            self.table_sizes = {}
+        else:
+            self.table_sizes = dict(table_offsets)
+
+    def reserve(self, stage_name, table_name, n_ids=None):
+        """Reserve n_ids IDs of table_name for stage_name, or block_size IDs if it is set. Returns the offset."""
+        if (stage_name, table_name) in self.id_ranges:
+            raise ValueError("IDs of '%s' are already reserved for stage '%s'" % (table_name, stage_name))
+
+        if self.block_size is not None:
+            n_ids = self.block_size
+        elif n_ids is None:
+            raise ValueError("Reserving IDs of '%s' for stage '%s' needs n_ids or a block_size"
+                             % (table_name, stage_name))
+
+        offset = self.table_sizes.get(table_name, 0)
+        self.id_ranges[(stage_name, table_name)] = (offset, n_ids)
+        self.table_sizes[table_name] = offset + n_ids
+        return offset
+
+    def reserve_csv_rows(self, stage_name, table_names, csv_file_name):
+        """Reserve an ID of each table for each row of the stage's input file"""
+        if self.block_size is not None:
+            n_ids = None
+        elif os.path.exists(csv_file_name):
+            n_ids = count_csv_rows(csv_file_name)
+        else:
+            n_ids = 0
+        for table_name in table_names:
+            self.reserve(stage_name, table_name, n_ids)
+
+    def offset(self, stage_name, table_name):
+        return self.id_ranges[(stage_name, table_name)][0]
+
+    def offset_and_max_id(self, stage_name, table_name):
+        """Return the offset and the last ID of the range, the start_i and max_i of a row_map_offset"""
+        offset, n_ids = self.id_ranges[(stage_name, table_name)]
+        return offset, offset + n_ids
+
+    def id_range(self, stage_name, table_name):
+        """Return the first and last ID of the range"""
+        offset, n_ids = self.id_ranges[(stage_name, table_name)]
+        return offset + 1, offset + n_ids
+
+    def stage_id_ranges(self, stage_name):
+        """Return [table, offset, n_ids] of each range reserved for a stage"""
+        return sorted([[table_name, offset, n_ids]
+                       for (range_stage_name, table_name), (offset, n_ids) in self.id_ranges.items()
+                       if range_stage_name == stage_name])
+
+    def check_rows_run(self, stage_name, rows_run):
+        """Raise an error if a stage mapped more rows than the IDs reserved for it. IDs mapped with the max_i of
+        offset_and_max_id() already raise when the row is mapped."""
+        for (range_stage_name, table_name), (offset, n_ids) in self.id_ranges.items():
+            if range_stage_name == stage_name and rows_run > n_ids:
+                raise RuntimeError("Stage '%s' mapped %s rows but only %s IDs of '%s' are reserved"
+                                   % (stage_name, rows_run, n_ids, table_name))
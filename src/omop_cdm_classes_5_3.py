@@ -51,6 +51,9 @@ class VisitDetailObject(OutputClass):
                 "preceding_visit_detail_id", "visit_source_value", "visit_source_concept_id", "admitting_source_value",
                 "discharge_to_source_value", "visit_detail_parent_id", "visit_occurrence_id"]
 
+    def table_name(self):
+        return "visit_detail"
+
 
 class DrugStrengthObject(OutputClass):
     def fields(self):
@@ -1,5 +1,7 @@
-from mapping_classes import MapperClass, InputClassCSVRealization, OutputClassCSVRealization, \
-    build_input_output_mapper, RunMapperAgainstSingleInputRealization, CaseInsensitiveDictReader
+from mapping_classes import MapperClass, InputClassCSVRealization, InputClassCSVTupleRealization, \
+    OutputClassCSVRealization, build_input_output_mapper, RunMapperAgainstSingleInputRealization, \
+    CaseInsensitiveDictReader, \
+    map_batch_by_distinct_values, write_sorted_key_lookup, write_artifact_manifest, lookup_build_defaults
 import time
 import csv
 import os
@@ -103,7 +105,10 @@ def convert_datetime(datetime_str):
         return time.strftime('%Y-%m-%d %H:%M:%S', localized_datetime)
 
 
-def create_json_map_from_csv_file(csv_file_name, lookup_field_name, lookup_value_field_name, json_file_name=None):
+def create_json_map_from_csv_file(csv_file_name, lookup_field_name, lookup_value_field_name, json_file_name=None,
+                                  sorted_key_lookup=True):
+    """Write a JSON map of lookup_field_name to {lookup_value_field_name: value}. With sorted_key_lookup a
+    memory mapped sorted key lookup file is also written which CoderMapperJSONClass reads in place of the JSON"""
 
     if json_file_name is None:
         json_file_name = csv_file_name + ".json"
@@ -127,9 +132,29 @@ def create_json_map_from_csv_file(csv_file_name, lookup_field_name, lookup_value
                 map_value = row_dict[lookup_value_field_name]
                 map_dict[map_key] = {lookup_value_field_name: map_value}
 
+    return write_json_map(map_dict, json_file_name, sorted_key_lookup)
+
+
+def write_json_map_from_id_map(id_map, json_file_name, sorted_key_lookup=True):
+    """Persist a SourceValueIdMap captured while a CDM file was written as the JSON map, and sorted key lookup,
+    which create_json_map_from_csv_file writes from the file"""
+    id_map.json_file_name = write_json_map(dict(id_map.items()), json_file_name, sorted_key_lookup)
+    return id_map.json_file_name
+
+
+def write_json_map(map_dict, json_file_name, sorted_key_lookup=True):
     with open(json_file_name, "w") as fwj:
         json.dump(map_dict, fwj)
 
+    if sorted_key_lookup:
+        start_time = time.time()
+        write_sorted_key_lookup(((key, json.dumps(map_dict[key])) for key in map_dict), json_file_name + ".skl")
+        # Values are never lists so the sorted key lookup is current for the default non-unique key policy
+        write_artifact_manifest(json_file_name + ".skl", [json_file_name], time.time() - start_time,
+                                {"non_unique_key_policy": lookup_build_defaults["non_unique_key_policy"]})
+    elif os.path.exists(json_file_name + ".skl"):
+        os.remove(json_file_name + ".skl")
+
     return os.path.abspath(json_file_name)
 
 
@@ -157,6 +182,9 @@ class SplitDateTimeWithTZ(MapperClass):
         else:
             return {}
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class DateTimeWithTZ(MapperClass):
 
@@ -180,6 +208,9 @@ class DateTimeWithTZ(MapperClass):
 
         return {"datetime": datetime_local}
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class DateTimeWithTZDebug(MapperClass):
 
@@ -237,6 +268,9 @@ class MapDateTimeToUnixEpochSeconds(MapperClass):
         else:
             return {}
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class FloatMapper(MapperClass):
     """Convert value to float"""
@@ -252,6 +286,9 @@ class FloatMapper(MapperClass):
 
         return resulting_map
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class IntFloatMapper(MapperClass):
     """Convert value to int or float"""
@@ -270,15 +307,23 @@ class IntFloatMapper(MapperClass):
 
         return resulting_map
 
+    def map_batch(self, input_columns, n_rows):
+        return map_batch_by_distinct_values(self, input_columns, n_rows)
+
 
 class row_map_offset(MapperClass):
+    """Maps ':row_id' to an ID starting after start_i. An ID past max_i, the last ID reserved, raises an error."""
 
-    def __init__(self, field_name, start_i=0):
+    def __init__(self, field_name, start_i=0, max_i=None):
         self.start_i = start_i
+        self.max_i = max_i
         self.field_name = field_name
 
     def map(self, input_dict):
-        return {self.field_name: input_dict[":row_id"] + self.start_i}
+        row_id = input_dict[":row_id"] + self.start_i
+        if self.max_i is not None and row_id > self.max_i:
+            raise RuntimeError("'%s' %s is past the last reserved ID %s" % (self.field_name, row_id, self.max_i))
+        return {self.field_name: row_id}
 
 
 def get_largest_id_from_csv_file(csv_file_name, primary_key_field_name):
@@ -301,13 +346,15 @@ def capitalize_words_and_normalize_spacing(input_string):
 
 
 def generate_mapper_obj(input_csv_file_name, input_class_obj, output_csv_file_name, output_class_obj, map_rules_list,
-                        output_obj, in_out_map_obj, input_router_func=None, pre_map_func=None, post_map_func=None):
+                        output_obj, in_out_map_obj, input_router_func=None, pre_map_func=None, post_map_func=None,
+                        mapping_context=None, project_input_fields=False, id_map_fields=None):
 
     if input_router_func is None:
         input_router_func = lambda x: output_class_obj
 
-    input_csv_class_obj = InputClassCSVRealization(input_csv_file_name, input_class_obj)
-    output_csv_class_obj = OutputClassCSVRealization(output_csv_file_name, output_class_obj)
+    input_csv_class_obj = InputClassCSVTupleRealization(input_csv_file_name, input_class_obj)
+    output_csv_class_obj = OutputClassCSVRealization(output_csv_file_name, output_class_obj,
+                                                     id_map_fields=id_map_fields)
 
     map_rules_obj = build_input_output_mapper(map_rules_list)
 
@@ -316,7 +363,9 @@ def generate_mapper_obj(input_csv_file_name, input_class_obj, output_csv_file_na
     in_out_map_obj.register(input_class_obj, output_class_obj, map_rules_obj)
 
     map_runner_obj = RunMapperAgainstSingleInputRealization(input_csv_class_obj, in_out_map_obj, output_obj,
-                                                            input_router_func, pre_map_func, post_map_func)
+                                                            input_router_func, pre_map_func, post_map_func,
+                                                            mapping_context=mapping_context,
+                                                            project_input_fields=project_input_fields)
 
     return map_runner_obj
 
@@ -325,7 +374,7 @@ def register_to_mapper_obj(input_csv_file_name, input_class_obj, output_csv_file
                            map_rules_list,
                            output_obj, in_out_map_obj):
 
-    input_csv_class_obj = InputClassCSVRealization(input_csv_file_name, input_class_obj)
+    input_csv_class_obj = InputClassCSVTupleRealization(input_csv_file_name, input_class_obj)
 
     output_csv_class_obj = OutputClassCSVRealization(output_csv_file_name, output_class_obj)
 
@@ -1,5 +1,10 @@
 import unittest
 import os
+import glob
+import threading
+import pickle
+import shutil
+import tempfile
 from mapping_classes import *
 logging.basicConfig(level=logging.INFO)
 
@@ -9,6 +14,11 @@ class Object1(InputClass):
         return ["id", "object_name", "object_code"]
 
 
+class Object1Extra(InputClass):
+    def fields(self):
+        return ["id", "object_name", "object_code", "object_extra"]
+
+
 class Object1Output(OutputClass):
     def fields(self):
         return ["id", "object_name", "object_code"]
@@ -142,6 +152,59 @@ class TestTranslators(unittest.TestCase):
 
         self.assertEquals({"code_id": 702}, mapped_code)
 
+    def test_translator_sorted_key_lookup(self):
+
+        skl_file_name = "./test/sorted_key_lookup.json.skl"
+        try:
+            items = [("101", '{"code_id": 702}'), ("\u00e9", '[{"code_id": 1}, {"code_id": 2}]'), ("", '{}'),
+                     ("100", '{"code_id": 700}'), ("101", '{"code_id": 703}')]
+            self.assertEquals(4, write_sorted_key_lookup(items, skl_file_name))
+
+            cdx_obj = CoderMapperJSONClass(skl_file_name)
+            self.assertEquals({"code_id": 703}, cdx_obj.map({"code": "101"}))
+            self.assertEquals({"code_id": 1}, cdx_obj.map({"code": "\u00e9"}))
+            self.assertEquals({}, cdx_obj.map({"code": "102"}))
+            self.assertEquals(["", "100", "101", "\u00e9"], list(cdx_obj.mapper_dict))
+            cdx_obj.mapper_dict.close()
+
+            # Sorted in chunks of 2 pairs and merged the file is the same
+            with open(skl_file_name, "rb") as f:
+                skl_bytes = f.read()
+            self.assertEquals(4, write_sorted_key_lookup(iter(items), skl_file_name, chunk_size=2))
+            with open(skl_file_name, "rb") as f:
+                self.assertEquals(skl_bytes, f.read())
+
+            # Built from a JSON file it holds the same items
+            build_sorted_key_lookup("./test/code_mapper.json", skl_file_name)
+            sorted_key_lookup = SortedKeyLookup(skl_file_name)
+            with open("./test/code_mapper.json") as f:
+                json_dict = json.load(f)
+            self.assertEquals(len(json_dict), len(sorted_key_lookup))
+            for key in json_dict:
+                self.assertEquals(json_dict[key], sorted_key_lookup[key])
+            sorted_key_lookup.close()
+
+            # Keys on and between the sparse index entries are found and lookups are cached
+            items = [("%05d" % i, '{"code_id": %s}' % i) for i in range(0, 400, 2)]
+            write_sorted_key_lookup(items, skl_file_name)
+            sorted_key_lookup = SortedKeyLookup(skl_file_name, cache_size=10)
+            for i in list(range(400)) + list(range(400)):
+                if i % 2:
+                    self.assertEquals(None, sorted_key_lookup.get("%05d" % i))
+                else:
+                    self.assertEquals({"code_id": i}, sorted_key_lookup.get("%05d" % i))
+            self.assertEquals(None, sorted_key_lookup.get("99999"))
+            self.assertEquals(None, sorted_key_lookup.get(""))
+            self.assertEquals({"code_id": 398}, sorted_key_lookup.get("00398"))
+            self.assertEquals({"code_id": 398}, sorted_key_lookup.get("00398"))
+            self.assertTrue(sorted_key_lookup.cache.hits > 0)
+            self.assertTrue(len(sorted_key_lookup.cache) <= 10)
+            sorted_key_lookup.close()
+        finally:
+            for file_name in [skl_file_name, artifact_manifest_file_name(skl_file_name)]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
     def test_dict_translator(self):
 
         mapper_obj = CodeMapperDictClass({"a": "1", "b": "2", "c": "3"})
@@ -155,12 +218,17 @@ class TestTranslators(unittest.TestCase):
 class TestCodeMapperClassSqliteJSONClass(unittest.TestCase):
 
     def setUp(self):
-        if os.path.exists("./test/code_mapper.json.db3"):
-            os.remove("./test/code_mapper.json.db3")
+        # Each test builds its database from a copy of the JSON file so tests do not share or leave behind files
+        self.temp_directory = tempfile.mkdtemp()
+        self.code_mapper_json = os.path.join(self.temp_directory, "code_mapper.json")
+        shutil.copy("./test/code_mapper.json", self.code_mapper_json)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
 
     def test_lookup_and_build(self):
 
-        cdx_obj = CodeMapperClassSqliteJSONClass("./test/code_mapper.json")
+        cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json)
         mapped_code_1 = cdx_obj.map({"code": "101"})
 
         self.assertEquals({"code_id": 702}, mapped_code_1)
@@ -171,6 +239,247 @@ class TestCodeMapperClassSqliteJSONClass(unittest.TestCase):
         mapped_code_3 = cdx_obj.map({"code": "ZZZZZ"})
         self.assertEquals({}, mapped_code_3)
 
+        self.assertFalse(len(glob.glob(glob.escape(self.code_mapper_json) + ".db3.*.tmp")))
+
+        # Lookups are served by a read only connection
+        with self.assertRaises(sqlite3.OperationalError):
+            cdx_obj.connection.execute("DELETE FROM lookup_table")
+
+    def test_bounded_caches(self):
+
+        cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json, cache_size=2, miss_cache_size=1)
+        for code in ["101", "102", "101", "100", "102", "ZZZ", "ZZZ", "YYY", "ZZZ"]:
+            cdx_obj.map({"code": code})
+
+        self.assertEquals(2, len(cdx_obj.mapper_dict_cache))
+        self.assertEquals({"size": 2, "bytes": 0, "hits": 1, "misses": 8, "evictions": 2},
+                          cdx_obj.mapper_dict_cache.statistics())
+        self.assertEquals({"size": 1, "bytes": 0, "hits": 1, "misses": 7, "evictions": 2},
+                          cdx_obj.missed_mapper_dict_cache.statistics())
+        self.assertEquals(7, cdx_obj.cache_statistics()["db_lookups"])
+
+        lookup_cache_statistics = log_lookup_cache_statistics()
+        self.assertTrue(cdx_obj.json_file_name in [x["json_file_name"] for x in lookup_cache_statistics])
+        self.assertEquals(0, cdx_obj.cache_statistics()["db_lookups"])
+
+        lru_cache = LRUCache(max_bytes=10)
+        lru_cache.put("a", 1, 4)
+        lru_cache.put("b", 2, 4)
+        lru_cache.get("a")
+        lru_cache.put("c", 3, 4)
+        self.assertEquals(["a", "c"], list(lru_cache.items.keys()))
+        self.assertEquals(8, lru_cache.n_bytes)
+
+    def test_prefetch(self):
+
+        cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json)
+        cdx_obj.prefetch(["101", "102", "101", "ZZZ", ""])
+        self.assertEquals(1, cdx_obj.db_lookups)
+        self.assertTrue("101" in cdx_obj.mapper_dict_cache)
+        self.assertTrue("ZZZ" in cdx_obj.missed_mapper_dict_cache)
+
+        self.assertEquals({"code_id": 704}, cdx_obj.map({"code": "102"}))
+        self.assertEquals({}, cdx_obj.map({"code": "ZZZ"}))
+        self.assertEquals(1, cdx_obj.db_lookups)
+
+        # Only the rows selected for a case are prefetched by the mapper for that case
+        cdx_obj_1 = CodeMapperClassSqliteJSONClass(self.code_mapper_json, "code", shared=False)
+        cdx_obj_2 = CodeMapperClassSqliteJSONClass(self.code_mapper_json, "code", shared=False)
+        case_mapper_obj = CascadeMapper(CaseMapper(lambda x: int(x["system"]), cdx_obj_1, cdx_obj_2),
+                                        ConstantMapper({"code_id": 0}))
+        prefetch_lookups(case_mapper_obj, {"code": ["100", "101", "102"], "system": ["0", "1", "0"]}, 3)
+        self.assertEquals(["100", "102"], list(cdx_obj_1.mapper_dict_cache.items.keys()))
+        self.assertEquals(["101"], list(cdx_obj_2.mapper_dict_cache.items.keys()))
+
+    def test_shared_lookup_store(self):
+
+        cdx_obj_1 = CodeMapperClassSqliteJSONClass(self.code_mapper_json)
+        cdx_obj_2 = CodeMapperClassSqliteJSONClass(self.code_mapper_json, "code")
+        self.assertTrue(cdx_obj_1.lookup_store is cdx_obj_2.lookup_store)
+        self.assertTrue(cdx_obj_1.connection is cdx_obj_2.connection)
+
+        cdx_obj_1.reset_cache_statistics()
+        self.assertEquals({"code_id": 702}, cdx_obj_1.map({"code": "101"}))
+        self.assertEquals({"code_id": 702}, cdx_obj_2.map({"code": "101"}))
+        self.assertEquals(1, cdx_obj_2.db_lookups)
+
+        cdx_obj_3 = CodeMapperClassSqliteJSONClass(self.code_mapper_json, shared=False)
+        self.assertFalse(cdx_obj_1.lookup_store is cdx_obj_3.lookup_store)
+
+        # A rebuilt database file opens a new store
+        os.remove(self.code_mapper_json + ".db3")
+        cdx_obj_4 = CodeMapperClassSqliteJSONClass(self.code_mapper_json)
+        self.assertFalse(cdx_obj_1.lookup_store is cdx_obj_4.lookup_store)
+        self.assertTrue(cdx_obj_4.lookup_store.is_current())
+
+    def test_artifact_manifest(self):
+
+        json_file_name = "./test/manifest_source.json"
+        db_file_name = json_file_name + ".db3"
+        try:
+            with open(json_file_name, "w") as fw:
+                fw.write('{"101": {"code_id": 1}}')
+
+            build_options = {"non_unique_key_policy": "first"}
+            self.assertEquals("does not exist", artifact_rebuild_reason(db_file_name, [json_file_name], build_options))
+            cdx_obj = CodeMapperClassSqliteJSONClass(json_file_name)
+            self.assertIsNone(artifact_rebuild_reason(db_file_name, [json_file_name], build_options))
+            self.assertIsNotNone(estimate_rebuild_seconds(db_file_name, [json_file_name]))
+
+            # Touching the source without changing it keeps the artifact
+            os.utime(json_file_name, (0, 0))
+            self.assertIsNone(artifact_rebuild_reason(db_file_name, [json_file_name], build_options))
+
+            # A changed source of the same size is detected by its hash and the database is rebuilt
+            with open(json_file_name, "w") as fw:
+                fw.write('{"101": {"code_id": 2}}')
+            os.utime(json_file_name, (1, 1))
+            self.assertEquals("source '%s' changed" % os.path.abspath(json_file_name),
+                              artifact_rebuild_reason(db_file_name, [json_file_name], build_options))
+            self.assertEquals("was built with different options",
+                              artifact_rebuild_reason(db_file_name, [json_file_name], {"non_unique_key_policy": None}))
+            self.assertFalse(cdx_obj.lookup_store.is_current())
+
+            previous_cdx_obj = cdx_obj
+            cdx_obj = CodeMapperClassSqliteJSONClass(json_file_name)
+            self.assertEquals({"code_id": 2}, cdx_obj.map({"code": "101"}))
+            self.assertIsNone(artifact_rebuild_reason(db_file_name, [json_file_name], build_options))
+
+            # The rebuilt database replaces the file so a store opened before the rebuild still reads the old one
+            self.assertEquals({"code_id": 1}, previous_cdx_obj.map({"code": "101"}))
+        finally:
+            for file_name in [json_file_name, db_file_name, artifact_manifest_file_name(db_file_name),
+                              db_file_name + ".lock"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def test_build_lock(self):
+
+        json_file_name = "./test/build_lock.json"
+        db_file_name = json_file_name + ".db3"
+        try:
+            with open(json_file_name, "w") as fw:
+                fw.write('{"101": {"code_id": 1}}')
+
+            # A build waits while another process holds the lock
+            with ArtifactBuildLock(db_file_name):
+                build_thread = threading.Thread(target=build_sqlite_lookup_artifact, args=(json_file_name,))
+                build_thread.start()
+                build_thread.join(0.2)
+                self.assertTrue(build_thread.is_alive())
+                self.assertFalse(os.path.exists(db_file_name))
+            build_thread.join()
+
+            self.assertIsNone(artifact_rebuild_reason(db_file_name, [json_file_name],
+                                                      {"non_unique_key_policy": "first"}))
+            self.assertEquals(db_file_name, build_sqlite_lookup_artifact(json_file_name))
+        finally:
+            for file_name in [json_file_name, db_file_name, artifact_manifest_file_name(db_file_name),
+                              db_file_name + ".lock"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def test_non_unique_key_policy(self):
+
+        entries = [{"concept_id": "1", "vocabulary_id": "OMOP Extension", "valid_end_date": "20991231"},
+                   {"concept_id": "2", "vocabulary_id": "SNOMED", "valid_end_date": "20150101"},
+                   {"concept_id": "3", "vocabulary_id": "SNOMED", "valid_end_date": "20991231"}]
+        self.assertEquals("1", NonUniqueKeyResolver("first").resolve(entries)["concept_id"])
+        self.assertEquals("1", NonUniqueKeyResolver("latest_valid_end_date").resolve(entries)["concept_id"])
+        self.assertEquals("2", NonUniqueKeyResolver("non_omop_extension_first").resolve(entries)["concept_id"])
+        self.assertRaises(ValueError, NonUniqueKeyResolver, "last")
+
+        json_file_name = "./test/non_unique_key.json"
+        try:
+            with open(json_file_name, "w") as fw:
+                json.dump({"101": entries, "102": entries[1]}, fw)
+
+            cdx_obj = CodeMapperClassSqliteJSONClass(json_file_name, non_unique_key_policy="non_omop_extension_first")
+            self.assertEquals(entries[1], cdx_obj.map({"code": "101"}))
+            self.assertEquals(1, cdx_obj.cache_statistics()["non_unique_keys"])
+
+            # A different policy rebuilds the database
+            cdx_obj = CodeMapperClassSqliteJSONClass(json_file_name, non_unique_key_policy="first")
+            self.assertEquals(entries[0], cdx_obj.map({"code": "101"}))
+
+            cdx_obj = CoderMapperJSONClass(json_file_name, non_unique_key_policy="latest_valid_end_date")
+            self.assertEquals(entries[0], cdx_obj.mapper_dict["101"])
+        finally:
+            for file_name in [json_file_name, json_file_name + ".db3", json_file_name + ".db3.manifest.json",
+                              json_file_name + ".db3.lock"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def test_warm_start(self):
+
+        warm_start_file_name = self.code_mapper_json + ".db3.warm.json"
+        try:
+            cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json, shared=False, warm_start=True)
+            for code in ["101", "102", "ZZZ"]:
+                cdx_obj.map({"code": code})
+            save_warm_start_profiles()
+            self.assertTrue(os.path.exists(warm_start_file_name))
+
+            cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json, shared=False, warm_start=True)
+            self.assertEquals(1, cdx_obj.db_lookups)
+            for code in ["101", "102", "ZZZ"]:
+                cdx_obj.map({"code": code})
+            self.assertEquals(1, cdx_obj.db_lookups)
+
+            # A profile saved for another version of the database is ignored
+            with open(warm_start_file_name) as f:
+                profile_dict = json.load(f)
+            profile_dict["artifact_version"] = "0"
+            with open(warm_start_file_name, "w") as fw:
+                json.dump(profile_dict, fw)
+            self.assertFalse(cdx_obj.lookup_store.load_warm_start_profile())
+
+            # The keys with the most hits are saved rather than the most recently used
+            cdx_obj = CodeMapperClassSqliteJSONClass(self.code_mapper_json, shared=False, warm_start=True,
+                                                     cache_size=1)
+            for code in ["101", "101", "101", "102", "102", "100"]:
+                cdx_obj.map({"code": code})
+            profile_dict = cdx_obj.lookup_store.warm_start_profile(n_hot_keys=2)
+            self.assertEquals(["101", "102"], profile_dict["hot_keys"])
+            self.assertEquals([3, 2], profile_dict["hit_counts"])
+
+            # Merged profiles add up the hit counts
+            cdx_obj.lookup_store.add_warm_start_profile({"artifact_version": profile_dict["artifact_version"],
+                                                         "hot_keys": ["100", "102"], "hit_counts": [5, 1],
+                                                         "misses": []})
+            profile_dict = cdx_obj.lookup_store.warm_start_profile(n_hot_keys=2)
+            self.assertEquals(["100", "101"], profile_dict["hot_keys"])
+            self.assertEquals([6, 3], profile_dict["hit_counts"])
+        finally:
+            if os.path.exists(warm_start_file_name):
+                os.remove(warm_start_file_name)
+
+    def test_iterate_json_object_items(self):
+
+        with open(self.code_mapper_json) as f:
+            json_dict = json.load(f)
+
+        # A small chunk size splits keys and values across reads
+        for chunk_size in (1, 7, 1048576):
+            items = list(iterate_json_object_items(self.code_mapper_json, chunk_size=chunk_size))
+            self.assertEquals(list(json_dict.items()), [(key, json.loads(value)) for key, value in items])
+
+    def test_build_with_repeated_key(self):
+
+        with open("./test/repeated_key.json", "w") as fw:
+            fw.write('{"101": {"code_id": 1}, "102": {"code_id": 2}, "101": {"code_id": 3}}')
+
+        try:
+            cdx_obj = CodeMapperClassSqliteJSONClass("./test/repeated_key.json")
+            self.assertEquals({"code_id": 3}, cdx_obj.map({"code": "101"}))
+            self.assertEquals({"code_id": 2}, cdx_obj.map({"code": "102"}))
+            cdx_obj.connection.close()
+        finally:
+            for file_name in ["./test/repeated_key.json", "./test/repeated_key.json.db3",
+                              "./test/repeated_key.json.db3.manifest.json", "./test/repeated_key.json.db3.lock"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
 
 class TestInputSourceRealizations(unittest.TestCase):
 
@@ -181,6 +490,35 @@ class TestInputSourceRealizations(unittest.TestCase):
         in_dict = list(in_obj_1)
         self.assertEquals({":row_id": 1, "id": '234', "object_name": "ab", "object_code": '102'}, in_dict[0])
 
+    def test_read_csv_tuple(self):
+
+        in_obj_1 = InputClassCSVTupleRealization("./test/input_object1.csv", Object1())
+        in_obj_2 = InputClassCSVRealization("./test/input_object1.csv", Object1())
+
+        in_rows = list(in_obj_1)
+        self.assertEquals(list(in_obj_2), in_rows)
+        self.assertEquals({":row_id": 1, "id": '234', "object_name": "ab", "object_code": '102'}, in_rows[0])
+
+        row_record = in_rows[2]
+        self.assertEquals(4, len(row_record))
+        self.assertEquals('500', row_record["object_code"])
+        self.assertEquals(3, row_record[":row_id"])
+        self.assertFalse("concept_id" in row_record)
+
+        row_record["concept_id"] = 0
+        row_record["object_code"] = '501'
+        del row_record["id"]
+        self.assertEquals({":row_id": 3, "object_name": "ad", "object_code": '501', "concept_id": 0},
+                          row_record.copy())
+        self.assertEquals(4, len(row_record))
+        del row_record["concept_id"]
+        del row_record["object_name"]
+        self.assertEquals(2, len(row_record))
+
+        # Fields of the input class missing from the file are filled with an empty string
+        in_obj_3 = InputClassCSVTupleRealization("./test/input_object1.csv", Object1Extra())
+        self.assertEquals("", next(in_obj_3)["object_extra"])
+
 
 class TestOutputSourceRealizations(unittest.TestCase):
 
@@ -193,6 +531,48 @@ class TestOutputSourceRealizations(unittest.TestCase):
         o_obj = OutputClassCSVRealization("./test/write_csv_test.csv", Object1Output())
         o_obj.write({"id": '234', "object_name": "ab", "object_code": '102'})
 
+    def test_write_csv_buffered(self):
+
+        o_obj = OutputClassCSVRealization("./test/write_csv_test.csv", Object1Output(), batch_size=2)
+        o_obj.write({"id": '234', "object_name": "ab", "object_code": '102'})
+        o_obj.write({"id": '100', "object_code": '101', "extra_field": "x"})
+        o_obj.write({"id": '123', "object_name": None, "object_code": '500'})
+
+        self.assertEquals(1, len(o_obj.rows_to_write))
+        o_obj.close()
+        self.assertTrue(o_obj.write_time > 0)
+
+        with open("./test/write_csv_test.csv", "r") as f:
+            self.assertEquals("id,object_name,object_code\n234,ab,102\n100,,101\n123,,500\n",
+                              f.read())
+
+    def test_capture_id_map(self):
+
+        o_obj = OutputClassCSVRealization("./test/write_csv_test.csv", Object1Output(),
+                                          id_map_fields=("object_code", "id"))
+        o_obj.write({"id": 234, "object_name": "ab", "object_code": '102'})
+        o_obj.write({"id": 100, "object_code": '101'})
+        o_obj.write({"id": 123, "object_name": None, "object_code": None})
+
+        shard_obj = o_obj.shard("./test/write_csv_test.csv.shard0000")
+        shard_obj.write({"id": 7, "object_name": "cd", "object_code": '500'})
+        shard_obj.close()
+        o_obj.append_csv_file("./test/write_csv_test.csv.shard0000")
+        os.remove("./test/write_csv_test.csv.shard0000")
+        o_obj.close()
+
+        id_map = o_obj.id_map()
+        self.assertEqual(4, len(id_map))
+        self.assertEqual({"id": "234"}, id_map.get("102"))
+        self.assertEqual({"id": "123"}, id_map[""])
+        self.assertEqual({"id": "7"}, id_map["500"])
+        self.assertIsNone(id_map.get("999"))
+        self.assertFalse("999" in id_map)
+
+        code_mapper = CoderMapperIdMapClass(pickle.loads(pickle.dumps(id_map)), "object_code")
+        self.assertEqual({"id": "100"}, code_mapper.map({"object_code": "101"}))
+        self.assertEqual({}, code_mapper.map({"object_code": "999"}))
+
 
 class TestBuildInputOutMapper(unittest.TestCase):
     def setUp(self):
@@ -204,6 +584,133 @@ class TestBuildInputOutMapper(unittest.TestCase):
 
         self.assertEquals(3, len(output_obj))
 
+    def test_map_batch(self):
+        rows = [{":row_id": 1, "id": "234", "object_name": "ab", "object_code": "102"},
+                {":row_id": 2, "id": "100", "object_name": "ac", "object_code": "101"},
+                {":row_id": 3, "id": "123", "object_name": "ab", "object_code": "500"}]
+
+        code_mapper = CodeMapperDictClass({"101": "B", "102": "C"}, "object_code")
+        rules = [("id", "ID"), (":row_id", "sequence_id"), ("object_name", TransformMapper(lambda x: x.upper()),
+                                                               "OBJECT_NAME"),
+                 "object_code",
+                 ("object_code", CascadeMapper(code_mapper, ConstantMapper({"mapped_value": "Z"})),
+                  {"mapped_value": "mapped_code_id"}),
+                 (("id", "object_code"), IdentityMapper(), {"id": "other_id"})]
+
+        output_obj = build_input_output_mapper(rules)
+        self.assertEqual(["id", ":row_id", "object_name", "object_code"], output_obj.input_fields())
+
+        input_columns = {}
+        for field in output_obj.input_fields():
+            input_columns[field] = [row_dict[field] for row_dict in rows]
+
+        mapped_rows = output_obj.map_batch(input_columns, len(rows))
+        self.assertEqual([output_obj.map(row_dict) for row_dict in rows], mapped_rows)
+        self.assertEqual("Z", mapped_rows[2]["mapped_code_id"])
+        self.assertIsNone(mapped_rows[0]["object_code"])
+
+    def test_compiled_mapper(self):
+        row_dict = {":row_id": 1, "id": "234", "object_name": "ab", "object_code": "101"}
+        code_mapper = CoderMapperJSONClass("./test/code_mapper.json")
+        rules = [("id", "ID"), (":row_id", "sequence_id"), ("object_name", TransformMapper(lambda x: x.upper()),
+                                                               "OBJECT_NAME"),
+                 "object_code", ("object_code", code_mapper, {"code_id": "mapped_code_id"}),
+                 (("id", "object_code"), IdentityMapper(), {"id": "other_id"}),
+                 ("object_name", ConstantMapper({"a": 1}))]
+
+        compiled_obj = build_input_output_mapper(rules, compile_rules=True)
+
+        self.assertTrue("mapped_dict['ID'] = " in compiled_obj.source)
+        self.assertEqual(build_input_output_mapper(rules).map(row_dict), compiled_obj.map(row_dict))
+        self.assertEqual(702, compiled_obj.map(row_dict)["mapped_code_id"])
+
+        self.assertRaises(KeyError, compiled_obj.map, {"id": "234"})
+
+    def test_shared_mapper_evaluation(self):
+        calls = []
+
+        def code_function(input_dict):
+            value = list(input_dict.values())[0]
+            calls.append(value)
+            return {"code": value + "x", "other": "y"}
+
+        code_mapper = PassThroughFunctionMapper(code_function)
+        rules = [("object_code", code_mapper, {"code": "code_1"}),
+                 ("object_code", code_mapper, {"code": "code_2"}),
+                 ("object_name", code_mapper, {"code": "code_3"}),
+                 ("object_name", CascadeMapper(TransformMapper(len), ConstantMapper({"object_name": 0})),
+                  {"object_name": "length_1"}),
+                 ("object_name", CascadeMapper(TransformMapper(len), ConstantMapper({"object_name": 0})),
+                  {"object_name": "length_2"})]
+
+        row_dict = {"object_code": "101", "object_name": "101"}
+        for compile_rules in (False, True):
+            calls.clear()
+            mapper_obj = build_input_output_mapper(rules, compile_rules=compile_rules)
+            mapped_dict = mapper_obj.map(row_dict)
+            self.assertEqual({"code_1": "101x", "code_2": "101x", "code_3": "101x", "other": None,
+                              "length_1": 3, "length_2": 3}, mapped_dict)
+            self.assertEqual(2, len(calls))
+
+            rule_statistics = mapper_obj.statistics()
+            self.assertEqual([1, 0, 1, 1, 0], [rule_statistic["evaluated"] for rule_statistic in rule_statistics])
+            self.assertEqual([0, 1, 0, 0, 1], [rule_statistic["reused"] for rule_statistic in rule_statistics])
+
+        calls.clear()
+        mapped_rows = mapper_obj.map_batch({"object_code": ["101", "102"], "object_name": ["a", "b"]}, 2)
+        self.assertEqual(["101", "102", "a", "b"], calls)
+        self.assertEqual("102x", mapped_rows[1]["code_2"])
+
+    def test_memoized_mapper(self):
+        calls = []
+
+        def gender_function(value):
+            calls.append(value)
+            return value.upper()
+
+        gender_mapper = CascadeMapper(ChainMapper(TransformMapper(gender_function, pure=True),
+                                                  SingleMatchAddValueMapper(("s_gender", "F"), ("gender_id", 8532))),
+                                      ConstantMapper({"gender_id": 0}))
+        self.assertTrue(is_memoizable_mapper(gender_mapper))
+        self.assertFalse(is_memoizable_mapper(ChainMapper(TransformMapper(gender_function), ConstantMapper({}))))
+        self.assertFalse(is_memoizable_mapper(CascadeMapper(FunctionMapper(len))))
+
+        # A CaseMapper is only memoized when its case function is marked pure
+        case_mapper = CaseMapper(lambda input_dict: 0, ConstantMapper({"gender_id": 0}))
+        self.assertTrue(memoize_mapper(case_mapper) is case_mapper)
+        pure_case_mapper = CaseMapper(lambda input_dict: 0, ConstantMapper({"gender_id": 0}), pure=True)
+        self.assertEqual("MemoizedMapper", memoize_mapper(pure_case_mapper).__class__.__name__)
+
+        # The input of a mapper which modifies it is copied
+        memoized_mapper = MemoizedMapper(gender_mapper, cache_size=2)
+        input_dict = {"s_gender": "f"}
+        result_dict = memoized_mapper.map(input_dict)
+        self.assertEqual({"s_gender": "F", "gender_id": 8532}, result_dict)
+        self.assertEqual({"s_gender": "f"}, input_dict)
+        result_dict["gender_id"] = 0
+        self.assertEqual({"s_gender": "F", "gender_id": 8532}, memoized_mapper.map({"s_gender": "f"}))
+        self.assertEqual(1, len(calls))
+
+        rules = [("s_gender", gender_mapper, {"gender_id": "gender_concept_id"}),
+                 ("s_gender", gender_mapper, {"s_gender": "gender_source_value"})]
+        for compile_rules in (False, True):
+            calls.clear()
+            mapper_obj = build_input_output_mapper(rules, compile_rules=compile_rules, memoize=True)
+            for gender in ["f", "m", "f", "f"]:
+                mapped_dict = mapper_obj.map({"s_gender": gender})
+            self.assertEqual(8532, mapped_dict["gender_concept_id"])
+            self.assertEqual("F", mapped_dict["gender_source_value"])
+            self.assertEqual(["f", "m"], calls)
+            self.assertEqual("MemoizedMapper", mapper_obj.statistics()[0]["mapper"])
+
+        in_out_map_obj = InputOutputMapperDirectory()
+        in_out_map_obj.register(Object1(), Object1Mapped(), build_input_output_mapper(rules))
+        in_out_map_obj.memoize()
+        in_out_map_obj.compile()
+        mapper_obj = in_out_map_obj[(Object1, Object1Mapped)]
+        self.assertTrue(mapper_obj.field_mapper_instances[0][1].map_function is
+                        mapper_obj.field_mapper_instances[1][1].map_function)
+
 
 # Function which return the output
 def _test_output_func(void_dict):
@@ -311,6 +818,9 @@ class TestRunMapper(unittest.TestCase):
 
         output_directory_obj.register(Object1Mapped(), output_realization)
 
+        in_out_map_obj.compile()
+        self.assertTrue(isinstance(in_out_map_obj[(Object1, Object1Mapped)], CompiledInputOutputMapper))
+
         map_runner_obj = RunMapperAgainstSingleInputRealization(in_obj_1, in_out_map_obj, output_directory_obj,
                                                                 _test_output_mapped_func)
         map_runner_obj.run()
@@ -357,6 +867,586 @@ class TestRunMapper(unittest.TestCase):
 
         self.assertEquals(2, len(list_dict))
 
+    def test_mapping_context(self):
+        calls = []
+
+        def code_function(input_dict):
+            calls.append(input_dict)
+            return {"code_id": input_dict["object_code"] + "x"}
+
+        mapping_context = MappingContext()
+        code_mapper = mapping_context.memoize(PassThroughFunctionMapper(code_function), ("object_code",))
+
+        def mapper_with_context(row_dict):
+            if code_mapper.map(row_dict)["code_id"] == "500x":
+                return NoOutputClass()
+            else:
+                return Object1Mapped()
+
+        rules = [("id", "ID"), (":row_id", "sequence_id"), ("object_name", "OBJECT_NAME"),
+                 "object_code", ("object_code", code_mapper, {"code_id": "mapped_code_id"})]
+
+        for batch_size in (None, 2):
+            calls.clear()
+            in_out_map_obj = InputOutputMapperDirectory()
+            in_out_map_obj.register(Object1(), Object1Mapped(), build_input_output_mapper(rules))
+
+            in_obj_1 = InputClassCSVRealization("./test/input_object1.csv", Object1())
+
+            output_directory_obj = OutputClassDirectory()
+            output_realization = OutputClassCSVRealization("./test/output_obj1_map_noc.csv", Object1Mapped())
+            output_directory_obj.register(Object1Mapped(), output_realization)
+
+            map_runner_obj = RunMapperAgainstSingleInputRealization(in_obj_1, in_out_map_obj, output_directory_obj,
+                                                                    mapper_with_context,
+                                                                    mapping_context=mapping_context)
+            map_runner_obj.run(batch_size=batch_size)
+
+            with open("./test/output_obj1_map_noc.csv", "r") as f:
+                list_dict = list(csv.DictReader(f))
+
+            self.assertEquals(["102x", "101x"], [row_dict["mapped_code_id"] for row_dict in list_dict])
+            self.assertEquals([{"object_code": "102"}, {"object_code": "101"}, {"object_code": "500"}], calls)
+            self.assertFalse(mapping_context.active)
+
+        # Outside of a run the mapper is called directly
+        code_mapper.map({"object_code": "102", "object_name": "ab"})
+        self.assertEquals(4, len(calls))
+
+        # A field missing from the input is left out
+        name_mapper = mapping_context.memoize(PassThroughFunctionMapper(lambda input_dict: dict(input_dict)),
+                                              ("object_name", "object_code"))
+        self.assertEquals({"object_code": "102"}, name_mapper.map({"object_code": "102", "id": "1"}))
+
+    def test_project_input_fields(self):
+
+        def mapper_with_no_class(row_dict):
+            if row_dict["object_name"] == "ad":
+                return NoOutputClass()
+            else:
+                return Object1Mapped()
+
+        rules = [("id", "ID"), (":row_id", "sequence_id")]
+
+        for input_fields in (None, ["object_name"]):
+            if input_fields is not None:
+                mapper_with_no_class.input_fields = input_fields
+
+            in_out_map_obj = InputOutputMapperDirectory()
+            in_out_map_obj.register(Object1(), Object1Mapped(), build_input_output_mapper(rules))
+
+            in_obj_1 = InputClassCSVTupleRealization("./test/input_object1.csv", Object1())
+
+            output_directory_obj = OutputClassDirectory()
+            output_realization = OutputClassCSVRealization("./test/output_obj1_map_noc.csv", Object1Mapped())
+            output_directory_obj.register(Object1Mapped(), output_realization)
+
+            map_runner_obj = RunMapperAgainstSingleInputRealization(in_obj_1, in_out_map_obj, output_directory_obj,
+                                                                    mapper_with_no_class, project_input_fields=True)
+            map_runner_obj.run()
+
+            if input_fields is None:  # A router which does not list its fields reads every field
+                self.assertIsNone(map_runner_obj.required_input_fields())
+                self.assertIsNone(in_obj_1.projection)
+            else:
+                self.assertEquals({"id", ":row_id", "object_name"}, map_runner_obj.required_input_fields())
+                self.assertEquals([0, 1], in_obj_1.positions)
+
+            with open("./test/output_obj1_map_noc.csv", "r") as f:
+                list_dict = list(csv.DictReader(f))
+
+            self.assertEquals(["234", "100"], [row_dict["ID"] for row_dict in list_dict])
+            self.assertEquals(["1", "2"], [row_dict["sequence_id"] for row_dict in list_dict])
+
+        # Only the fields read are kept in a row
+        in_obj_2 = InputClassCSVTupleRealization("./test/input_object1.csv", Object1())
+        in_obj_2.project(["object_code"])
+        self.assertEquals({":row_id": 1, "object_code": "102"}, next(in_obj_2))
+
+    def test_profiler(self):
+
+        def mapper_with_no_class(row_dict):
+            if row_dict["object_code"] == "500":
+                return NoOutputClass()
+            else:
+                return Object1Mapped()
+
+        code_mapper = CascadeMapper(CoderMapperJSONClass("./test/code_mapper.json"), ConstantMapper({"code_id": 0}))
+        rules = [("id", "ID"), (":row_id", "sequence_id"), ("object_name", "OBJECT_NAME"),
+                 "object_code", ("object_code", code_mapper, {"code_id": "mapped_code_id"}),
+                 ("object_code", code_mapper, {"code_id": "additional_field"})]
+
+        mapper_rules_class = build_input_output_mapper(rules)
+        in_out_map_obj = InputOutputMapperDirectory()
+        in_out_map_obj.register(Object1(), Object1Mapped(), mapper_rules_class)
+
+        in_obj_1 = InputClassCSVRealization("./test/input_object1.csv", Object1())
+
+        output_directory_obj = OutputClassDirectory()
+        output_realization = OutputClassCSVRealization("./test/output_obj1_map_noc.csv", Object1Mapped())
+        output_directory_obj.register(Object1Mapped(), output_realization)
+
+        map_runner_obj = RunMapperAgainstSingleInputRealization(in_obj_1, in_out_map_obj, output_directory_obj,
+                                                                mapper_with_no_class,
+                                                                profiler=MappingProfiler("./test/"))
+        map_runner_obj.run()
+
+        self.assertTrue(in_out_map_obj[(Object1, Object1Mapped)] is mapper_rules_class)
+        self.assertEquals(2, mapper_rules_class.statistics()[4]["evaluated"])
+
+        profile_report = map_runner_obj.profile_report
+        self.assertTrue(os.path.exists("./test/profile_01_Object1.json"))
+        os.remove("./test/profile_01_Object1.json")
+
+        profiles = {profile_dict["name"]: profile_dict for profile_dict in profile_report["profiles"]}
+        self.assertEquals(3, profiles["router"]["calls"])
+        self.assertEquals(2, profiles["Object1Mapped rule 4 object_code > CascadeMapper"]["calls"])
+        self.assertEquals(0, profiles["Object1Mapped rule 4 object_code > CascadeMapper[0] > CoderMapperJSONClass"]
+                          ["empty_results"])
+        self.assertEquals(0, profiles["Object1Mapped rule 4 object_code > CascadeMapper[1] > ConstantMapper"]["calls"])
+        self.assertEquals(4, len(profiles))
+
+        times = [profile_dict["time"] for profile_dict in profile_report["profiles"]]
+        self.assertEquals(sorted(times, reverse=True), times)
+        self.assertEquals(2, profile_report["writers"][0]["rows"])
+
+
+class TestRunMapperParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.code_mapper_json = os.path.join(self.temp_directory, "code_mapper.json")
+        shutil.copy("./test/code_mapper.json", self.code_mapper_json)
+
+        with open("./test/input_object_parallel.csv", "w", newline="") as fw:
+            csv_writer = csv.writer(fw)
+            csv_writer.writerow(["id", "object_name", "object_code"])
+            for i in range(997):
+                csv_writer.writerow([str(i), "name_%s" % i, ["100", "101", "102", "500"][i % 4]])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+        for file_name in ["./test/input_object_parallel.csv", "./test/output_serial.csv",
+                          "./test/output_parallel.csv"]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def _run(self, output_csv_file_name, n_workers=None, batch_size=None, pipeline=False, prefetch_size=None,
+             commit_file_name=None, fail_row_id=None, warm_start=False):
+
+        def mapper_with_no_class(row_dict):
+            if row_dict["object_code"] == "ZZZ" or row_dict[":row_id"] == fail_row_id:
+                raise ValueError("Unknown code")
+            elif row_dict["object_code"] == "500":
+                return NoOutputClass()
+            else:
+                return Object1Mapped()
+
+        code_mapper = CodeMapperClassSqliteJSONClass(self.code_mapper_json, shared=False, warm_start=warm_start)
+        rules = [("id", "ID"), (":row_id", "sequence_id"), ("object_name", "OBJECT_NAME"),
+                 "object_code", ("object_code", code_mapper, {"code_id": "mapped_code_id"})]
+
+        in_out_map_obj = InputOutputMapperDirectory()
+        in_out_map_obj.register(Object1(), Object1Mapped(), build_input_output_mapper(rules))
+
+        output_directory_obj = OutputClassDirectory()
+        output_directory_obj.register(Object1Mapped(), OutputClassCSVRealization(output_csv_file_name,
+                                                                                  Object1Mapped()))
+
+        in_obj = InputClassCSVTupleRealization("./test/input_object_parallel.csv", Object1())
+        map_runner_obj = RunMapperAgainstSingleInputRealization(in_obj, in_out_map_obj, output_directory_obj,
+                                                                mapper_with_no_class, prefetch_size=prefetch_size)
+        map_runner_obj.commit_file_name = commit_file_name
+        map_runner_obj.commit_rows = 100
+        self.db_lookups = code_mapper.db_lookups
+        if pipeline:
+            map_runner_obj.run_pipelined(batch_size=batch_size, chunk_size=10, queue_size=2)
+        elif n_workers is None:
+            map_runner_obj.run(batch_size=batch_size)
+        else:
+            map_runner_obj.run_parallel(n_workers=n_workers, n_shards=7, batch_size=batch_size)
+
+        self.db_lookups = code_mapper.db_lookups - self.db_lookups
+        with open(output_csv_file_name) as f:
+            return map_runner_obj.rows_run, f.read()
+
+    def test_compute_csv_shards(self):
+        shards = compute_csv_shards("./test/input_object_parallel.csv", 7)
+        self.assertEqual(7, len(shards))
+        with open("./test/input_object_parallel.csv", "rb") as f:
+            data = f.read()
+        for start_offset, end_offset in shards:
+            self.assertEqual(b"\n", data[start_offset - 1:start_offset])
+
+    def test_parallel_matches_serial(self):
+        serial_rows_run, serial_output = self._run("./test/output_serial.csv")
+        parallel_rows_run, parallel_output = self._run("./test/output_parallel.csv", n_workers=2)
+
+        self.assertEqual(997, serial_rows_run)
+        self.assertEqual(serial_rows_run, parallel_rows_run)
+        self.assertEqual(serial_output, parallel_output)
+        self.assertFalse(len(glob.glob("./test/output_parallel.csv.shard*")))
+
+    def test_parallel_warm_start(self):
+        warm_start_file_name = self.code_mapper_json + ".db3.warm.json"
+        try:
+            self._run("./test/output_parallel.csv", n_workers=2, warm_start=True)
+
+            # The profile saved holds the keys looked up in the workers
+            with open(warm_start_file_name) as f:
+                profile_dict = json.load(f)
+            self.assertEqual(["100", "101", "102"], sorted(profile_dict["hot_keys"]))
+            # Each lookup in a worker is counted once when the counts of the shards are added up
+            self.assertEqual({"100": 250, "101": 249, "102": 249},
+                             dict(zip(profile_dict["hot_keys"], profile_dict["hit_counts"])))
+        finally:
+            if os.path.exists(warm_start_file_name):
+                os.remove(warm_start_file_name)
+
+    def test_batch_matches_serial(self):
+        serial_rows_run, serial_output = self._run("./test/output_serial.csv")
+        batch_rows_run, batch_output = self._run("./test/output_parallel.csv", batch_size=100)
+
+        self.assertEqual(serial_rows_run, batch_rows_run)
+        self.assertEqual(serial_output, batch_output)
+
+    def test_pipelined_matches_serial(self):
+        serial_rows_run, serial_output = self._run("./test/output_serial.csv")
+        for batch_size in (None, 100):
+            pipelined_rows_run, pipelined_output = self._run("./test/output_parallel.csv", batch_size=batch_size,
+                                                             pipeline=True)
+
+            self.assertEqual(serial_rows_run, pipelined_rows_run)
+            self.assertEqual(serial_output, pipelined_output)
+
+    def test_prefetch_matches_serial(self):
+        serial_rows_run, serial_output = self._run("./test/output_serial.csv")
+        for batch_size in (None, 100):
+            prefetch_rows_run, prefetch_output = self._run("./test/output_parallel.csv", batch_size=batch_size,
+                                                           prefetch_size=200)
+
+            self.assertEqual(serial_rows_run, prefetch_rows_run)
+            self.assertEqual(serial_output, prefetch_output)
+            self.assertEqual(1, self.db_lookups)
+
+    def test_resume_matches_serial(self):
+        serial_rows_run, serial_output = self._run("./test/output_serial.csv")
+        commit_file_name = "./test/output_parallel.csv.commit.json"
+        for batch_size in (None, 100):
+            self.assertRaises(ValueError, self._run, "./test/output_parallel.csv", batch_size=batch_size,
+                              commit_file_name=commit_file_name, fail_row_id=550)
+            self.assertEqual(500, read_commit(commit_file_name)["rows_run"])
+
+            self.assertEqual(500, prepare_resume(commit_file_name)["rows_run"])
+            self.assertTrue(os.path.exists("./test/output_parallel.csv.committed"))
+            resumed_rows_run, resumed_output = self._run("./test/output_parallel.csv", batch_size=batch_size,
+                                                         commit_file_name=commit_file_name)
+
+            self.assertEqual(serial_rows_run, resumed_rows_run)
+            self.assertEqual(serial_output, resumed_output)
+            self.assertFalse(os.path.exists(commit_file_name))
+            self.assertFalse(os.path.exists("./test/output_parallel.csv.committed"))
+
+    def test_pipelined_error(self):
+        with open("./test/input_object_parallel.csv", "a", newline="") as fw:
+            fw.write("998,name_998,ZZZ\r\n")
+
+        self.assertRaises(ValueError, self._run, "./test/output_parallel.csv", pipeline=True)
+        self.assertEqual(1, threading.active_count())
+
+
+def _stage_ids(config, stage_inputs):
+    with open(config["ids_file_name"], "w") as fw:
+        fw.write("\n".join([str(i) for i in range(config["n_ids"])]))
+    return {"ids": config["ids_file_name"]}
+
+
+def _stage_squares(config, stage_inputs):
+    with open(stage_inputs["ids"]) as f:
+        return {"squares": sum([int(line) ** 2 for line in f]), "square_pid": os.getpid()}
+
+
+def _stage_cubes(config, stage_inputs):
+    with open(stage_inputs["ids"]) as f:
+        return {"cubes": sum([int(line) ** 3 for line in f])}
+
+
+def _stage_total(config, stage_inputs):
+    return {"total": stage_inputs["squares"] + stage_inputs["cubes"]}
+
+
+def _stage_lookup_files(config, stage_name):
+    return [config["lookup_json_file_name"], "./test/not_a_lookup.json"]
+
+
+def _stage_lookup_current(config, stage_inputs):
+    return {"lookup_current": artifact_rebuild_reason(config["lookup_json_file_name"] + ".db3",
+                                                      [config["lookup_json_file_name"]],
+                                                      {"non_unique_key_policy": "first"}) is None}
+
+
+def _stage_id_map(config, stage_inputs):
+    id_map = SourceValueIdMap("person_id", {"p1": 1, "p2": 2})
+    if config["persist_id_maps"]:
+        with open(config["id_map_json_file_name"], "w") as fw:
+            json.dump(dict(id_map.items()), fw)
+        id_map.json_file_name = config["id_map_json_file_name"]
+    return {"person_id_map": id_map}
+
+
+def _stage_map_person(config, stage_inputs):
+    person_id_mapper = CoderMapperIdMapClass(stage_inputs["person_id_map"], "s_person_id")
+    return {"person_id": person_id_mapper.map({"s_person_id": "p2"})["person_id"],
+            "id_map_class": stage_inputs["person_id_map"].__class__.__name__}
+
+
+class TestMappingStageGraph(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists("./test/stage_ids.txt"):
+            os.remove("./test/stage_ids.txt")
+
+    def _stage_graph(self):
+        return MappingStageGraph([MappingStage("total", _stage_total, ["squares", "cubes"], ["total"]),
+                                  MappingStage("ids", _stage_ids, ["n_ids"], ["ids"]),
+                                  MappingStage("squares", _stage_squares, ["ids"], ["squares", "square_pid"]),
+                                  MappingStage("cubes", _stage_cubes, ["ids"], ["cubes"])])
+
+    def test_execution_order(self):
+        stage_graph = self._stage_graph()
+        self.assertEqual({"total": {"squares", "cubes"}, "ids": set(), "squares": {"ids"}, "cubes": {"ids"}},
+                         stage_graph.dependencies())
+        self.assertEqual(["ids", "squares", "cubes", "total"], stage_graph.execution_order())
+
+    def test_serial_and_concurrent_outputs(self):
+        config = {"ids_file_name": "./test/stage_ids.txt", "n_ids": 100}
+
+        serial_outputs = self._stage_graph().run(config)
+        self.assertEqual(328350 + 24502500, serial_outputs["total"])
+        self.assertEqual(os.getpid(), serial_outputs["square_pid"])
+
+        concurrent_outputs = self._stage_graph().run(config, max_workers=2)
+        self.assertNotEqual(os.getpid(), concurrent_outputs.pop("square_pid"))
+        serial_outputs.pop("square_pid")
+        self.assertEqual(serial_outputs, concurrent_outputs)
+
+    def test_id_map_outputs(self):
+        json_file_name = "./test/stage_person_id_map.json"
+        config = {"id_map_json_file_name": json_file_name, "persist_id_maps": True}
+        stage_graph = MappingStageGraph([MappingStage("person", _stage_id_map, [], ["person_id_map"]),
+                                         MappingStage("map_person", _stage_map_person, ["person_id_map"],
+                                                      ["person_id", "id_map_class"])])
+        try:
+            # In a single process the captured map is passed on
+            serial_outputs = stage_graph.run(config)
+            self.assertEqual(("2", "SourceValueIdMap"), (serial_outputs["person_id"], serial_outputs["id_map_class"]))
+
+            # Stages in worker processes open the persisted map
+            concurrent_outputs = stage_graph.run(config, max_workers=2)
+            self.assertEqual(("2", "str"), (concurrent_outputs["person_id"], concurrent_outputs["id_map_class"]))
+            self.assertEqual(json_file_name, concurrent_outputs["person_id_map"])
+
+            # A map which was not persisted is still pickled
+            config["persist_id_maps"] = False
+            concurrent_outputs = stage_graph.run(config, max_workers=2)
+            self.assertEqual("SourceValueIdMap", concurrent_outputs["id_map_class"])
+        finally:
+            if os.path.exists(json_file_name):
+                os.remove(json_file_name)
+
+    def test_build_lookup_artifacts(self):
+        json_file_name = "./test/stage_lookup.json"
+        config = {"lookup_json_file_name": json_file_name}
+        try:
+            with open(json_file_name, "w") as fw:
+                fw.write('{"101": {"code_id": 1}}')
+
+            stage_graph = MappingStageGraph([MappingStage("lookup", _stage_lookup_current, [], ["lookup_current"]),
+                                             MappingStage("ids", _stage_ids, [], ["ids"])],
+                                            lookup_files=_stage_lookup_files)
+
+            # A file of several stages is listed once and files which do not exist are left out
+            self.assertEqual([json_file_name], stage_graph.build_lookup_artifacts(config))
+            os.remove(json_file_name + ".db3")
+
+            # The concurrent stages find the database built before they started
+            config.update({"ids_file_name": "./test/stage_ids.txt", "n_ids": 10})
+            self.assertTrue(stage_graph.run(config, max_workers=2)["lookup_current"])
+        finally:
+            for file_name in [json_file_name, json_file_name + ".db3", json_file_name + ".db3.manifest.json",
+                              json_file_name + ".db3.lock"]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def test_invalid_graphs(self):
+        stage_graph = self._stage_graph()
+        with self.assertRaises(ValueError):
+            stage_graph.add(MappingStage("more_ids", _stage_ids, [], ["ids"]))
+
+        circular_graph = MappingStageGraph([MappingStage("squares", _stage_squares, ["ids", "cubes"], ["squares"]),
+                                            MappingStage("cubes", _stage_cubes, ["squares"], ["cubes"])])
+        with self.assertRaises(ValueError):
+            circular_graph.execution_order()
+
+        missing_output_graph = MappingStageGraph([MappingStage("ids", _stage_ids, [], ["ids", "n_ids"])])
+        with self.assertRaises(RuntimeError):
+            missing_output_graph.run({"ids_file_name": "./test/stage_ids.txt", "n_ids": 10})
+
+
+checkpoint_stage_runs = []
+
+
+def _stage_count_rows(config, stage_inputs):
+    checkpoint_stage_runs.append("count")
+    CoderMapperJSONClass(config["lookup_json_file_name"])
+    with open(os.path.join(config["input_directory"], "rows.txt")) as f:
+        n_rows = len(f.readlines())
+    with open(config["count_file_name"], "w") as fw:
+        fw.write(str(n_rows))
+    return {"count_file": config["count_file_name"]}
+
+
+def _stage_report_rows(config, stage_inputs):
+    checkpoint_stage_runs.append("report")
+    with open(stage_inputs["count_file"]) as f:
+        return {"report": "rows: " + f.read()}
+
+
+class TestStageCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.input_directory = "./test/checkpoint_input"
+        self.checkpoint_directory = "./test/checkpoints"
+        os.makedirs(self.input_directory)
+        with open(os.path.join(self.input_directory, "rows.txt"), "w") as fw:
+            fw.write("a\nb\n")
+        with open(os.path.join(self.input_directory, "lookup.json"), "w") as fw:
+            fw.write('{"a": {"code_id": 1}}')
+
+        self.config = {"input_directory": self.input_directory,
+                       "lookup_json_file_name": os.path.join(self.input_directory, "lookup.json"),
+                       "count_file_name": os.path.join(self.input_directory, "count.txt")}
+
+    def tearDown(self):
+        for directory in [self.input_directory, self.checkpoint_directory]:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+
+    def _run(self, build_options=None):
+        stage_graph = MappingStageGraph([MappingStage("count", _stage_count_rows, ["rows.txt"], ["count_file"]),
+                                         MappingStage("report", _stage_report_rows, ["count_file"], ["report"])])
+        checkpoints = StageCheckpoints(self.checkpoint_directory, self.input_directory, build_options)
+        del checkpoint_stage_runs[:]
+        return stage_graph.run(self.config, checkpoints=checkpoints)["report"]
+
+    def test_current_checkpoints_are_skipped(self):
+        self.assertEqual("rows: 2", self._run())
+        self.assertEqual(["count", "report"], checkpoint_stage_runs)
+
+        self.assertEqual("rows: 2", self._run())
+        self.assertEqual([], checkpoint_stage_runs)
+
+    def test_changed_input(self):
+        self._run()
+        with open(os.path.join(self.input_directory, "rows.txt"), "a") as fw:
+            fw.write("c\n")
+
+        # The stage reading the file passed on by the rerun stage reruns although its checkpoint pickle is unchanged
+        self.assertEqual("rows: 3", self._run())
+        self.assertEqual(["count", "report"], checkpoint_stage_runs)
+
+    def test_changed_lookup_file(self):
+        self._run()
+        with open(self.config["lookup_json_file_name"], "w") as fw:
+            fw.write('{"a": {"code_id": 2}}')
+
+        # The file passed on is rewritten unchanged so the stage reading it is still current
+        self.assertEqual("rows: 2", self._run())
+        self.assertEqual(["count"], checkpoint_stage_runs)
+
+    def test_changed_build_options(self):
+        self._run({"report": {"version": 1}})
+        self.assertEqual("rows: 2", self._run({"report": {"version": 2}}))
+        self.assertEqual(["report"], checkpoint_stage_runs)
+
+
+class TestIdRangeAllocator(unittest.TestCase):
+
+    def setUp(self):
+        with open("./test/id_range_rows.csv", "w", newline="") as fw:
+            fw.write("id,name\n1,a\n2,b\n\n3,c\n")
+
+    def tearDown(self):
+        os.remove("./test/id_range_rows.csv")
+
+    def test_reserve_csv_rows(self):
+        self.assertEqual(3, count_csv_rows("./test/id_range_rows.csv"))
+
+        id_ranges = IdRangeAllocator()
+        id_ranges.reserve_csv_rows("result", ["measurement", "observation"], "./test/id_range_rows.csv")
+        id_ranges.reserve("condition", "measurement", 10)
+        id_ranges.reserve_csv_rows("procedure", ["measurement"], "./test/id_range_rows.csv")
+        id_ranges.reserve_csv_rows("missing", ["observation"], "./test/not_a_file.csv")
+
+        self.assertEqual(0, id_ranges.offset("result", "measurement"))
+        self.assertEqual(3, id_ranges.offset("condition", "measurement"))
+        self.assertEqual((14, 16), id_ranges.id_range("procedure", "measurement"))
+        self.assertEqual((13, 16), id_ranges.offset_and_max_id("procedure", "measurement"))
+        self.assertEqual(3, id_ranges.offset("missing", "observation"))
+
+        with self.assertRaises(ValueError):
+            id_ranges.reserve("result", "measurement", 1)
+
+        id_ranges.check_rows_run("condition", 10)
+        with self.assertRaises(RuntimeError):
+            id_ranges.check_rows_run("result", 4)
+
+    def test_block_size(self):
+        id_ranges = IdRangeAllocator(block_size=1000)
+        id_ranges.reserve_csv_rows("result", ["measurement"], "./test/id_range_rows.csv")
+        id_ranges.reserve("condition", "measurement")
+        self.assertEqual((1001, 2000), id_ranges.id_range("condition", "measurement"))
+
+    def test_table_offsets(self):
+        id_ranges = IdRangeAllocator(table_offsets={"measurement": 500})
+        id_ranges.reserve_csv_rows("result", ["measurement", "observation"], "./test/id_range_rows.csv")
+        self.assertEqual((501, 503), id_ranges.id_range("result", "measurement"))
+        self.assertEqual((1, 3), id_ranges.id_range("result", "observation"))
+
+
+class TestChangedCSVKeys(unittest.TestCase):
+
+    def setUp(self):
+        with open("./test/keys_previous.csv", "w", newline="") as fw:
+            fw.write("s_person_id,code\n1,a\n2,b\n1,c\n3,d\n")
+        with open("./test/keys_current.csv", "w", newline="") as fw:
+            fw.write("S_PERSON_ID,code\n1,c\n2,x\n\n1,a\n4,\"e,f\"\n")
+
+    def tearDown(self):
+        for csv_file_name in ["./test/keys_previous.csv", "./test/keys_current.csv", "./test/keys_filtered.csv"]:
+            if os.path.exists(csv_file_name):
+                os.remove(csv_file_name)
+
+    def test_changed_csv_keys(self):
+        self.assertEqual({"1": 2, "2": 1, "4": 1},
+                         dict([(key, n_rows) for key, (n_rows, digest)
+                               in csv_key_digests("./test/keys_current.csv", "s_person_id").items()]))
+
+        # Reordering the rows of a key does not change it; the header differs in case only
+        self.assertEqual(set(["1", "2", "3", "4"]),
+                         changed_csv_keys("./test/keys_previous.csv", "./test/keys_current.csv", "s_person_id"))
+
+        with open("./test/keys_previous.csv", "w", newline="") as fw:
+            fw.write("S_PERSON_ID,code\n1,a\n2,b\n1,c\n3,d\n")
+        self.assertEqual(set(["2", "3", "4"]),
+                         changed_csv_keys("./test/keys_previous.csv", "./test/keys_current.csv", "s_person_id"))
+
+    def test_filter_csv_file(self):
+        self.assertEqual(3, filter_csv_file("./test/keys_current.csv", "./test/keys_filtered.csv", "s_person_id",
+                                            set(["1", "4"])))
+        with open("./test/keys_filtered.csv", newline="") as f:
+            self.assertEqual("S_PERSON_ID,code\n1,c\n1,a\n4,\"e,f\"\n", f.read())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -25,6 +25,15 @@ class TestMappers(unittest.TestCase):
         self.assertEqual(values_converted["value_2"], 4)
         self.assertEqual(values_converted["value_3"], 3.2)
 
+    def test_row_map_offset(self):
+
+        row_mapper = row_map_offset("measurement_id", 10, 12)
+        self.assertEqual({"measurement_id": 12}, row_mapper.map({":row_id": 2}))
+        with self.assertRaises(RuntimeError):
+            row_mapper.map({":row_id": 3})
+
+        self.assertEqual({"measurement_id": 1000}, row_map_offset("measurement_id", 10).map({":row_id": 990}))
+
 
 class TestUtilityFunctions(unittest.TestCase):
 